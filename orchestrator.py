@@ -5,17 +5,36 @@ Implements Context7 principles with multi-agent coordination
 """
 
 import asyncio
+import bisect
+import hashlib
 import json
+import math
+import multiprocessing
 import os
+import re
+import signal
+import socket
+import sqlite3
 import sys
+import threading
+import time
+import urllib.request
 import uuid
-from datetime import datetime
+import zlib
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from enum import Enum
+from fnmatch import fnmatchcase
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
 import logging
 from dataclasses import dataclass, field
-from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import click
 import yaml
@@ -23,27 +42,32 @@ from anthropic import AsyncAnthropic
 from dotenv import load_dotenv
 from loguru import logger
 from pydantic import BaseModel, Field
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import (retry, retry_if_exception_type, retry_if_not_exception_type,
+                      stop_after_attempt, wait_exponential)
+from tenacity.wait import wait_base
 from rich.console import Console
+from rich.live import Live
 from rich.progress import Progress, SpinnerColumn, TextColumn
 from rich.table import Table
+from rich.text import Text
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logger.remove()
-logger.add(
-    "workspace/logs/orchestrator.log",
-    rotation="1 day",
-    retention="30 days",
-    format="{time:YYYY-MM-DD HH:mm:ss} | {level} | {message}",
-    level=os.getenv("LOG_LEVEL", "INFO")
-)
-logger.add(sys.stderr, level="INFO")
-
 console = Console()
 
+def configure_logging(log_file: Path = Path("workspace/logs/orchestrator.log")):
+    """Log to ``log_file`` and stderr; called by the entry points, not on import"""
+    logger.remove()
+    logger.add(
+        log_file,
+        rotation="1 day",
+        retention="30 days",
+        format="{time:YYYY-MM-DD HH:mm:ss} | {level} | {message}",
+        level=os.getenv("LOG_LEVEL", "INFO")
+    )
+    logger.add(sys.stderr, level="INFO")
+
 # ============================================================================
 # Data Models
 # ============================================================================
@@ -61,6 +85,14 @@ class Priority(str, Enum):
     HIGH = "high"
     CRITICAL = "critical"
 
+# Scheduling rank used by the message queue; higher ranks are served first
+PRIORITY_RANKS = {
+    Priority.LOW: 0,
+    Priority.MEDIUM: 1,
+    Priority.HIGH: 2,
+    Priority.CRITICAL: 3,
+}
+
 class AgentStatus(str, Enum):
     IDLE = "idle"
     BUSY = "busy"
@@ -77,8 +109,17 @@ class AgentMessage(BaseModel):
     priority: Priority = Priority.MEDIUM
     payload: Dict[str, Any]
     thread_id: Optional[str] = None
+    in_reply_to: Optional[str] = None
     requires_response: bool = False
+    stream: bool = False
+    # Streamed reply text for the sender's on_partial callback, never work to process
+    partial: bool = False
+    batch: bool = False
     context: Optional[Dict[str, Any]] = None
+    # W3C trace context of the span that sent the message
+    traceparent: Optional[str] = None
+    # Broadcast topic, matched against each agent's AgentConfig.topics
+    topic: Optional[str] = None
 
 @dataclass
 class AgentConfig:
@@ -92,71 +133,2721 @@ class AgentConfig:
     can_invoke: List[str] = field(default_factory=list)
     blocked_by: List[str] = field(default_factory=list)
     parallel_safe: bool = True
+    max_tokens: int = 4000
+    temperature: float = 0.3
+    # Agent instances sharing the inbox
+    replicas: int = 1
+    # Broadcast topics the agent subscribes to (fnmatch patterns)
+    topics: List[str] = field(default_factory=lambda: ["*"])
+
+class AgentTaskError(Exception):
+    """An agent answered a task with an ERROR message"""
+    
+    def __init__(self, agent_name: str, error: str):
+        super().__init__(f"{agent_name} failed: {error}")
+        self.agent_name = agent_name
+        self.error = error
+
+# ============================================================================
+# Telemetry
+# ============================================================================
+
+@dataclass
+class Span:
+    """One timed operation, in the OpenTelemetry trace model"""
+    name: str
+    trace_id: str
+    span_id: str
+    parent_span_id: Optional[str]
+    start_ns: int
+    end_ns: int = 0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+    
+    @property
+    def duration(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e9
+        
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+        
+    def set_attributes(self, attributes: Dict[str, Any]):
+        self.attributes.update(attributes)
+        
+    def to_otlp(self) -> Dict[str, Any]:
+        """OTLP/JSON encoding of the span"""
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id or "",
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+
+def otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format"""
+    
+    BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self.gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+        
+    def inc(self, name: str, value: float = 1.0, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+            
+    def set(self, name: str, value: float, **labels: str):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+            
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            # Per-bucket counts, then sum and count
+            series = self.histograms.setdefault(key, [0.0] * (len(self.BUCKETS) + 2))
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+            
+    @staticmethod
+    def _labels(labels: Tuple[Tuple[str, str], ...], le: Optional[str] = None) -> str:
+        pairs = list(labels) + ([("le", le)] if le is not None else [])
+        if not pairs:
+            return ""
+        escaped = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                   for key, value in pairs]
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+        
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (series, labels), value in sorted(self.counters.items()):
+                    if series == name:
+                        lines.append(f"{name}{self._labels(labels)} {value:g}")
+            for name in sorted({name for name, _ in self.gauges}):
+                lines.append(f"# TYPE {name} gauge")
+                for (series, labels), value in sorted(self.gauges.items()):
+                    if series == name:
+                        lines.append(f"{name}{self._labels(labels)} {value:g}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (series, labels), values in sorted(self.histograms.items()):
+                    if series != name:
+                        continue
+                    for bound, count in zip(self.BUCKETS, values):
+                        lines.append(f"{name}_bucket{self._labels(labels, str(bound))} {count:g}")
+                    lines.append(f"{name}_bucket{self._labels(labels, '+Inf')} {values[-1]:g}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {values[-2]:g}")
+                    lines.append(f"{name}_count{self._labels(labels)} {values[-1]:g}")
+        return "\n".join(lines) + "\n"
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+class Telemetry:
+    """Spans around queue, context, LLM and workflow work
+
+    With ENABLE_TRACING set, finished spans are kept and flushed as
+    OTLP/JSON to OTEL_EXPORTER_OTLP_ENDPOINT (``/v1/traces``), or appended
+    to workspace/telemetry/traces.jsonl when no endpoint is set. Span
+    durations and LLM token counts always feed the Prometheus metrics that
+    serve_metrics exposes.
+    """
+    
+    def __init__(self, enabled: Optional[bool] = None, endpoint: Optional[str] = None,
+                 path: Path = Path("workspace/telemetry/traces.jsonl")):
+        self.enabled = enabled if enabled is not None else (
+            os.getenv("ENABLE_TRACING", "false").lower() == "true")
+        self.endpoint = endpoint if endpoint is not None else os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+        self.path = path
+        self.service_name = os.getenv("OTEL_SERVICE_NAME", "agentic-orchestrator")
+        self.batch_size = int(os.getenv("TELEMETRY_BATCH_SIZE", "512"))
+        self.metrics = Metrics()
+        # Called with every finished span, e.g. by the workflow profiler
+        self.listeners: List[Callable[[Span], None]] = []
+        self._spans: List[Span] = []
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        
+    @staticmethod
+    def child(name: str, start_ns: int, attributes: Optional[Dict[str, Any]] = None,
+              parent: Optional[str] = None) -> Span:
+        """A span under ``parent`` (a traceparent), or else under the current span"""
+        if parent:
+            _, trace_id, parent_id, _ = parent.split("-")
+        else:
+            current = _current_span.get()
+            trace_id = current.trace_id if current else uuid.uuid4().hex
+            parent_id = current.span_id if current else None
+        return Span(name=name, trace_id=trace_id, span_id=os.urandom(8).hex(),
+                    parent_span_id=parent_id, start_ns=start_ns, attributes=dict(attributes or {}))
+        
+    @contextmanager
+    def span(self, name: str, attributes: Optional[Dict[str, Any]] = None,
+             parent: Optional[str] = None):
+        """Time the enclosed block as a child of ``parent`` or the current span"""
+        span = self.child(name, time.time_ns(), attributes, parent)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = str(e) or type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            self.end(span)
+            
+    def record(self, name: str, start_ns: int, attributes: Optional[Dict[str, Any]] = None,
+               error: Optional[str] = None, parent: Optional[str] = None):
+        """Add a span that started at ``start_ns`` and ends now"""
+        span = self.child(name, start_ns, attributes, parent)
+        span.error = error
+        self.end(span)
+        
+    def count(self, attributes: Dict[str, int]):
+        """Add to numeric attributes of the current span"""
+        span = _current_span.get()
+        if span is not None:
+            for key, value in attributes.items():
+                span.attributes[key] = span.attributes.get(key, 0) + value
+                
+    def end(self, span: Span):
+        span.end_ns = time.time_ns()
+        attributes = span.attributes
+        agent = str(attributes.get("agent", ""))
+        self.metrics.observe("orchestrator_span_duration_seconds", span.duration, span=span.name, agent=agent)
+        if span.error:
+            self.metrics.inc("orchestrator_span_errors_total", span=span.name, agent=agent)
+        for key, value in attributes.items():
+            if key.startswith("gen_ai.usage."):
+                self.metrics.inc("orchestrator_llm_tokens_total", value, agent=agent,
+                                 model=str(attributes.get("gen_ai.request.model", "")),
+                                 kind=key[len("gen_ai.usage."):])
+        if "llm.ttft_ms" in attributes:
+            self.metrics.observe("orchestrator_llm_ttft_seconds", attributes["llm.ttft_ms"] / 1000,
+                                 agent=agent)
+        for listener in self.listeners:
+            listener(span)
+            
+        if self.enabled:
+            with self._lock:
+                self._spans.append(span)
+                full = len(self._spans) >= self.batch_size
+            if full:
+                threading.Thread(target=self.flush, daemon=True).start()
+                
+    def otlp(self, spans: List[Span]) -> Dict[str, Any]:
+        """OTLP/JSON ExportTraceServiceRequest for ``spans``"""
+        return {"resourceSpans": [{
+            "resource": {"attributes": [otlp_attribute("service.name", self.service_name)]},
+            "scopeSpans": [{
+                "scope": {"name": "orchestrator"},
+                "spans": [span.to_otlp() for span in spans],
+            }],
+        }]}
+        
+    def flush(self):
+        """Export the spans finished since the last flush"""
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if not spans:
+            return
+        body = json.dumps(self.otlp(spans))
+        if self.endpoint:
+            request = urllib.request.Request(
+                self.endpoint.rstrip("/") + "/v1/traces", data=body.encode(),
+                headers={"Content-Type": "application/json"}, method="POST"
+            )
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+            except OSError as e:
+                logger.warning(f"Span export to {self.endpoint} failed: {e}")
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(body + "\n")
+                
+    def serve_metrics(self, port: int) -> ThreadingHTTPServer:
+        """Serve Prometheus metrics on ``port`` from a background thread"""
+        metrics = self.metrics
+        
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                
+            def log_message(self, *args):
+                pass
+                
+        self._server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics on :{self._server.server_address[1]}/metrics")
+        return self._server
+        
+    def close(self):
+        self.flush()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+telemetry = Telemetry()
 
 # ============================================================================
 # Message Queue System
 # ============================================================================
 
+class MessageCodec:
+    """Encodes queued messages as a header byte followed by the body
+
+    The header's low nibble names the format (compact JSON or msgpack) and
+    its high nibble the compression (none, zlib or zstd), so every stored
+    message says how to read it back and inboxes written under different
+    MESSAGE_CODEC settings stay readable. Data starting with ``{`` is the
+    legacy plain-JSON encoding. Only bodies of at least ``compress_min_bytes``
+    are compressed; msgpack and zstd are optional, and a codec asked for one
+    that is not installed falls back to JSON and zlib respectively.
+    """
+    
+    FORMATS = ("json", "msgpack")
+    COMPRESSIONS = ("none", "zlib", "zstd")
+    LEGACY = ord("{")
+    
+    def __init__(self, format: Optional[str] = None, compression: Optional[str] = None,
+                 compress_min_bytes: Optional[int] = None):
+        format = (format or os.getenv("MESSAGE_CODEC", "json")).split("#")[0].strip().lower()
+        compression = (compression or os.getenv("MESSAGE_COMPRESSION", "zstd")).split("#")[0].strip().lower()
+        if format not in self.FORMATS:
+            logger.warning(f"Unknown MESSAGE_CODEC '{format}', using json")
+            format = "json"
+        if compression not in self.COMPRESSIONS:
+            logger.warning(f"Unknown MESSAGE_COMPRESSION '{compression}', using zlib")
+            compression = "zlib"
+        if format == "msgpack" and self._module("msgpack") is None:
+            logger.warning("msgpack not installed, encoding messages as JSON")
+            format = "json"
+        if compression == "zstd" and self._module("zstd") is None:
+            logger.debug("zstandard not installed, compressing messages with zlib")
+            compression = "zlib"
+        self.format = format
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes if compress_min_bytes is not None else int(
+            os.getenv("MESSAGE_COMPRESS_MIN_BYTES", "4096")
+        )
+        
+    @staticmethod
+    def _module(name: str):
+        try:
+            if name == "msgpack":
+                import msgpack
+                return msgpack
+            import zstandard
+            return zstandard
+        except ImportError:
+            return None
+            
+    def encode(self, message: AgentMessage) -> bytes:
+        if self.format == "msgpack":
+            body = self._module("msgpack").packb(message.model_dump(mode="json"))
+        else:
+            body = message.model_dump_json().encode()
+        compression = self.compression if len(body) >= self.compress_min_bytes else "none"
+        header = self.FORMATS.index(self.format) + 1 | self.COMPRESSIONS.index(compression) << 4
+        return bytes([header]) + self.compress(body, compression)
+        
+    @classmethod
+    def compress(cls, body: bytes, compression: str) -> bytes:
+        if compression == "zlib":
+            return zlib.compress(body, 6)
+        if compression == "zstd":
+            return cls._module("zstd").ZstdCompressor(level=3).compress(body)
+        return body
+        
+    @classmethod
+    def decompress(cls, body: bytes, compression: str) -> bytes:
+        if compression == "zlib":
+            return zlib.decompress(body)
+        if compression == "zstd":
+            return cls._module("zstd").ZstdDecompressor().decompress(body)
+        return body
+        
+    @classmethod
+    def decode(cls, data: Union[bytes, str]) -> AgentMessage:
+        """Decode data written by any codec, or legacy JSON text"""
+        if isinstance(data, str):
+            data = data.encode()
+        if data[0] == cls.LEGACY:
+            return AgentMessage.model_validate_json(data)
+        format, compression = cls.FORMATS[(data[0] & 0x0F) - 1], cls.COMPRESSIONS[data[0] >> 4]
+        body = cls.decompress(data[1:], compression)
+        if format == "msgpack":
+            return AgentMessage.model_validate(cls._module("msgpack").unpackb(body))
+        return AgentMessage.model_validate_json(body)
+
+class BlobStore:
+    """Content-addressed store for large payload values
+
+    ``externalize`` replaces every string in a payload of at least
+    ``min_bytes`` with a reference, ``{"$blob": "sha256:<hex>", "bytes": n}``,
+    and stores the string once under ``<base_path>/<hex[:2]>/<hex>``, so an
+    artifact sent to several agents, or sent again unchanged, is written once
+    and messages stay small. ``resolve`` swaps references back for their
+    content and is called only when a message is processed. Blobs are
+    immutable, so recently read ones are kept in memory. A blob's mtime is
+    the last time a message referenced it; ``sweep`` deletes the ones that
+    are no longer referenced once they are ``grace`` seconds old. With
+    MESSAGE_QUEUE_TYPE=redis across hosts, ``base_path`` must be shared
+    storage, or BLOB_MIN_BYTES=0 to keep payloads inline.
+    """
+    
+    REF = "$blob"
+    
+    def __init__(self, base_path: Path = Path("workspace/blobs"), min_bytes: Optional[int] = None,
+                 cache_bytes: int = 16 * 1024 * 1024, grace: float = 3600):
+        self.base_path = base_path
+        self.min_bytes = min_bytes if min_bytes is not None else int(os.getenv("BLOB_MIN_BYTES", "4096"))
+        self.cache_bytes = cache_bytes
+        # A blob is written before the message that references it is stored
+        self.grace = grace
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        
+    def path(self, digest: str) -> Path:
+        hexdigest = digest.split(":", 1)[-1]
+        return self.base_path / hexdigest[:2] / hexdigest
+        
+    def put(self, content: str) -> Dict[str, Any]:
+        """Store ``content`` (once) and return a reference to it"""
+        data = content.encode()
+        digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+        blob_path = self.path(digest)
+        try:
+            os.utime(blob_path)
+        except FileNotFoundError:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = blob_path.with_name(f"{blob_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, blob_path)
+        return {self.REF: digest, "bytes": len(data)}
+        
+    def sweep(self, keep: Set[str], cutoff: Optional[float] = None) -> int:
+        """Delete blobs not in ``keep`` and last referenced before ``cutoff``
+
+        ``cutoff`` defaults to ``grace`` seconds ago. Returns how many were deleted.
+        """
+        cutoff = min(cutoff if cutoff is not None else time.time(), time.time() - self.grace)
+        deleted = 0
+        for blob_path in self.base_path.glob("*/*"):
+            digest = f"sha256:{blob_path.name.split('.')[0]}"
+            try:
+                if digest in keep or blob_path.stat().st_mtime >= cutoff:
+                    continue
+                blob_path.unlink()
+            except FileNotFoundError:
+                continue
+            deleted += 1
+            with self._lock:
+                content = self._cache.pop(digest, None)
+                if content is not None:
+                    self._cached_bytes -= len(content)
+        return deleted
+        
+    def get(self, digest: str) -> str:
+        with self._lock:
+            content = self._cache.get(digest)
+            if content is not None:
+                self._cache.move_to_end(digest)
+                return content
+        content = self.path(digest).read_bytes().decode()
+        with self._lock:
+            if digest not in self._cache:
+                self._cache[digest] = content
+                self._cached_bytes += len(content)
+            while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+                self._cached_bytes -= len(self._cache.popitem(last=False)[1])
+        return content
+        
+    @classmethod
+    def is_ref(cls, value: Any) -> bool:
+        return isinstance(value, dict) and cls.REF in value and set(value) <= {cls.REF, "bytes"}
+        
+    @classmethod
+    def refs(cls, value: Any) -> Set[str]:
+        """Digests of the blobs ``value`` references"""
+        if cls.is_ref(value):
+            return {value[cls.REF]}
+        if isinstance(value, dict):
+            return set().union(*(cls.refs(item) for item in value.values()))
+        if isinstance(value, list):
+            return set().union(*(cls.refs(item) for item in value))
+        return set()
+        
+    @classmethod
+    def has_refs(cls, value: Any) -> bool:
+        if cls.is_ref(value):
+            return True
+        if isinstance(value, dict):
+            return any(cls.has_refs(item) for item in value.values())
+        if isinstance(value, list):
+            return any(cls.has_refs(item) for item in value)
+        return False
+        
+    def externalize(self, value: Any) -> Any:
+        """A copy of ``value`` with its large strings stored as blobs"""
+        if isinstance(value, str):
+            return self.put(value) if self.min_bytes and len(value) >= self.min_bytes else value
+        if isinstance(value, dict):
+            return {key: self.externalize(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.externalize(item) for item in value]
+        return value
+        
+    def resolve(self, value: Any) -> Any:
+        """A copy of ``value`` with blob references replaced by their content"""
+        if self.is_ref(value):
+            return self.get(value[self.REF])
+        if isinstance(value, dict):
+            return {key: self.resolve(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+        return value
+
+@dataclass
+class ThreadEntry:
+    """A message of a thread and where it currently sits"""
+    inbox: str
+    # pending, in_flight, done or archived; "stored" with Redis, which does not track it
+    state: str
+    message: AgentMessage
+
+class QueueBackend:
+    """Storage behind a MessageQueue
+
+    ``take`` hands out the next message for an agent. Backends that can block
+    server-side set ``blocking`` and honour ``timeout`` themselves; for the
+    others MessageQueue does the waiting. Messages handed out stay in flight
+    until ``ack`` is called. Backends that lease them to a consumer set
+    ``lease_period``; a consumer holding messages longer calls ``renew``.
+    """
+    
+    blocking = False
+    lease_period: Optional[float] = None
+    
+    async def put(self, message: AgentMessage):
+        raise NotImplementedError
+        
+    async def take(self, agent_name: str, timeout: Optional[float] = None) -> Optional[AgentMessage]:
+        raise NotImplementedError
+        
+    async def ack(self, agent_name: str, message_id: str):
+        """Mark a message as fully processed"""
+        
+    async def requeue_in_flight(self, agent_name: str, consumer: Optional[str] = None) -> int:
+        """Hand unacknowledged messages out again after their consumer died
+
+        Only ``consumer``'s messages when given (see queue_consumer_id), else
+        every consumer's. Returns how many were requeued. Backends that
+        reclaim abandoned work on their own return 0.
+        """
+        return 0
+        
+    async def renew(self, agent_name: str, message_ids: List[str]):
+        """Extend this consumer's lease on in-flight messages it still holds"""
+        
+    async def peek(self, agent_name: str) -> Optional[AgentMessage]:
+        """Return the message ``take`` would hand out next, without taking it"""
+        raise NotImplementedError
+        
+    async def depth(self, agent_name: str) -> int:
+        """Number of messages waiting to be taken"""
+        raise NotImplementedError
+        
+    async def depth_by_priority(self, agent_name: str) -> Dict[str, int]:
+        """Waiting messages per priority level"""
+        raise NotImplementedError
+        
+    async def publish(self, message: AgentMessage):
+        """Append a broadcast to the log every subscriber reads"""
+        raise NotImplementedError
+        
+    async def subscribe(self, agent_name: str):
+        """Give an agent a broadcast cursor at the end of the log, if it has none"""
+        
+    async def take_broadcast(self, agent_name: str, topics: List[str]) -> Optional[AgentMessage]:
+        """Next broadcast past the agent's cursor on one of ``topics``, advancing the cursor
+
+        Broadcasts are delivered at most once per agent; replicas share the
+        cursor. Returns None for agents that never subscribed.
+        """
+        return None
+        
+    async def thread(self, thread_id: str) -> List[ThreadEntry]:
+        """Every stored message of a thread, including its opening message, in any order"""
+        raise NotImplementedError
+        
+    async def compact(self, archive_after: float, retention: float = 0) -> int:
+        """Move messages processed over ``archive_after`` seconds ago out of the inboxes
+
+        Archived messages older than ``retention`` seconds (0 keeps them)
+        are deleted. Returns how many messages were archived. Backends that
+        bound their own storage return 0.
+        """
+        return 0
+        
+    async def referenced_blobs(self) -> Optional[Set[str]]:
+        """Digests of every blob a stored or archived message references
+
+        None for backends that do not track them; their blobs are swept by
+        age alone.
+        """
+        return None
+        
+    async def close(self):
+        """Release connections held by the backend"""
+
+class SQLiteInboxBackend(QueueBackend):
+    """Per-agent SQLite inbox under ``<base_path>/<agent>/inbox.sqlite``
+
+    Messages get a monotonic sequence number on insert. ``take`` looks at the
+    oldest pending message of each priority through the
+    ``(state, priority, seq)`` index and hands out the one with the highest
+    aged score: its priority rank plus one rank for every ``aging_interval``
+    seconds it has waited. CRITICAL work jumps the queue, while a LOW message
+    can never wait more than a few intervals. Dequeue and peek cost four index
+    lookups and depths are read from counter rows, independent of inbox size.
+    Legacy ``inbox/`` and ``processed/`` JSON files are imported the first
+    time an agent's inbox is opened.
+
+    Several consumers (agent replicas, in one process or many) can share an
+    inbox: ``take`` claims a message atomically under a lease of
+    ``lease_seconds``, and a message whose lease runs out is handed to the
+    next consumer that asks. Messages of one ``thread_id`` are handed out one
+    at a time, in the order they were sent. Rows hold the message as encoded
+    by ``codec``.
+
+    ``compact`` moves done messages into day-partitioned archive segments
+    (``<agent>/archive/<YYYY-MM-DD>.seg``) of compressed frames, indexed by
+    message and thread in the ``archive`` table, and deletes whole segments
+    past retention, so an inbox only holds live and recently done messages.
+
+    Broadcasts are written once to ``broadcasts/log.sqlite``, and every
+    subscribed agent reads them through its own cursor row.
+
+    With ``read_only`` the inboxes are opened read-only and left as they
+    are, without migration, so inspection tools can run next to a live
+    orchestrator; only the read methods (``peek``, ``depth``, ``thread``,
+    ``archived``) work.
+    """
+    
+    PENDING, IN_FLIGHT, DONE = 0, 1, 2
+    SCHEMA_VERSION = 6
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            thread_id TEXT,
+            from_agent TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 1,
+            enqueued_at REAL NOT NULL DEFAULT 0,
+            state INTEGER NOT NULL DEFAULT 0,
+            lease_until REAL NOT NULL DEFAULT 0,
+            consumer TEXT,
+            done_at REAL NOT NULL DEFAULT 0,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_state_priority_seq
+            ON messages (state, priority, seq);
+        CREATE INDEX IF NOT EXISTS messages_thread_state_seq
+            ON messages (thread_id, state, seq) WHERE thread_id IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS depths (
+            state INTEGER NOT NULL,
+            priority INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (state, priority)
+        );
+        CREATE TABLE IF NOT EXISTS archive (
+            id TEXT PRIMARY KEY,
+            thread_id TEXT,
+            created_at TEXT NOT NULL,
+            segment TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            position INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS archive_thread
+            ON archive (thread_id) WHERE thread_id IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS archive_segment ON archive (segment);
+        CREATE TABLE IF NOT EXISTS blob_refs (
+            id TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (id, digest)
+        ) WITHOUT ROWID;
+    """
+    
+    BROADCAST_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            topic TEXT NOT NULL,
+            from_agent TEXT NOT NULL,
+            enqueued_at REAL NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS cursors (
+            subscriber TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS blob_refs (
+            id TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (id, digest)
+        ) WITHOUT ROWID;
+    """
+    
+    def __init__(self, base_path: Path, aging_interval: Optional[float] = None,
+                 lease_seconds: Optional[float] = None, consumer: Optional[str] = None,
+                 codec: Optional[MessageCodec] = None, read_only: bool = False):
+        self.base_path = base_path
+        self.read_only = read_only
+        if not read_only:
+            self.base_path.mkdir(parents=True, exist_ok=True)
+        self.aging_interval = aging_interval if aging_interval is not None else float(
+            os.getenv("MESSAGE_QUEUE_AGING_SECONDS", "60")
+        )
+        self.lease_seconds = lease_seconds if lease_seconds is not None else float(
+            os.getenv("MESSAGE_QUEUE_LEASE_SECONDS", os.getenv("AGENT_TASK_TIMEOUT", "900"))
+        )
+        self.lease_period = self.lease_seconds
+        self.consumer = consumer or queue_consumer_id()
+        self.codec = codec or MessageCodec()
+        self._connections: Dict[str, sqlite3.Connection] = {}
+        self._broadcasts: Optional[sqlite3.Connection] = None
+        
+    def connection(self, agent_name: str) -> sqlite3.Connection:
+        """Open (and migrate, on first use) an agent's inbox database"""
+        conn = self._connections.get(agent_name)
+        if conn is None and self.read_only:
+            conn = sqlite3.connect(f"{(self.base_path / agent_name / 'inbox.sqlite').resolve().as_uri()}?mode=ro",
+                                   uri=True, isolation_level=None, timeout=30)
+            self._connections[agent_name] = conn
+        elif conn is None:
+            agent_dir = self.base_path / agent_name
+            agent_dir.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(agent_dir / "inbox.sqlite", isolation_level=None, timeout=30)
+            # Lets compaction hand freed pages back to the filesystem
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with sqlite_transaction(conn):
+                self._upgrade_schema(conn)
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # Inboxes created before compaction switch over with a one-off VACUUM
+                conn.execute("VACUUM")
+            self._connections[agent_name] = conn
+            migrate_legacy_inbox(conn, agent_dir, self.codec)
+        return conn
+        
+    def _upgrade_schema(self, conn: sqlite3.Connection):
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= self.SCHEMA_VERSION:
+            return
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+        if columns and "priority" not in columns:
+            # Version 1 inboxes were FIFO-only with a single counter per state
+            conn.execute("ALTER TABLE messages ADD COLUMN priority INTEGER NOT NULL DEFAULT 1")
+            conn.execute("ALTER TABLE messages ADD COLUMN enqueued_at REAL NOT NULL DEFAULT 0")
+            conn.execute("DROP INDEX IF EXISTS messages_state_seq")
+            conn.execute("DROP TABLE IF EXISTS counters")
+        if columns and "lease_until" not in columns:
+            # Version 2 inboxes had a single consumer and no leases
+            conn.execute("ALTER TABLE messages ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE messages ADD COLUMN consumer TEXT")
+        if columns and "done_at" not in columns:
+            # Version 5 inboxes did not record when a message was processed
+            conn.execute("ALTER TABLE messages ADD COLUMN done_at REAL NOT NULL DEFAULT 0")
+            conn.execute("UPDATE messages SET done_at = enqueued_at WHERE state = ?", (self.DONE,))
+        tracked = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'blob_refs'").fetchone()
+        for statement in self.SCHEMA.split(";"):
+            if statement.strip():
+                conn.execute(statement)
+        if columns and not tracked:
+            # Version 4 inboxes did not record blob references; archived ones are lost
+            for message_id, data in conn.execute("SELECT id, data FROM messages").fetchall():
+                insert_blob_refs(conn, message_id, MessageCodec.decode(data).payload)
+        conn.execute("DELETE FROM depths")
+        conn.execute(
+            "INSERT INTO depths SELECT state, priority, COUNT(*) FROM messages "
+            "GROUP BY state, priority"
+        )
+        conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        
+    def _next_pending(self, conn: sqlite3.Connection) -> Optional[tuple]:
+        """Pick the pending row with the best aged priority score
+
+        Rows behind an earlier pending or in-flight message of their thread
+        are skipped until that message is done.
+        """
+        now = time.time()
+        best, best_key = None, None
+        for rank in PRIORITY_RANKS.values():
+            row = conn.execute(
+                "SELECT seq, priority, enqueued_at, data FROM messages AS m "
+                "WHERE state = ? AND priority = ? AND (thread_id IS NULL OR NOT EXISTS ("
+                "    SELECT 1 FROM messages AS earlier WHERE earlier.thread_id = m.thread_id"
+                "    AND earlier.state IN (?, ?) AND earlier.seq < m.seq)) "
+                "ORDER BY seq LIMIT 1",
+                (self.PENDING, rank, self.PENDING, self.IN_FLIGHT)
+            ).fetchone()
+            if row is None:
+                continue
+            score = rank
+            if self.aging_interval > 0:
+                score += max(0.0, now - row[2]) / self.aging_interval
+            key = (score, rank, -row[0])
+            if best_key is None or key > best_key:
+                best, best_key = row, key
+        return best
+        
+    async def put(self, message: AgentMessage):
+        conn = self.connection(message.to_agent)
+        with sqlite_transaction(conn):
+            insert_inbox_row(conn, message, self.PENDING, self.codec)
+            
+    async def take(self, agent_name: str, timeout: Optional[float] = None) -> Optional[AgentMessage]:
+        conn = self.connection(agent_name)
+        with sqlite_transaction(conn):
+            self._release_expired(conn)
+            row = self._next_pending(conn)
+            if row is None:
+                return None
+            seq, rank, _, data = row
+            conn.execute("UPDATE messages SET state = ?, lease_until = ?, consumer = ? WHERE seq = ?",
+                         (self.IN_FLIGHT, time.time() + self.lease_seconds, self.consumer, seq))
+            move_inbox_count(conn, rank, self.PENDING, self.IN_FLIGHT)
+        return MessageCodec.decode(data)
+        
+    def _release_expired(self, conn: sqlite3.Connection, consumer: Optional[str] = None) -> int:
+        """Return in-flight rows to pending: those of ``consumer``, else those past their lease"""
+        if consumer is None:
+            where, params = "state = ? AND lease_until < ?", (self.IN_FLIGHT, time.time())
+        else:
+            where, params = "state = ? AND consumer = ?", (self.IN_FLIGHT, consumer)
+        counts = conn.execute(
+            f"SELECT priority, COUNT(*) FROM messages WHERE {where} GROUP BY priority", params
+        ).fetchall()
+        if counts:
+            conn.execute(f"UPDATE messages SET state = {self.PENDING}, consumer = NULL WHERE {where}", params)
+            for rank, count in counts:
+                move_inbox_count(conn, rank, self.IN_FLIGHT, self.PENDING, count)
+        return sum(count for _, count in counts)
+        
+    async def ack(self, agent_name: str, message_id: str):
+        conn = self.connection(agent_name)
+        with sqlite_transaction(conn):
+            row = conn.execute(
+                "SELECT priority FROM messages WHERE id = ? AND state = ?",
+                (message_id, self.IN_FLIGHT)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE messages SET state = ?, done_at = ? WHERE id = ?",
+                             (self.DONE, time.time(), message_id))
+                move_inbox_count(conn, row[0], self.IN_FLIGHT, self.DONE)
+                
+    async def requeue_in_flight(self, agent_name: str, consumer: Optional[str] = None) -> int:
+        conn = self.connection(agent_name)
+        with sqlite_transaction(conn):
+            if consumer is not None:
+                return self._release_expired(conn, consumer)
+            # Every consumer: expire all leases
+            conn.execute("UPDATE messages SET lease_until = 0 WHERE state = ?", (self.IN_FLIGHT,))
+            return self._release_expired(conn)
+            
+    async def renew(self, agent_name: str, message_ids: List[str]):
+        conn = self.connection(agent_name)
+        with sqlite_transaction(conn):
+            conn.executemany(
+                "UPDATE messages SET lease_until = ? WHERE id = ? AND state = ? AND consumer = ?",
+                [(time.time() + self.lease_seconds, message_id, self.IN_FLIGHT, self.consumer)
+                 for message_id in message_ids]
+            )
+        
+    async def peek(self, agent_name: str) -> Optional[AgentMessage]:
+        row = self._next_pending(self.connection(agent_name))
+        return MessageCodec.decode(row[3]) if row else None
+        
+    async def depth(self, agent_name: str) -> int:
+        return sum((await self.depth_by_priority(agent_name)).values())
+        
+    async def depth_by_priority(self, agent_name: str) -> Dict[str, int]:
+        counts = dict(self.connection(agent_name).execute(
+            "SELECT priority, count FROM depths WHERE state = ?", (self.PENDING,)
+        ).fetchall())
+        return {priority.value: counts.get(rank, 0) for priority, rank in PRIORITY_RANKS.items()}
+        
+    def broadcast_log(self) -> sqlite3.Connection:
+        if self._broadcasts is None:
+            log_dir = self.base_path / "broadcasts"
+            log_dir.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(log_dir / "log.sqlite", isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            tracked = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'blob_refs'").fetchone()
+            conn.executescript(self.BROADCAST_SCHEMA)
+            if not tracked:
+                with sqlite_transaction(conn):
+                    for message_id, data in conn.execute("SELECT id, data FROM broadcasts").fetchall():
+                        insert_blob_refs(conn, message_id, MessageCodec.decode(data).payload)
+            self._broadcasts = conn
+        return self._broadcasts
+        
+    async def publish(self, message: AgentMessage):
+        conn = self.broadcast_log()
+        with sqlite_transaction(conn):
+            conn.execute(
+                "INSERT OR IGNORE INTO broadcasts (id, topic, from_agent, enqueued_at, data) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (message.id, message.topic, message.from_agent, time.time(), self.codec.encode(message))
+            )
+            insert_blob_refs(conn, message.id, message.payload)
+            
+    async def subscribe(self, agent_name: str):
+        conn = self.broadcast_log()
+        with sqlite_transaction(conn):
+            conn.execute("INSERT OR IGNORE INTO cursors SELECT ?, COALESCE(MAX(seq), 0) FROM broadcasts",
+                         (agent_name,))
+            
+    async def take_broadcast(self, agent_name: str, topics: List[str]) -> Optional[AgentMessage]:
+        conn = self.broadcast_log()
+        with sqlite_transaction(conn):
+            row = conn.execute("SELECT seq FROM cursors WHERE subscriber = ?", (agent_name,)).fetchone()
+            if row is None:
+                return None
+            cursor, data = row[0], None
+            while data is None:
+                rows = conn.execute(
+                    "SELECT seq, topic, from_agent, data FROM broadcasts WHERE seq > ? ORDER BY seq LIMIT 100",
+                    (cursor,)
+                ).fetchall()
+                if not rows:
+                    break
+                for seq, topic, from_agent, candidate in rows:
+                    cursor = seq
+                    if from_agent != agent_name and topic_matches(topic, topics):
+                        data = candidate
+                        break
+            if cursor != row[0]:
+                conn.execute("UPDATE cursors SET seq = ? WHERE subscriber = ?", (cursor, agent_name))
+        if data is None:
+            return None
+        return MessageCodec.decode(data).model_copy(update={"to_agent": agent_name})
+        
+    async def compact(self, archive_after: float, retention: float = 0,
+                      batch_size: int = 500) -> int:
+        archived = 0
+        for inbox in sorted(self.base_path.glob("*/inbox.sqlite")):
+            agent_name = inbox.parent.name
+            while True:
+                # Batches keep each write transaction, and event-loop stall, short
+                count = self._archive_done(agent_name, time.time() - archive_after, batch_size)
+                archived += count
+                await asyncio.sleep(0)
+                if count < batch_size:
+                    break
+            if retention > 0:
+                self._expire_archive(agent_name, time.time() - retention)
+            self.connection(agent_name).execute("PRAGMA incremental_vacuum")
+        if (self.base_path / "broadcasts" / "log.sqlite").exists():
+            # Every subscriber has read these, and new ones start at the end
+            conn = self.broadcast_log()
+            where = ("enqueued_at < ? AND seq <= COALESCE((SELECT MIN(seq) FROM cursors), seq)",
+                     (time.time() - archive_after,))
+            with sqlite_transaction(conn):
+                conn.execute(f"DELETE FROM blob_refs WHERE id IN (SELECT id FROM broadcasts WHERE {where[0]})",
+                             where[1])
+                conn.execute(f"DELETE FROM broadcasts WHERE {where[0]}", where[1])
+        return archived
+        
+    def _archive_done(self, agent_name: str, cutoff: float, limit: int) -> int:
+        """Archive up to ``limit`` done messages processed before ``cutoff``
+
+        Segments are named by the day the messages were processed, so
+        retention counts from processing rather than from sending. Frames
+        are fsynced before the rows are swapped for index entries in the
+        same transaction, so a crash can at worst leave an unindexed frame
+        behind, never lose a message.
+        """
+        conn = self.connection(agent_name)
+        archive_dir = self.base_path / agent_name / "archive"
+        with sqlite_transaction(conn):
+            rows = conn.execute(
+                "SELECT seq, id, thread_id, created_at, priority, data, done_at FROM messages "
+                "WHERE state = ? AND done_at < ? ORDER BY seq LIMIT ?",
+                (self.DONE, cutoff, limit)
+            ).fetchall()
+            days: Dict[str, list] = {}
+            for row in rows:
+                days.setdefault(datetime.utcfromtimestamp(row[6]).date().isoformat(), []).append(row)
+            for day, day_rows in days.items():
+                segment = f"{day}.seg"
+                offset, length = write_archive_frame(
+                    archive_dir / segment, [row[5] for row in day_rows], self.codec.compression)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO archive VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(row[1], row[2], row[3], segment, offset, length, position)
+                     for position, row in enumerate(day_rows)]
+                )
+            conn.executemany("DELETE FROM messages WHERE seq = ?", [(row[0],) for row in rows])
+            for rank, count in Counter(row[4] for row in rows).items():
+                conn.execute("UPDATE depths SET count = count - ? WHERE state = ? AND priority = ?",
+                             (count, self.DONE, rank))
+        return len(rows)
+        
+    def _expire_archive(self, agent_name: str, cutoff: float):
+        """Delete archive segments whose whole day is older than ``cutoff``"""
+        conn = self.connection(agent_name)
+        first_kept = datetime.utcfromtimestamp(cutoff).date().isoformat()
+        for segment in sorted((self.base_path / agent_name / "archive").glob("*.seg")):
+            if segment.stem >= first_kept:
+                break
+            with sqlite_transaction(conn):
+                conn.execute("DELETE FROM blob_refs WHERE id IN (SELECT id FROM archive WHERE segment = ?)",
+                             (segment.name,))
+                conn.execute("DELETE FROM archive WHERE segment = ?", (segment.name,))
+            segment.unlink()
+            logger.info(f"Deleted archive segment {segment} past retention")
+            
+    async def referenced_blobs(self) -> Optional[Set[str]]:
+        digests: Set[str] = set()
+        connections = [self.connection(inbox.parent.name)
+                       for inbox in sorted(self.base_path.glob("*/inbox.sqlite"))]
+        if (self.base_path / "broadcasts" / "log.sqlite").exists():
+            connections.append(self.broadcast_log())
+        for conn in connections:
+            digests.update(digest for (digest,) in conn.execute("SELECT DISTINCT digest FROM blob_refs"))
+        return digests
+        
+    async def thread(self, thread_id: str) -> List[ThreadEntry]:
+        # One lookup on the thread and id indexes of each inbox and its archive
+        states = {self.PENDING: "pending", self.IN_FLIGHT: "in_flight", self.DONE: "done"}
+        entries = []
+        for inbox in sorted(self.base_path.glob("*/inbox.sqlite")):
+            agent_name = inbox.parent.name
+            rows = self.connection(agent_name).execute(
+                "SELECT state, data FROM messages WHERE thread_id = ? OR id = ?", (thread_id, thread_id)
+            ).fetchall()
+            entries.extend(ThreadEntry(agent_name, states[state], MessageCodec.decode(data))
+                           for state, data in rows)
+            entries.extend(ThreadEntry(agent_name, "archived", message)
+                           for message in await self.archived(agent_name, thread_id))
+        return entries
+        
+    async def archived(self, agent_name: str, thread_id: str) -> List[AgentMessage]:
+        """Archived messages of a thread (including its opening message), oldest first"""
+        conn = self.connection(agent_name)
+        if self.read_only and not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'archive'").fetchone():
+            # Inboxes from before compaction have no archive until they are next opened for writing
+            return []
+        rows = conn.execute(
+            "SELECT segment, offset, length, position FROM archive "
+            "WHERE thread_id = ? OR id = ? ORDER BY created_at",
+            (thread_id, thread_id)
+        ).fetchall()
+        archive_dir = self.base_path / agent_name / "archive"
+        frames: Dict[Tuple[str, int], List[bytes]] = {}
+        messages = []
+        for segment, offset, length, position in rows:
+            if (segment, offset) not in frames:
+                frames[segment, offset] = read_archive_frame(archive_dir / segment, offset, length)
+            messages.append(MessageCodec.decode(frames[segment, offset][position]))
+        return messages
+        
+    async def close(self):
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
+        if self._broadcasts is not None:
+            self._broadcasts.close()
+            self._broadcasts = None
+
+@contextmanager
+def sqlite_transaction(conn: sqlite3.Connection):
+    """Write transaction that takes the database lock up front"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def insert_inbox_row(conn: sqlite3.Connection, message: AgentMessage, state: int,
+                     codec: MessageCodec) -> bool:
+    """Insert a message row and bump its depth counter; duplicates are ignored"""
+    rank, now = PRIORITY_RANKS[message.priority], time.time()
+    inserted = conn.execute(
+        "INSERT OR IGNORE INTO messages "
+        "(id, thread_id, from_agent, created_at, priority, enqueued_at, state, done_at, data) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (message.id, message.thread_id, message.from_agent, message.timestamp.isoformat(),
+         rank, now, state, now if state == SQLiteInboxBackend.DONE else 0, codec.encode(message))
+    ).rowcount
+    if inserted:
+        conn.execute(
+            "INSERT INTO depths VALUES (?, ?, 1) "
+            "ON CONFLICT (state, priority) DO UPDATE SET count = count + 1",
+            (state, rank)
+        )
+        insert_blob_refs(conn, message.id, message.payload)
+    return bool(inserted)
+
+def insert_blob_refs(conn: sqlite3.Connection, message_id: str, payload: Any):
+    """Record the blobs a stored message references, so compaction keeps them"""
+    conn.executemany("INSERT OR IGNORE INTO blob_refs VALUES (?, ?)",
+                     [(message_id, digest) for digest in BlobStore.refs(payload)])
+
+def topic_matches(topic: Optional[str], patterns: List[str]) -> bool:
+    return any(fnmatchcase(topic or "general", pattern) for pattern in patterns)
+
+def write_archive_frame(segment: Path, records: List[Union[bytes, str]], compression: str) -> Tuple[int, int]:
+    """Append length-prefixed records as one compressed frame; returns its offset and length"""
+    body = b"".join(len(record).to_bytes(4, "big") + record
+                    for record in (r.encode() if isinstance(r, str) else r for r in records))
+    frame = bytes([MessageCodec.COMPRESSIONS.index(compression)]) + MessageCodec.compress(body, compression)
+    segment.parent.mkdir(parents=True, exist_ok=True)
+    with open(segment, "ab") as f:
+        offset = f.seek(0, os.SEEK_END)
+        f.write(frame)
+        f.flush()
+        os.fsync(f.fileno())
+    return offset, len(frame)
+
+def read_archive_frame(segment: Path, offset: int, length: int) -> List[bytes]:
+    """The records of the frame written at ``offset``"""
+    with open(segment, "rb") as f:
+        f.seek(offset)
+        frame = f.read(length)
+    body = MessageCodec.decompress(frame[1:], MessageCodec.COMPRESSIONS[frame[0]])
+    records, position = [], 0
+    while position < len(body):
+        size = int.from_bytes(body[position:position + 4], "big")
+        records.append(body[position + 4:position + 4 + size])
+        position += 4 + size
+    return records
+
+def move_inbox_count(conn: sqlite3.Connection, rank: int, from_state: int, to_state: int,
+                     count: int = 1):
+    conn.execute("UPDATE depths SET count = count - ? WHERE state = ? AND priority = ?",
+                 (count, from_state, rank))
+    conn.execute(
+        "INSERT INTO depths VALUES (?, ?, ?) "
+        "ON CONFLICT (state, priority) DO UPDATE SET count = count + excluded.count",
+        (to_state, rank, count)
+    )
+
+def migrate_legacy_inbox(conn: sqlite3.Connection, agent_dir: Path, codec: MessageCodec) -> int:
+    """Import ``inbox/*.json`` and ``processed/*.json`` files into the SQLite inbox
+
+    Files are deleted only after their rows are committed; re-running after an
+    interruption skips messages that were already imported.
+    """
+    migrated = 0
+    for folder, state in (("processed", SQLiteInboxBackend.DONE),
+                          ("inbox", SQLiteInboxBackend.PENDING)):
+        legacy_dir = agent_dir / folder
+        if not legacy_dir.is_dir():
+            continue
+        files = sorted(legacy_dir.glob("*.json"))
+        if not files:
+            continue
+            
+        imported = []
+        with sqlite_transaction(conn):
+            for message_file in files:
+                try:
+                    message = AgentMessage(**json.loads(message_file.read_text()))
+                except (ValueError, OSError) as e:
+                    logger.warning(f"Skipping unreadable legacy message {message_file}: {e}")
+                    continue
+                insert_inbox_row(conn, message, state, codec)
+                imported.append(message_file)
+                
+        for message_file in imported:
+            message_file.unlink()
+        migrated += len(imported)
+        
+    if migrated:
+        logger.info(f"Migrated {migrated} legacy messages into {agent_dir / 'inbox.sqlite'}")
+    return migrated
+
+class RedisStreamsBackend(QueueBackend):
+    """Redis Streams backend for multi-node deployments
+
+    Each agent has a stream per priority (``<prefix>:<agent>:inbox:<priority>``)
+    read through a consumer group named after the agent, so several
+    orchestrator processes or agent replicas can share an inbox. ``take``
+    looks at the next undelivered entry of each stream and reads the one
+    with the best aged score, as the SQLite inbox does: its priority rank
+    plus one rank per ``aging_interval`` seconds since it was added. Messages
+    stay pending until acked; entries left pending by a dead consumer for
+    longer than ``claim_idle`` seconds are claimed by the next consumer that
+    asks for work. Each thread's pending entries are queued by stream
+    position in ``<prefix>:<agent>:thread-queue:<id>``, and only the head of
+    that queue is handed out; a later entry read early stays pending until
+    acking the head pushes it onto the agent's ready list for the next
+    taker. A sorted set per thread (``<prefix>:thread:<id>``) indexes its
+    entries by send time and expires after MESSAGE_RETENTION_DAYS; a reply
+    also gets one under its own id.
+    """
+    
+    blocking = True
+    
+    def __init__(self, client=None, url: Optional[str] = None, prefix: str = "agents",
+                 consumer: Optional[str] = None, claim_idle: Optional[float] = None,
+                 maxlen: Optional[int] = None, codec: Optional[MessageCodec] = None,
+                 aging_interval: Optional[float] = None):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url or os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        self.client = client
+        self.prefix = prefix
+        self.consumer = consumer or queue_consumer_id()
+        self.claim_idle = claim_idle if claim_idle is not None else float(
+            os.getenv("MESSAGE_QUEUE_CLAIM_IDLE", "300")
+        )
+        self.aging_interval = aging_interval if aging_interval is not None else float(
+            os.getenv("MESSAGE_QUEUE_AGING_SECONDS", "60")
+        )
+        self.maxlen = maxlen or int(os.getenv("MESSAGE_QUEUE_REDIS_MAXLEN", "100000"))
+        self.codec = codec or MessageCodec()
+        self.thread_ttl = int(float(os.getenv("MESSAGE_RETENTION_DAYS", "30")) * 86400)
+        self._groups: Set[str] = set()
+        self._subscribed: Set[str] = set()
+        self._inflight: Dict[str, tuple] = {}
+        
+    @property
+    def lease_period(self) -> float:
+        return self.claim_idle
+        
+    def stream_key(self, agent_name: str, priority: Priority = Priority.MEDIUM) -> str:
+        return f"{self.prefix}:{agent_name}:inbox:{priority.value}"
+        
+    def stream_keys(self, agent_name: str) -> Dict[str, int]:
+        """An agent's streams and their priority ranks, most urgent first"""
+        return {self.stream_key(agent_name, priority): rank
+                for priority, rank in sorted(PRIORITY_RANKS.items(), key=lambda item: -item[1])}
+        
+    def thread_queue_key(self, agent_name: str, thread_id: str) -> str:
+        return f"{self.prefix}:{agent_name}:thread-queue:{thread_id}"
+        
+    async def _ensure_group(self, agent_name: str):
+        if agent_name in self._groups:
+            return
+        for key in self.stream_keys(agent_name):
+            try:
+                # Start from 0 so messages sent before the first reader are kept
+                await self.client.xgroup_create(key, agent_name, id="0", mkstream=True)
+            except Exception as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+        self._groups.add(agent_name)
+        
+    async def put(self, message: AgentMessage):
+        key = self.stream_key(message.to_agent, message.priority)
+        entry_id = await self.client.xadd(key, {"data": self.codec.encode(message)},
+                                          maxlen=self.maxlen, approximate=True)
+        if isinstance(entry_id, bytes):
+            entry_id = entry_id.decode()
+        if message.thread_id:
+            queue_key = self.thread_queue_key(message.to_agent, message.thread_id)
+            await self.client.zadd(queue_key, {f"{key}|{entry_id}": stream_position(entry_id)})
+            if self.thread_ttl > 0:
+                await self.client.expire(queue_key, self.thread_ttl)
+        # Replies are indexed under their own id too, so get_thread can start from one
+        for thread_id in {message.thread_id or message.id, message.id}:
+            thread_key = f"{self.prefix}:thread:{thread_id}"
+            await self.client.zadd(thread_key, {f"{key}|{entry_id}": time.time()})
+            if self.thread_ttl > 0:
+                await self.client.expire(thread_key, self.thread_ttl)
+            
+    async def thread(self, thread_id: str) -> List[ThreadEntry]:
+        entries = []
+        for member in await self.client.zrange(f"{self.prefix}:thread:{thread_id}", 0, -1):
+            key, entry_id = (member.decode() if isinstance(member, bytes) else member).split("|")
+            found = await self.client.xrange(key, min=entry_id, max=entry_id)
+            if found:
+                # Entries trimmed from the stream are gone
+                agent_name = key.rsplit(":", 2)[0][len(self.prefix) + 1:]
+                entries.append(ThreadEntry(agent_name, "stored",
+                                           MessageCodec.decode(found[0][1].get(b"data", found[0][1].get("data")))))
+        return entries
+        
+    async def take(self, agent_name: str, timeout: Optional[float] = None) -> Optional[AgentMessage]:
+        await self._ensure_group(agent_name)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or 0)
+        while True:
+            entry = await self._take_ready(agent_name) or await self._claim_abandoned(agent_name)
+            if entry is None:
+                entry = await self._read_next(agent_name, deadline - loop.time() if timeout else 0)
+                if entry is None:
+                    return None
+                if not entry:
+                    continue
+                    
+            key, entry_id, fields = entry
+            if not fields:
+                # Entry was trimmed from the stream while pending
+                await self.client.xack(key, agent_name, entry_id)
+                continue
+            message = MessageCodec.decode(fields.get(b"data", fields.get("data")))
+            if await self._thread_turn(agent_name, message.thread_id, key, entry_id):
+                self._inflight[message.id] = (key, entry_id, message.thread_id)
+                return message
+                
+    async def _take_ready(self, agent_name: str) -> Optional[tuple]:
+        """Claim the next entry whose turn in its thread came while someone else held it"""
+        while True:
+            member = await self.client.lpop(f"{self.prefix}:{agent_name}:ready")
+            if member is None:
+                return None
+            key, entry_id = (member.decode() if isinstance(member, bytes) else member).split("|")
+            # Whoever read it first still has it pending; take it over
+            claimed = await self.client.xclaim(key, agent_name, self.consumer, 0, [entry_id])
+            if claimed:
+                return (key, *claimed[0])
+                
+    async def _claim_abandoned(self, agent_name: str) -> Optional[tuple]:
+        """Recover work left in flight by consumers that went away"""
+        for key in self.stream_keys(agent_name):
+            claimed = await self.client.xautoclaim(key, agent_name, self.consumer,
+                                                   int(self.claim_idle * 1000),
+                                                   start_id="0-0", count=1)
+            if claimed and claimed[1]:
+                return (key, *claimed[1][0])
+        return None
+        
+    async def _read_next(self, agent_name: str, block: float) -> Optional[tuple]:
+        """Read the best-scored undelivered entry, waiting up to ``block`` seconds for one
+
+        Returns an empty tuple when another consumer read the chosen entry first.
+        """
+        candidates = await self._candidates(agent_name)
+        if candidates:
+            key = max(candidates, key=lambda candidate: candidate[:3])[3]
+            response = await self.client.xreadgroup(agent_name, self.consumer, {key: ">"}, count=1)
+            return (key, *response[0][1][0]) if response and response[0][1] else ()
+        if block <= 0:
+            return None
+            
+        streams = self.stream_keys(agent_name)
+        response = await self.client.xreadgroup(agent_name, self.consumer, {key: ">" for key in streams},
+                                                count=1, block=max(1, int(block * 1000)))
+        entries = sorted(((name.decode() if isinstance(name, bytes) else name, *entry)
+                          for name, stream_entries in response or [] for entry in stream_entries),
+                         key=lambda entry: -streams[entry[0]])
+        if not entries:
+            return None
+        # Entries that arrived together on other streams go to the next taker
+        for key, entry_id, _ in entries[1:]:
+            await self.client.rpush(f"{self.prefix}:{agent_name}:ready",
+                                    f"{key}|{entry_id.decode() if isinstance(entry_id, bytes) else entry_id}")
+        return entries[0]
+        
+    async def _candidates(self, agent_name: str) -> List[tuple]:
+        """(score, rank, -position, stream, entry) for the next undelivered entry of each stream"""
+        now = time.time()
+        candidates = []
+        for key, rank in self.stream_keys(agent_name).items():
+            group = await self._group_info(agent_name, key)
+            if group.get("lag") == 0:
+                continue
+            last_id = group.get("last-delivered-id", b"0-0")
+            if isinstance(last_id, bytes):
+                last_id = last_id.decode()
+            entries = await self.client.xrange(key, min=f"({last_id}", count=1)
+            if not entries:
+                continue
+            entry_id = entries[0][0].decode() if isinstance(entries[0][0], bytes) else entries[0][0]
+            score = rank
+            if self.aging_interval > 0:
+                # Stream ids start with the millisecond they were added
+                score += max(0.0, now - int(entry_id.split("-")[0]) / 1000) / self.aging_interval
+            candidates.append((score, rank, -stream_position(entry_id), key, entries[0]))
+        return candidates
+        
+    async def _thread_turn(self, agent_name: str, thread_id: Optional[str], key: str,
+                           entry_id: Any) -> bool:
+        """Whether an entry is the oldest unacked one of its thread"""
+        if not thread_id:
+            return True
+        if isinstance(entry_id, bytes):
+            entry_id = entry_id.decode()
+        head = await self.client.zrange(self.thread_queue_key(agent_name, thread_id), 0, 0)
+        return not head or (head[0].decode() if isinstance(head[0], bytes) else head[0]) == f"{key}|{entry_id}"
+        
+    async def ack(self, agent_name: str, message_id: str):
+        inflight = self._inflight.pop(message_id, None)
+        if inflight:
+            key, entry_id, thread_id = inflight
+            await self.client.xack(key, agent_name, entry_id)
+            if thread_id:
+                queue_key = self.thread_queue_key(agent_name, thread_id)
+                await self.client.zrem(queue_key,
+                                       f"{key}|{entry_id.decode() if isinstance(entry_id, bytes) else entry_id}")
+                head = await self.client.zrange(queue_key, 0, 0)
+                if head:
+                    # A replica may already have read it and be waiting on this ack
+                    await self.client.rpush(f"{self.prefix}:{agent_name}:ready", head[0])
+                    
+    async def renew(self, agent_name: str, message_ids: List[str]):
+        for message_id in message_ids:
+            inflight = self._inflight.get(message_id)
+            if inflight is not None:
+                key, entry_id, _ = inflight
+                # Claiming our own entry resets its idle time, keeping xautoclaim off it
+                await self.client.xclaim(key, agent_name, self.consumer, 0, [entry_id], justid=True)
+            
+    async def _group_info(self, agent_name: str, key: str) -> Dict[str, Any]:
+        await self._ensure_group(agent_name)
+        for group in await self.client.xinfo_groups(key):
+            name = group["name"]
+            if (name.decode() if isinstance(name, bytes) else name) == agent_name:
+                return group
+        return {}
+        
+    async def peek(self, agent_name: str) -> Optional[AgentMessage]:
+        await self._ensure_group(agent_name)
+        candidates = await self._candidates(agent_name)
+        if not candidates:
+            return None
+        fields = max(candidates, key=lambda candidate: candidate[:3])[4][1]
+        return MessageCodec.decode(fields.get(b"data", fields.get("data")))
+        
+    async def depth(self, agent_name: str) -> int:
+        return sum((await self.depth_by_priority(agent_name)).values())
+        
+    async def depth_by_priority(self, agent_name: str) -> Dict[str, int]:
+        depths = {}
+        for priority in PRIORITY_RANKS:
+            group = await self._group_info(agent_name, self.stream_key(agent_name, priority))
+            # "lag" is the number of entries not yet delivered to the group (Redis 7+)
+            depths[priority.value] = int(group.get("lag") or 0)
+        return depths
+        
+    async def publish(self, message: AgentMessage):
+        await self.client.xadd(f"{self.prefix}:broadcasts", {"data": self.codec.encode(message)},
+                               maxlen=self.maxlen, approximate=True)
+        
+    async def subscribe(self, agent_name: str):
+        # Each agent's consumer group on the broadcast stream is its cursor
+        try:
+            await self.client.xgroup_create(f"{self.prefix}:broadcasts", agent_name,
+                                            id="$", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._subscribed.add(agent_name)
+        
+    async def take_broadcast(self, agent_name: str, topics: List[str]) -> Optional[AgentMessage]:
+        if agent_name not in self._subscribed:
+            return None
+        key = f"{self.prefix}:broadcasts"
+        while True:
+            response = await self.client.xreadgroup(agent_name, self.consumer, {key: ">"}, count=1)
+            entries = response[0][1] if response else []
+            if not entries:
+                return None
+            entry_id, fields = entries[0]
+            await self.client.xack(key, agent_name, entry_id)
+            if not fields:
+                continue
+            message = MessageCodec.decode(fields.get(b"data", fields.get("data")))
+            if message.from_agent != agent_name and topic_matches(message.topic, topics):
+                return message.model_copy(update={"to_agent": agent_name})
+        
+    async def close(self):
+        close = getattr(self.client, "aclose", None) or self.client.close
+        await close()
+
+def stream_position(entry_id: str) -> int:
+    """Sortable number for a Redis stream entry id (``<ms>-<seq>``)"""
+    ms, seq = entry_id.split("-")
+    return int(ms) * 1000 + min(int(seq), 999)
+
+def queue_consumer_id(pid: Optional[int] = None) -> str:
+    """Name a process uses when claiming messages"""
+    return f"{socket.gethostname()}-{pid or os.getpid()}"
+
+def create_queue_backend(queue_type: Optional[str] = None,
+                         base_path: Path = Path("workspace/messages"),
+                         read_only: bool = False) -> QueueBackend:
+    """Build the backend selected by MESSAGE_QUEUE_TYPE
+
+    ``read_only`` opens SQLite inboxes without migrating them; Redis is
+    unaffected.
+    """
+    queue_type = (queue_type or os.getenv("MESSAGE_QUEUE_TYPE", "filesystem")).split("#")[0].strip().lower()
+    if queue_type == "redis":
+        return RedisStreamsBackend()
+    if queue_type not in ("filesystem", "sqlite"):
+        logger.warning(f"Unknown MESSAGE_QUEUE_TYPE '{queue_type}', using filesystem")
+    return SQLiteInboxBackend(base_path, read_only=read_only)
+
 class MessageQueue:
-    """File-based message queue for agent communication"""
+    """Message queue for agent communication
+
+    Storage is delegated to a QueueBackend chosen by MESSAGE_QUEUE_TYPE.
+    Receivers can block on ``receive(agent, timeout=...)``. Sends made through
+    this instance wake waiting agents immediately; for the filesystem backend,
+    sends from other processes are picked up through a watchdog observer on
+    the message directory, with ``poll_interval`` as a safety net when
+    watchdog is unavailable. Large payload values travel by reference to
+    a BlobStore next to the message directory; ``resolve`` fetches them.
+    """
     
-    def __init__(self, base_path: Path = Path("workspace/messages")):
+    def __init__(self, base_path: Path = Path("workspace/messages"),
+                 poll_interval: Optional[float] = None,
+                 backend: Optional[QueueBackend] = None,
+                 blobs: Optional[BlobStore] = None):
         self.base_path = base_path
-        self.base_path.mkdir(parents=True, exist_ok=True)
+        self.backend = backend or create_queue_backend(base_path=base_path)
+        self.blobs = blobs or BlobStore(base_path.parent / "blobs")
+        self.archive_after = float(os.getenv("MESSAGE_ARCHIVE_AFTER", "3600"))
+        self.retention = float(os.getenv("MESSAGE_RETENTION_DAYS", "30")) * 86400
+        self.compact_interval = float(os.getenv("MESSAGE_COMPACT_INTERVAL", "300"))
+        self.depth_interval = float(os.getenv("QUEUE_DEPTH_INTERVAL", "15"))
+        self.poll_interval = poll_interval if poll_interval is not None else float(
+            os.getenv("MESSAGE_QUEUE_POLL_INTERVAL", "5")
+        )
+        self._events: Dict[str, asyncio.Event] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._observer = None
         
     async def send(self, message: AgentMessage):
         """Send a message to an agent's inbox"""
-        inbox = self.base_path / message.to_agent / "inbox"
-        inbox.mkdir(parents=True, exist_ok=True)
-        
-        message_file = inbox / f"{message.timestamp.isoformat()}_{message.id}.json"
-        message_file.write_text(message.model_dump_json(indent=2))
+        # The receiver's spans become children of the sender's current span
+        current = _current_span.get()
+        if message.traceparent is None and current is not None:
+            message.traceparent = current.traceparent
+        payload = self.blobs.externalize(message.payload)
+        if payload != message.payload:
+            message = message.model_copy(update={"payload": payload})
+        with telemetry.span("queue.send", {
+            "agent": message.from_agent,
+            "messaging.destination.name": message.to_agent,
+            "messaging.message.id": message.id,
+            "messaging.message.type": message.type.value,
+        }):
+            await self.backend.put(message)
+            self._notify(message.to_agent)
         
         logger.info(f"Message {message.id} sent from {message.from_agent} to {message.to_agent}")
         
-    async def receive(self, agent_name: str) -> Optional[AgentMessage]:
-        """Receive the next message for an agent"""
-        inbox = self.base_path / agent_name / "inbox"
-        if not inbox.exists():
+    async def receive(self, agent_name: str, timeout: Optional[float] = None,
+                      topics: Optional[List[str]] = None) -> Optional[AgentMessage]:
+        """Receive the next message for an agent
+
+        Without a timeout this returns immediately. With a timeout it waits
+        until a message arrives or the timeout expires. With ``topics``,
+        broadcasts on them are delivered too once the agent's inbox is empty.
+        """
+        message = await self._receive(agent_name, timeout, topics)
+        if message:
+            # The span covers the time the message sat in the inbox
+            queued = datetime.utcnow() - message.timestamp
+            telemetry.record("queue.receive", time.time_ns() - max(int(queued.total_seconds() * 1e9), 0), {
+                "agent": agent_name,
+                "messaging.message.id": message.id,
+                "messaging.message.type": message.type.value,
+                "messaging.queue_time_ms": round(queued.total_seconds() * 1000, 3),
+            }, parent=message.traceparent)
+        return message
+        
+    async def _take(self, agent_name: str, topics: Optional[List[str]]) -> Optional[AgentMessage]:
+        message = await self.backend.take(agent_name)
+        if message is None and topics:
+            message = await self.backend.take_broadcast(agent_name, topics)
+        return message
+        
+    async def _receive(self, agent_name: str, timeout: Optional[float],
+                       topics: Optional[List[str]] = None) -> Optional[AgentMessage]:
+        if timeout is None:
+            return await self._take(agent_name, topics)
+        if self.backend.blocking:
+            if topics:
+                # Broadcasts reach a blocked receiver on its next call
+                message = await self._take(agent_name, topics)
+                if message is not None:
+                    return message
+            return await self.backend.take(agent_name, timeout)
+            
+        self._ensure_watcher()
+        event = self._event(agent_name)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        
+        while True:
+            # Clear before checking so a send racing with the check still wakes us
+            event.clear()
+            message = await self._take(agent_name, topics)
+            if message:
+                return message
+                
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            # asyncio.wait rather than wait_for: before Python 3.12, wait_for can
+            # swallow a cancellation that lands as the event fires
+            waiter = asyncio.ensure_future(event.wait())
+            try:
+                await asyncio.wait({waiter}, timeout=min(remaining, self.poll_interval))
+            finally:
+                waiter.cancel()
+                
+    async def resolve(self, message: AgentMessage) -> AgentMessage:
+        """``message`` with blob references in its payload replaced by their content"""
+        if not BlobStore.has_refs(message.payload):
+            return message
+        payload = await asyncio.get_running_loop().run_in_executor(
+            None, self.blobs.resolve, message.payload)
+        return message.model_copy(update={"payload": payload})
+        
+    async def ack(self, message: AgentMessage):
+        """Acknowledge that a received message has been fully processed"""
+        await self.backend.ack(message.to_agent, message.id)
+        
+    async def requeue(self, agent_name: str, consumer: Optional[str] = None) -> int:
+        """Make an agent's unacknowledged messages available again"""
+        requeued = await self.backend.requeue_in_flight(agent_name, consumer)
+        if requeued:
+            self._notify(agent_name)
+        return requeued
+        
+    @asynccontextmanager
+    async def leased(self, agent_name: str, messages: List[AgentMessage]):
+        """Keep received ``messages`` claimed by this consumer while the block runs
+
+        Leases are renewed every third of the backend's lease period, so
+        work that outlives a lease (a Message Batch) is not handed to
+        another replica.
+        """
+        period = self.backend.lease_period
+        if not period:
+            yield
+            return
+            
+        async def renew():
+            while True:
+                await asyncio.sleep(period / 3)
+                try:
+                    await self.backend.renew(agent_name, [message.id for message in messages])
+                except Exception as e:
+                    logger.warning(f"Renewing {agent_name}'s message leases failed: {e}")
+                    
+        renewing = asyncio.create_task(renew())
+        try:
+            yield
+        finally:
+            renewing.cancel()
+        
+    async def peek(self, agent_name: str) -> Optional[AgentMessage]:
+        """Look at the next message for an agent without dequeuing it"""
+        return await self.backend.peek(agent_name)
+        
+    async def depth(self, agent_name: str) -> int:
+        """Number of messages waiting in an agent's inbox"""
+        return await self.backend.depth(agent_name)
+        
+    async def depth_by_priority(self, agent_name: str) -> Dict[str, int]:
+        """Waiting messages in an agent's inbox, per priority level
+
+        Each call also sets the ``orchestrator_queue_depth`` gauge.
+        """
+        depths = await self.backend.depth_by_priority(agent_name)
+        for priority, depth in depths.items():
+            telemetry.metrics.set("orchestrator_queue_depth", depth, agent=agent_name, priority=priority)
+        return depths
+        
+    async def run_depth_metrics(self, agent_names: List[str]):
+        """Refresh the depth gauges of ``agent_names`` every ``depth_interval`` seconds until cancelled"""
+        while True:
+            for agent_name in agent_names:
+                try:
+                    await self.depth_by_priority(agent_name)
+                except Exception as e:
+                    logger.warning(f"Reading {agent_name}'s queue depth failed: {e}")
+            await asyncio.sleep(self.depth_interval)
+        
+    async def get_thread(self, message_id: str) -> List[ThreadEntry]:
+        """The thread ``message_id`` belongs to, oldest message first
+
+        ``message_id`` can be the thread id (the id of its opening message)
+        or the id of any reply in it.
+        """
+        entries = await self.backend.thread(message_id)
+        for entry in entries:
+            if entry.message.id == message_id and entry.message.thread_id not in (None, message_id):
+                entries = await self.backend.thread(entry.message.thread_id)
+                break
+        unique = {entry.message.id: entry for entry in entries}
+        return sorted(unique.values(), key=lambda entry: entry.message.timestamp)
+        
+    async def compact(self) -> int:
+        """Archive processed messages and drop those past retention"""
+        with telemetry.span("queue.compact", {"agent": "Orchestrator"}) as span:
+            archived = await self.backend.compact(self.archive_after, self.retention)
+            swept = await self.sweep_blobs()
+            span.set_attributes({"messaging.batch.message_count": archived, "queue.blobs_deleted": swept})
+        if archived:
+            logger.info(f"Archived {archived} processed messages")
+        if swept:
+            logger.info(f"Deleted {swept} unreferenced blobs")
+        return archived
+        
+    async def sweep_blobs(self) -> int:
+        """Delete blobs no stored or archived message references any more
+
+        Backends that do not track references lose a blob once nothing has
+        sent it for MESSAGE_RETENTION_DAYS; with retention off they keep all.
+        """
+        keep = await self.backend.referenced_blobs()
+        if keep is None:
+            if self.retention <= 0:
+                return 0
+            keep, cutoff = set(), time.time() - self.archive_after - self.retention
+        else:
+            cutoff = None
+        return await asyncio.get_running_loop().run_in_executor(None, self.blobs.sweep, keep, cutoff)
+        
+    async def run_compactor(self):
+        """Compact every ``compact_interval`` seconds until cancelled"""
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await self.compact()
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Message compaction failed: {e}")
+                
+    async def subscribe(self, agent_name: str):
+        """Start delivering broadcasts published from now on to an agent"""
+        await self.backend.subscribe(agent_name)
+        
+    async def broadcast(self, message: AgentMessage, topic: Optional[str] = None):
+        """Broadcast a message to all agents subscribed to its topic
+
+        The message is written once; each agent reads the broadcast log
+        through its own cursor.
+        """
+        payload = self.blobs.externalize(message.payload)
+        message = message.model_copy(update={"topic": topic or message.topic or "general",
+                                             "payload": payload})
+        with telemetry.span("queue.publish", {
+            "agent": message.from_agent,
+            "messaging.destination.name": message.topic,
+            "messaging.message.id": message.id,
+        }):
+            await self.backend.publish(message)
+        for agent_name in self._events:
+            self._notify(agent_name)
+        
+        logger.info(f"Broadcast message {message.id} from {message.from_agent} on {message.topic}")
+        
+    def close(self):
+        """Stop the filesystem watcher, if one was started"""
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=2)
+            self._observer = None
+            
+    def _event(self, agent_name: str) -> asyncio.Event:
+        if agent_name not in self._events:
+            self._events[agent_name] = asyncio.Event()
+        return self._events[agent_name]
+        
+    def _notify(self, agent_name: str):
+        """Wake any receiver waiting on this agent's inbox"""
+        event = self._events.get(agent_name)
+        if event is not None:
+            event.set()
+            
+    def _notify_threadsafe(self, agent_name: str):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._notify, agent_name)
+            
+    def _ensure_watcher(self):
+        """Start a watchdog observer so sends from other processes wake receivers"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self.close()
+        self._loop = loop
+        if not isinstance(self.backend, SQLiteInboxBackend):
+            return
+            
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            logger.debug("watchdog not installed, falling back to inbox polling")
+            return
+            
+        queue = self
+        
+        class InboxHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                path = Path(getattr(event, "dest_path", "") or event.src_path)
+                try:
+                    parts = path.relative_to(queue.backend.base_path.resolve()).parts
+                except ValueError:
+                    return
+                if len(parts) >= 2 and parts[0] == "broadcasts":
+                    for agent_name in list(queue._events):
+                        queue._notify_threadsafe(agent_name)
+                elif len(parts) >= 2 and parts[1].startswith("inbox"):
+                    queue._notify_threadsafe(parts[0])
+                    
+        observer = Observer()
+        observer.daemon = True
+        observer.schedule(InboxHandler(), str(self.backend.base_path.resolve()), recursive=True)
+        try:
+            observer.start()
+        except OSError as e:
+            logger.warning(f"Message watcher unavailable, falling back to polling: {e}")
+            return
+        self._observer = observer
+
+# ============================================================================
+# Context Assembly
+# ============================================================================
+
+# Queue, cache, checkpoint and telemetry state the orchestrator writes while
+# it runs; never agent context, even under a broad ``workspace/**`` pattern
+RUNTIME_STATE_DIRS = tuple(Path(path) for path in (
+    "workspace/messages", "workspace/blobs", "workspace/cache", "workspace/checkpoints",
+    "workspace/telemetry", "workspace/logs", "workspace/reports/profile",
+))
+
+def is_runtime_state(path: Path) -> bool:
+    """Whether a relative path lies under one of RUNTIME_STATE_DIRS"""
+    parts = path.parts
+    return any(parts[:len(root.parts)] == root.parts for root in RUNTIME_STATE_DIRS)
+
+class ContextCache:
+    """Shared cache of the files agents put into their system prompts
+
+    File contents are kept in an LRU bounded by ``max_bytes`` and keyed by
+    path, validated against mtime and size. Once a pattern's directory is
+    under a watchdog observer, glob results, file contents and composed
+    contexts are trusted until a filesystem event invalidates them, so an
+    unchanged workspace costs no filesystem calls at all. Without watchdog
+    every lookup re-globs and re-stats, but only changed files are re-read.
+    A change only rebuilds the composed contexts whose roots contain it, and
+    RUNTIME_STATE_DIRS are neither globbed nor watched.
+
+    Agents share one cache across the event loop, so blocking work goes
+    through ``offload`` onto a pool of CONTEXT_IO_THREADS threads. With
+    CONTEXT_PROCESS_WORKERS set, term counts for ranking are computed in
+    worker processes as well.
+    """
+    
+    def __init__(self, max_bytes: Optional[int] = None, watch: bool = True,
+                 io_threads: Optional[int] = None, process_workers: Optional[int] = None):
+        self.max_bytes = max_bytes or int(os.getenv("CONTEXT_CACHE_BYTES", str(64 * 1024 * 1024)))
+        self.executor = ThreadPoolExecutor(
+            max_workers=io_threads or int(os.getenv("CONTEXT_IO_THREADS", "4")),
+            thread_name_prefix="context"
+        )
+        self.process_workers = process_workers if process_workers is not None else int(
+            os.getenv("CONTEXT_PROCESS_WORKERS", "0"))
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self.hits = 0
+        self.misses = 0
+        self._files: "OrderedDict[Path, Tuple[int, int, str]]" = OrderedDict()
+        self._bytes = 0
+        self._globs: Dict[str, List[Path]] = {}
+        self._composed: Dict[tuple, Tuple[int, tuple]] = {}
+        self._terms: Dict[Path, Tuple[str, Counter]] = {}
+        # Per composed key: its roots, and a generation bumped by changes under them
+        self._roots: Dict[tuple, List[Path]] = {}
+        self._generations: Dict[tuple, int] = {}
+        self._lock = threading.RLock()
+        self._watch = watch
+        self._observer = None
+        self._watched: Set[Path] = set()
+        
+    async def offload(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run blocking ``fn(*args)`` on the context thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        
+    @staticmethod
+    def pattern_root(pattern: str) -> Path:
+        """Deepest directory of a glob pattern that contains no wildcards"""
+        parts = []
+        for part in Path(pattern).parts:
+            if any(char in part for char in "*?["):
+                break
+            parts.append(part)
+        else:
+            parts = parts[:-1]
+        return Path(*parts) if parts else Path(".")
+        
+    def compose(self, role_file: Path, patterns: List[str]) -> str:
+        """Role file followed by every file matching ``patterns``"""
+        role_content, files = self.collect(role_file, patterns)
+        return "\n\n".join([role_content] + [format_context_file(path, content)
+                                              for path, content in files])
+        
+    def collect(self, role_file: Path, patterns: List[str]) -> Tuple[str, List[Tuple[Path, str]]]:
+        """Role file contents and ``(path, contents)`` for every file matching ``patterns``"""
+        key = (str(role_file), tuple(patterns))
+        roots = [role_file.parent] + [self.pattern_root(pattern) for pattern in patterns]
+        for root in roots:
+            self.watch(root)
+            
+        with self._lock:
+            self._roots[key] = roots
+            generation = self._generations.get(key, 0)
+            cached = self._composed.get(key)
+            # Roots that do not exist yet have nothing to watch; watch() bumps
+            # the generation once they appear
+            if cached and cached[0] == generation and all(
+                    self._is_watched(root) or not root.exists() for root in roots):
+                self.hits += 1
+                return cached[1]
+                
+        role_content = (self.read(role_file) if role_file.exists() else "") or ""
+        files = []
+        for pattern in patterns:
+            for file in self.glob(pattern):
+                content = self.read(file)
+                if content is not None:
+                    files.append((file, content))
+        collected = (role_content, files)
+        
+        with self._lock:
+            self._composed[key] = (generation, collected)
+        return collected
+        
+    def terms(self, path: Path, content: str) -> Counter:
+        """Word counts of a file, cached for as long as its contents are"""
+        with self._lock:
+            cached = self._terms.get(path)
+            if cached is not None and cached[0] is content:
+                return cached[1]
+        counts = count_terms(content)
+        with self._lock:
+            self._terms[path] = (content, counts)
+        return counts
+        
+    def warm_terms(self, files: List[Tuple[Path, str]]):
+        """Count terms for every file not yet counted, in the process pool if configured"""
+        if self.process_workers <= 0:
+            return
+        with self._lock:
+            missing = [(path, content) for path, content in files
+                       if self._terms.get(path, (None,))[0] is not content]
+        if len(missing) < 2:
+            return
+        if self._processes is None:
+            # spawn rather than fork: this process runs watchdog and executor threads
+            self._processes = ProcessPoolExecutor(max_workers=self.process_workers,
+                                                  mp_context=multiprocessing.get_context("spawn"))
+        chunksize = max(1, len(missing) // (self.process_workers * 4))
+        counted = self._processes.map(count_terms, [content for _, content in missing], chunksize=chunksize)
+        with self._lock:
+            for (path, content), counts in zip(missing, counted):
+                self._terms[path] = (content, counts)
+        
+    def glob(self, pattern: str) -> List[Path]:
+        """Files matching a pattern relative to the working directory"""
+        with self._lock:
+            cached = self._globs.get(pattern)
+            if cached is not None and self._is_watched(self.pattern_root(pattern)):
+                return cached
+        files = sorted(file for file in Path(".").glob(pattern)
+                       if file.is_file() and not is_runtime_state(file))
+        with self._lock:
+            self._globs[pattern] = files
+        return files
+        
+    def read(self, path: Path) -> Optional[str]:
+        """File contents, or None if the file is gone or not text"""
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None and self._is_watched(path.parent):
+                self._files.move_to_end(path)
+                self.hits += 1
+                return cached[2]
+        try:
+            stat = path.stat()
+        except OSError:
+            self._forget(path)
             return None
             
-        messages = sorted(inbox.glob("*.json"))
-        if not messages:
+        with self._lock:
+            if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                self._files.move_to_end(path)
+                self.hits += 1
+                return cached[2]
+            self.misses += 1
+            
+        try:
+            content = path.read_text()
+        except (OSError, UnicodeDecodeError) as e:
+            logger.debug(f"Skipping {path} in context: {e}")
             return None
             
-        message_file = messages[0]
-        message_data = json.loads(message_file.read_text())
-        message = AgentMessage(**message_data)
+        with self._lock:
+            self._forget(path)
+            self._files[path] = (stat.st_mtime_ns, stat.st_size, content)
+            self._bytes += len(content)
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                _, (_, _, evicted) = self._files.popitem(last=False)
+                self._bytes -= len(evicted)
+        return content
         
-        # Move to processed
-        processed = self.base_path / agent_name / "processed"
-        processed.mkdir(parents=True, exist_ok=True)
-        message_file.rename(processed / message_file.name)
+    def invalidate(self, path: Optional[Path] = None, structural: bool = True):
+        """Drop cached state for a changed path (or everything)
+
+        ``structural`` changes (files created, deleted or moved) also drop
+        the glob results that could include the path. Only composed
+        contexts with a root containing the path are rebuilt.
+        """
+        with self._lock:
+            if path is None:
+                self._files.clear()
+                self._terms.clear()
+                self._bytes = 0
+                self._globs.clear()
+                self._bump(lambda root: True)
+                return
+            path = Path(os.path.relpath(path))
+            if is_runtime_state(path):
+                return
+            self._forget(path)
+            if structural:
+                for pattern in list(self._globs):
+                    root = self.pattern_root(pattern)
+                    if root == Path(".") or root in path.parents or root == path:
+                        del self._globs[pattern]
+            self._bump(lambda root: root == Path(".") or root == path or root in path.parents)
+            
+    def _bump(self, affects: Callable[[Path], bool]):
+        """Outdate the composed contexts with a root for which ``affects`` holds"""
+        for key, roots in self._roots.items():
+            if any(affects(root) for root in roots):
+                self._generations[key] = self._generations.get(key, 0) + 1
+            
+    def watch(self, root: Path):
+        """Trust cached entries under ``root`` and invalidate them from watchdog events"""
+        if not self._watch or not root.is_dir():
+            return
+        root = Path(os.path.relpath(root.resolve()))
+        if self._is_watched(root):
+            return
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            self._watch = False
+            return
+            
+        cache = self
         
-        return message
+        class ContextHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                # Our own reads raise opened/closed_no_write events; ignore them
+                if event.event_type not in ("created", "deleted", "moved", "modified", "closed"):
+                    return
+                if event.is_directory and event.event_type == "modified":
+                    return
+                structural = event.event_type in ("created", "deleted", "moved")
+                cache.invalidate(Path(event.src_path), structural)
+                if getattr(event, "dest_path", ""):
+                    cache.invalidate(Path(event.dest_path), structural)
+                    
+        with self._lock:
+            try:
+                if self._observer is None:
+                    self._observer = Observer()
+                    self._observer.daemon = True
+                    self._observer.start()
+                self._observer.schedule(ContextHandler(), str(root.resolve()), recursive=True)
+            except OSError as e:
+                logger.warning(f"Context watcher unavailable, validating by mtime: {e}")
+                self._watch = False
+                return
+            self._watched.add(root)
+            # Contexts that were validated by mtime under this root
+            self._bump(lambda other: other == root or root in other.parents or other in root.parents)
+            
+    def close(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=2)
+            self._observer = None
+        self._watched.clear()
+        self.executor.shutdown(wait=False)
+        if self._processes is not None:
+            # Reap the workers rather than leave them to exit on their own
+            self._processes.shutdown(wait=True, cancel_futures=True)
+            self._processes = None
+        
+    def _is_watched(self, path: Path) -> bool:
+        path = Path(os.path.relpath(path)) if path.is_absolute() else path
+        return any(root == Path(".") or root == path or root in path.parents
+                   for root in self._watched)
+        
+    def _forget(self, path: Path):
+        self._terms.pop(path, None)
+        cached = self._files.pop(path, None)
+        if cached is not None:
+            self._bytes -= len(cached[2])
+
+# System-prompt token budgets by model family; CONTEXT_TOKEN_BUDGET or an
+# agent's context_policy.max_context_tokens override them
+CONTEXT_TOKEN_BUDGETS = {
+    "opus": 120000,
+    "sonnet": 120000,
+    "haiku": 60000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 60000
+
+# Top-level directories whose files change during a run; everything else is
+# treated as stable and placed in the cacheable system prompt prefix
+VOLATILE_CONTEXT_ROOTS = ("workspace",)
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English and code)"""
+    return len(text) // 4 + 1
+
+def tokenize_terms(text: str) -> List[str]:
+    return [term.lower() for term in re.findall(r"[A-Za-z][A-Za-z0-9_]{2,}", text)]
+
+def count_terms(text: str) -> Counter:
+    return Counter(tokenize_terms(text))
+
+def format_context_file(path: Path, content: str) -> str:
+    return f"\n# File: {path}\n{content}"
+
+class ContextPacker:
+    """Fit an agent's role and files into a per-model token budget
+
+    Files are ranked by how many of the message's terms they contain (path
+    matches count extra) and admitted best-first until ``max_context_files``
+    or the budget is reached. The first file that does not fit is truncated
+    into the remaining space; the rest are listed in a short summary so the
+    agent knows they exist. Admitted files keep their original order, so
+    the packed context stays stable from one message to the next. A
+    context that fits whole does not depend on the message, so it is
+    reused until a file changes.
+    """
+    
+    TRUNCATE_MIN_TOKENS = 200
+    SUMMARY_LINE_CHARS = 160
+    
+    def __init__(self, cache: ContextCache):
+        self.cache = cache
+        # (model, policy), role, files and sections of the last context that fit whole
+        self._fitted: Optional[Tuple[tuple, str, List[Tuple[Path, str]], Tuple[str, str]]] = None
+        
+    @staticmethod
+    def budget_for(model: str, policy: Dict[str, Any]) -> int:
+        if policy.get("max_context_tokens"):
+            return int(policy["max_context_tokens"])
+        if os.getenv("CONTEXT_TOKEN_BUDGET"):
+            return int(os.getenv("CONTEXT_TOKEN_BUDGET"))
+        for family, budget in CONTEXT_TOKEN_BUDGETS.items():
+            if family in model:
+                return budget
+        return DEFAULT_CONTEXT_TOKEN_BUDGET
+        
+    def rank(self, files: List[Tuple[Path, str]], query: str) -> List[int]:
+        """Indexes of ``files``, most relevant to ``query`` first"""
+        query_terms = set(tokenize_terms(query))
+        if not query_terms:
+            return list(range(len(files)))
+        self.cache.warm_terms(files)
+            
+        def score(index: int) -> float:
+            path, content = files[index]
+            counts = self.cache.terms(path, content)
+            path_terms = set(tokenize_terms(str(path)))
+            return sum(math.log1p(counts[term]) + (2.0 if term in path_terms else 0.0)
+                       for term in query_terms)
+            
+        return sorted(range(len(files)), key=lambda index: (-score(index), index))
+        
+    def pack(self, role_content: str, files: List[Tuple[Path, str]], model: str,
+             policy: Optional[Dict[str, Any]] = None, query: str = "") -> str:
+        """Packed context as a single string"""
+        return "\n\n".join(part for part in self.pack_sections(role_content, files, model,
+                                                                policy, query) if part)
+        
+    @staticmethod
+    def is_stable(path: Path) -> bool:
+        """Whether a file belongs to the rarely-changing part of the context"""
+        return not path.parts or path.parts[0] not in VOLATILE_CONTEXT_ROOTS
+        
+    def pack_sections(self, role_content: str, files: List[Tuple[Path, str]], model: str,
+                      policy: Optional[Dict[str, Any]] = None, query: str = "") -> Tuple[str, str]:
+        """Packed context split into a stable prefix and a volatile remainder
+
+        The prefix holds the role file and whole stable files (prompts,
+        specs, agent definitions), so it is identical from one message to
+        the next while everything fits, which makes it a prompt-cache
+        candidate. When the budget binds, stable files compete with the
+        rest on relevance and the prefix holds the ones admitted. Workspace
+        files, truncated files and the omitted-file summary go into the
+        remainder.
+        """
+        policy = policy or {}
+        fitted = self._fitted
+        # ContextCache hands out the same string objects until a file changes
+        if (fitted is not None and fitted[0] == (model, policy) and fitted[1] is role_content
+                and len(fitted[2]) == len(files)
+                and all(path == old_path and content is old_content
+                        for (path, content), (old_path, old_content) in zip(files, fitted[2]))):
+            return fitted[3]
+        budget = self.budget_for(model, policy)
+        max_files = policy.get("max_context_files")
+        
+        role_tokens = estimate_tokens(role_content)
+        if role_tokens >= budget:
+            return self.truncate(role_content, budget), ""
+            
+        parts = [format_context_file(path, content) for path, content in files]
+        sizes = [estimate_tokens(part) for part in parts]
+        stable = [index for index, (path, _) in enumerate(files) if self.is_stable(path)]
+        stable_set = set(stable)
+        volatile = [index for index in range(len(files)) if index not in stable_set]
+        
+        if role_tokens + sum(sizes) <= budget and (not max_files or len(files) <= max_files):
+            sections = ("\n\n".join([role_content] + [parts[index] for index in stable]),
+                        "\n\n".join(parts[index] for index in volatile))
+            self._fitted = ((model, dict(policy)), role_content, list(files), sections)
+            return sections
+            
+        ranked = self.rank(files, query)
+        remaining = budget - role_tokens
+        admitted: Dict[int, str] = {}
+        truncated: Set[int] = set()
+        omitted: List[int] = []
+        for index in ranked:
+            if max_files and len(admitted) >= max_files:
+                omitted.append(index)
+            elif sizes[index] <= remaining:
+                admitted[index] = parts[index]
+                remaining -= sizes[index]
+            elif remaining >= self.TRUNCATE_MIN_TOKENS and not omitted:
+                # Leave room for the summary of everything that does not fit
+                reserve = min(remaining // 2, len(files) * self.SUMMARY_LINE_CHARS // 4)
+                admitted[index] = self.truncate(parts[index], remaining - reserve)
+                truncated.add(index)
+                remaining -= estimate_tokens(admitted[index])
+            else:
+                omitted.append(index)
+                
+        prefix = [index for index in stable if index in admitted and index not in truncated]
+        prefix_set = set(prefix)
+        rest = [index for index in sorted(admitted) if index not in prefix_set]
+        volatile_parts = [admitted[index] for index in rest]
+        if omitted:
+            summary = self.summarize([files[index] for index in omitted], remaining)
+            if summary:
+                volatile_parts.append(summary)
+        logger.debug(f"Packed {len(admitted)}/{len(files)} context files into {budget} tokens")
+        return ("\n\n".join([role_content] + [admitted[index] for index in prefix]),
+                "\n\n".join(volatile_parts))
+        
+    @staticmethod
+    def truncate(text: str, tokens: int) -> str:
+        total = estimate_tokens(text)
+        if total <= tokens:
+            return text
+        marker = f"\n[... truncated, {total - tokens} of {total} tokens omitted]"
+        keep = max(0, tokens * 4 - len(marker))
+        return text[:keep] + marker
+        
+    def summarize(self, files: List[Tuple[Path, str]], tokens: int) -> str:
+        """One line per omitted file: path, size and first non-empty line"""
+        lines = ["# Files omitted to fit the context budget (request them if needed)"]
+        used = estimate_tokens(lines[0])
+        for path, content in files:
+            first_line = next((line.strip() for line in content.splitlines() if line.strip()), "")
+            line = f"- {path} (~{estimate_tokens(content)} tokens): {first_line}"
+            line = line[:self.SUMMARY_LINE_CHARS]
+            used += estimate_tokens(line)
+            if used > tokens:
+                lines.append(f"- ... and {len(files) - len(lines) + 1} more")
+                break
+            lines.append(line)
+        return "\n".join(lines) if len(lines) > 1 else ""
+
+# ============================================================================
+# Rate Limiting
+# ============================================================================
+
+# (requests/min, tokens/min) by model family; ANTHROPIC_RPM and
+# ANTHROPIC_TPM override them for every model
+RATE_LIMITS = {
+    "opus": (50, 40000),
+    "sonnet": (50, 80000),
+    "haiku": (50, 100000),
+}
+DEFAULT_RATE_LIMIT = (50, 40000)
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Delay requested by a 429/529 response's retry-after header, if any"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class WaitRetryAfter(wait_base):
+    """tenacity wait that honours retry-after, falling back to ``fallback``"""
+    
+    def __init__(self, fallback: wait_base):
+        self.fallback = fallback
+        
+    def __call__(self, retry_state) -> float:
+        retry_after = retry_after_seconds(retry_state.outcome.exception())
+        if retry_after is not None:
+            return retry_after
+        return self.fallback(retry_state)
+
+class TokenBucket:
+    """Allowance of ``per_minute`` units that refills continuously"""
+    
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        
+    def delay(self, amount: float, now: float) -> float:
+        """Seconds until ``amount`` can be taken"""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        # A request bigger than the whole bucket only waits for a full one
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+        
+    def take(self, amount: float):
+        # May go negative when actual usage exceeds the reservation
+        self.level -= amount
+
+class RateLimiter:
+    """Shared concurrency, requests/min and tokens/min limiter for LLM calls
+
+    Every call acquires a slot before it is sent. Waiters are served in
+    priority order, so a CRITICAL message jumps ahead of queued MEDIUM
+    work; a waiter held back by its model's limits does not block waiters
+    for other models. Calls reserve their estimated input tokens and
+    settle the difference against actual usage on release. ``pause``
+    holds a model after a 429 until its retry-after has passed. Agent
+    processes under an AgentSupervisor each get a ``share`` of the limits.
+    """
+    
+    def __init__(self, max_concurrency: Optional[int] = None,
+                 rpm: Optional[int] = None, tpm: Optional[int] = None, share: float = 1.0):
+        self.share = share
+        self.max_concurrency = max(1, int((max_concurrency or int(
+            os.getenv("ANTHROPIC_MAX_CONCURRENCY", "8"))) * share))
+        # Unset and empty (as in .env.example) both mean the per-family defaults
+        self.rpm = rpm or int(os.getenv("ANTHROPIC_RPM") or 0)
+        self.tpm = tpm or int(os.getenv("ANTHROPIC_TPM") or 0)
+        self.active = 0
+        self.paused_until: Dict[str, float] = {}
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        # (-priority rank, seq, model, tokens, future), kept sorted
+        self._waiters: List[Tuple[int, int, str, int, asyncio.Future]] = []
+        self._seq = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        
+    def limits_for(self, model: str) -> Tuple[int, int]:
+        rpm, tpm = DEFAULT_RATE_LIMIT
+        for family, limits in RATE_LIMITS.items():
+            if family in model:
+                rpm, tpm = limits
+                break
+        return max(1, int((self.rpm or rpm) * self.share)), max(1, int((self.tpm or tpm) * self.share))
+        
+    def buckets(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        if model not in self._buckets:
+            rpm, tpm = self.limits_for(model)
+            self._buckets[model] = (TokenBucket(rpm), TokenBucket(tpm))
+        return self._buckets[model]
+        
+    @property
+    def waiting(self) -> int:
+        return sum(1 for *_, future in self._waiters if not future.done())
+        
+    async def acquire(self, model: str, tokens: int, priority: Priority = Priority.MEDIUM):
+        """Wait for a slot to send a request of about ``tokens`` input tokens"""
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        bisect.insort(self._waiters, (-PRIORITY_RANKS[priority], self._seq, model, tokens, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as we were cancelled; hand the slot back
+                self.active -= 1
+                self._dispatch()
+            raise
+            
+    def release(self, model: str, reserved: int, used: Optional[int] = None):
+        """Return a slot, charging the tokens actually used if known"""
+        self.active -= 1
+        if used is not None:
+            self.buckets(model)[1].take(used - reserved)
+        self._dispatch()
+        
+    def pause(self, model: str, seconds: float):
+        """Hold every call to ``model`` for ``seconds``"""
+        until = time.monotonic() + seconds
+        self.paused_until[model] = max(self.paused_until.get(model, 0.0), until)
+        logger.warning(f"Rate limited on {model}, pausing for {seconds:.1f}s")
+        
+    def _dispatch(self):
+        """Grant slots to every waiter that can go now, then wake up when the next can"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        blocked: Set[str] = set()
+        next_check: Optional[float] = None
+        for entry in list(self._waiters):
+            *_, model, tokens, future = entry
+            if future.done():
+                self._waiters.remove(entry)
+                continue
+            if self.active >= self.max_concurrency:
+                break
+            if model in blocked:
+                continue
+            requests, token_bucket = self.buckets(model)
+            delay = max(self.paused_until.get(model, 0.0) - now,
+                        requests.delay(1, now), token_bucket.delay(tokens, now))
+            if delay > 0:
+                # Later waiters for this model must not overtake this one
+                blocked.add(model)
+                next_check = delay if next_check is None else min(next_check, delay)
+                continue
+            requests.take(1)
+            token_bucket.take(tokens)
+            self.active += 1
+            self._waiters.remove(entry)
+            future.set_result(None)
+        if next_check is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_check, self._dispatch)
+
+# ============================================================================
+# Model Routing
+# ============================================================================
+
+# USD per million (input, output) tokens, by model family
+MODEL_PRICES = {
+    "opus": (15.0, 75.0),
+    "sonnet": (3.0, 15.0),
+    "haiku": (0.8, 4.0),
+}
+# Typical output tokens per second, by model family
+MODEL_OUTPUT_SPEEDS = {
+    "opus": 25.0,
+    "sonnet": 60.0,
+    "haiku": 120.0,
+}
+
+def model_family(model: str) -> str:
+    for family in MODEL_PRICES:
+        if family in model:
+            return family
+    return "sonnet"
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    input_price, output_price = MODEL_PRICES[model_family(model)]
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+def estimate_latency(model: str, output_tokens: int) -> float:
+    return output_tokens / MODEL_OUTPUT_SPEEDS[model_family(model)]
+
+@dataclass
+class ModelRoute:
+    """Model and sampling parameters chosen for one LLM call"""
+    model: str
+    max_tokens: int
+    temperature: float
+    reason: str = "default"
+
+class ModelRouter:
+    """Pick the model and output budget for each message an agent handles
+
+    Requests go to the agent's own model with its full ``max_tokens``, since
+    a short request can ask for a long document; only status checks and
+    pings get a small budget. Notifications and replies that need no
+    answer go to ROUTER_FALLBACK_MODEL with a small budget. Each call's
+    saving against the agent's configured model and budget is logged and
+    totalled; a call that used up a reduced budget is credited with the
+    output the configured budget allowed. MODEL_ROUTING=false sends
+    everything to the configured model.
+    """
+    
+    # Output budgets for traffic that only needs a short acknowledgement
+    ACK_MAX_TOKENS = {
+        MessageType.NOTIFICATION: 512,
+        MessageType.RESPONSE: 1024,
+        MessageType.ERROR: 1024,
+    }
+    # Request actions whose answer is a line or two, whatever the payload
+    SHORT_ACTIONS = {"status", "ping", "ack", "acknowledge", "health_check"}
+    SHORT_ACTION_MAX_TOKENS = 1024
+    
+    def __init__(self, enabled: Optional[bool] = None, fallback_model: Optional[str] = None):
+        self.enabled = enabled if enabled is not None else (
+            os.getenv("MODEL_ROUTING", "true").lower() == "true")
+        self.fallback_model = fallback_model or os.getenv(
+            "ROUTER_FALLBACK_MODEL", "claude-3-5-haiku-20241022")
+        self.saved_cost = 0.0
+        self.saved_seconds = 0.0
+        self.routed_calls = 0
+        
+    @staticmethod
+    def default(config: AgentConfig) -> ModelRoute:
+        return ModelRoute(config.model, config.max_tokens, config.temperature)
+        
+    def route(self, config: AgentConfig, message: AgentMessage) -> ModelRoute:
+        if not self.enabled:
+            return self.default(config)
+        if message.type in self.ACK_MAX_TOKENS and not message.requires_response:
+            return ModelRoute(self.fallback_model,
+                              min(self.ACK_MAX_TOKENS[message.type], config.max_tokens),
+                              config.temperature, reason=f"{message.type.value} ack")
+        if message.payload.get("action") in self.SHORT_ACTIONS:
+            return ModelRoute(config.model, min(self.SHORT_ACTION_MAX_TOKENS, config.max_tokens),
+                              config.temperature, reason=f"{message.payload['action']} request")
+        return ModelRoute(config.model, config.max_tokens, config.temperature, reason="request")
+        
+    def record(self, config: AgentConfig, route: ModelRoute, usage: Any):
+        """Log and total what a routed call saved over the configured model and budget"""
+        baseline = self.default(config)
+        # ``reason`` is only a label, so it does not make a route different
+        if usage is None or (route.model, route.max_tokens) == (baseline.model, baseline.max_tokens):
+            return
+        input_tokens = getattr(usage, "input_tokens", 0) or 0
+        output_tokens = getattr(usage, "output_tokens", 0) or 0
+        baseline_output = output_tokens
+        if route.max_tokens < baseline.max_tokens and output_tokens >= route.max_tokens:
+            baseline_output = baseline.max_tokens
+        saved_cost = (estimate_cost(baseline.model, input_tokens, baseline_output)
+                      - estimate_cost(route.model, input_tokens, output_tokens))
+        saved_seconds = (estimate_latency(baseline.model, baseline_output)
+                         - estimate_latency(route.model, output_tokens))
+        self.saved_cost += saved_cost
+        self.saved_seconds += saved_seconds
+        self.routed_calls += 1
+        logger.info(f"Routed {config.name} {route.reason} to {route.model} "
+                    f"(max_tokens {route.max_tokens}): saved ${saved_cost:.4f}, ~{saved_seconds:.1f}s")
+        
+    def summary(self) -> str:
+        return (f"Model routing: {self.routed_calls} calls rerouted, "
+                f"saved ~${self.saved_cost:.2f} and ~{self.saved_seconds:.0f}s of generation")
+
+# ============================================================================
+# LLM Response Cache
+# ============================================================================
+
+class ResponseCacheMissError(Exception):
+    """Replay mode was asked for a response that was never recorded"""
+
+class ResponseCache:
+    """Opt-in on-disk memo of LLM responses
+
+    Entries live under ``workspace/cache/llm`` keyed by a hash of the model,
+    system prompt, user prompt and sampling parameters. LLM_CACHE_MODE picks
+    the behaviour: ``off`` (default), ``readwrite`` (serve hits, record
+    misses) or ``replay`` (serve hits, fail on misses, never call the API),
+    which makes reruns offline and deterministic. Entries older than
+    LLM_CACHE_TTL seconds are ignored outside replay mode, and the least
+    recently used entries are evicted once the cache exceeds
+    LLM_CACHE_MAX_BYTES.
+    """
+    
+    MODES = ("off", "readwrite", "replay")
+    
+    def __init__(self, path: Path = Path("workspace/cache/llm"), mode: Optional[str] = None,
+                 ttl: Optional[float] = None, max_bytes: Optional[int] = None):
+        self.path = path
+        self.mode = (mode or os.getenv("LLM_CACHE_MODE", "off")).lower()
+        if self.mode not in self.MODES:
+            logger.warning(f"Unknown LLM_CACHE_MODE '{self.mode}', caching disabled")
+            self.mode = "off"
+        self.ttl = ttl if ttl is not None else float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+        self.max_bytes = max_bytes or int(os.getenv("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+        self._bytes: Optional[int] = None
         
-    async def broadcast(self, message: AgentMessage):
-        """Broadcast a message to all agents"""
-        broadcast_dir = self.base_path / "broadcasts"
-        broadcast_dir.mkdir(parents=True, exist_ok=True)
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
         
-        message_file = broadcast_dir / f"{message.timestamp.isoformat()}_{message.id}.json"
-        message_file.write_text(message.model_dump_json(indent=2))
+    @staticmethod
+    def key(model: str, system: Any, prompt: str, params: Dict[str, Any]) -> str:
+        system_hash = hashlib.sha256(json.dumps(system, sort_keys=True).encode()).hexdigest()
+        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+        material = json.dumps([model, system_hash, prompt_hash, params], sort_keys=True)
+        return hashlib.sha256(material.encode()).hexdigest()
         
-        logger.info(f"Broadcast message {message.id} from {message.from_agent}")
+    def entry_path(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.json"
+        
+    def get(self, key: str) -> Optional[str]:
+        entry_path = self.entry_path(key)
+        try:
+            entry = json.loads(entry_path.read_text())
+        except (OSError, ValueError):
+            if self.mode == "replay":
+                raise ResponseCacheMissError(f"No recorded response for {key[:12]}") from None
+            return None
+            
+        if self.mode != "replay" and time.time() - entry["created"] > self.ttl:
+            self._remove(entry_path)
+            return None
+        # Touch so eviction is least-recently-used rather than oldest-written
+        os.utime(entry_path)
+        return entry["response"]
+        
+    def put(self, key: str, model: str, response: str):
+        if self.mode != "readwrite":
+            return
+        entry_path = self.entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        data = json.dumps({"model": model, "created": time.time(), "response": response})
+        tmp_path = entry_path.with_suffix(".tmp")
+        tmp_path.write_text(data)
+        tmp_path.rename(entry_path)
+        
+        if self._bytes is None:
+            self._bytes = sum(entry.stat().st_size for entry in self.path.glob("*/*.json"))
+        else:
+            self._bytes += len(data)
+        if self._bytes > self.max_bytes:
+            self.evict()
+            
+    def evict(self):
+        """Drop least recently used entries until the cache is within budget"""
+        entries = []
+        for entry_path in self.path.glob("*/*.json"):
+            try:
+                stat = entry_path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # Evict down to 90% so we do not rescan on every put
+        target = self.max_bytes * 0.9
+        for _, size, entry_path in entries:
+            if total <= target:
+                break
+            self._remove(entry_path)
+            total -= size
+        self._bytes = total
+        
+    def _remove(self, entry_path: Path):
+        try:
+            entry_path.unlink()
+        except OSError:
+            pass
 
 # ============================================================================
 # Agent Base Class
 # ============================================================================
 
+# Per-agent token accounting kept by Agent.record_usage
+USAGE_COUNTERS = (
+    "calls",
+    "input_tokens",
+    "output_tokens",
+    "cache_read_input_tokens",
+    "cache_creation_input_tokens",
+    "cache_hits",
+    "cache_misses",
+    "response_cache_hits",
+)
+
 class Agent:
     """Base class for all agents"""
     
-    def __init__(self, config: AgentConfig, anthropic_client: AsyncAnthropic):
+    def __init__(self, config: AgentConfig, anthropic_client: AsyncAnthropic,
+                 message_queue: Optional[MessageQueue] = None,
+                 context_cache: Optional[ContextCache] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 router: Optional[ModelRouter] = None):
         self.config = config
         self.client = anthropic_client
         self.status = AgentStatus.IDLE
-        self.message_queue = MessageQueue()
+        self.message_queue = message_queue or MessageQueue()
+        self.context_cache = context_cache or ContextCache()
+        self.context_packer = ContextPacker(self.context_cache)
+        self.prompt_caching = os.getenv("PROMPT_CACHING", "true").lower() == "true"
+        self.usage: Dict[str, int] = {key: 0 for key in USAGE_COUNTERS}
+        self.response_cache = ResponseCache()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.router = router or ModelRouter()
+        self.idle_timeout = float(os.getenv("AGENT_IDLE_TIMEOUT", "30"))
+        self.stream_flush_interval = float(os.getenv("STREAM_FLUSH_INTERVAL", "0.25"))
+        self.batch_window = float(os.getenv("BATCH_WINDOW", "2"))
+        self.batch_max_requests = int(os.getenv("BATCH_MAX_REQUESTS", "1000"))
+        self.batch_poll_interval = float(os.getenv("BATCH_POLL_INTERVAL", "30"))
+        self.batches: Set[asyncio.Task] = set()
+        # Index among the instances of this agent sharing one inbox
+        self.replica = 0
         self.workspace = Path("workspace")
         self.logs_dir = self.workspace / "logs"
         self.logs_dir.mkdir(parents=True, exist_ok=True)
@@ -165,49 +2856,327 @@ class Agent:
         self.logger = logger.bind(agent=config.name)
         self.log_file = self.logs_dir / f"{config.name.lower().replace(' ', '_')}.log"
         
-    async def load_context(self) -> str:
-        """Load agent's role and context"""
-        role_content = self.config.role_file.read_text() if self.config.role_file.exists() else ""
-        
-        # Load allowed files
-        context_parts = [role_content]
-        for pattern in self.config.files_allowed:
-            files = Path(".").glob(pattern)
-            for file in files:
-                if file.exists() and file.is_file():
-                    context_parts.append(f"\n# File: {file}\n{file.read_text()}")
-                    
-        return "\n\n".join(context_parts)
+    async def load_context(self, message: Optional[AgentMessage] = None) -> str:
+        """Load agent's role and context, packed to the model's token budget
+
+        Files most relevant to ``message`` are preferred when everything does
+        not fit. With ``receive_only_curated`` set, a message that names
+        ``context.files`` narrows the context to those files.
+        """
+        return "\n\n".join(part for part in await self.pack_context(message) if part)
+        
+    async def load_system_prompt(self, message: Optional[AgentMessage] = None) -> List[Dict[str, Any]]:
+        """System prompt blocks, stable prefix first and marked cacheable"""
+        stable, volatile = await self.pack_context(message)
+        blocks = []
+        if stable:
+            block = {"type": "text", "text": stable}
+            if self.prompt_caching:
+                block["cache_control"] = {"type": "ephemeral"}
+            blocks.append(block)
+        if volatile:
+            blocks.append({"type": "text", "text": volatile})
+        return blocks
+        
+    async def pack_context(self, message: Optional[AgentMessage] = None) -> Tuple[str, str]:
+        with telemetry.span("agent.load_context", {"agent": self.config.name}) as span:
+            # Reading and packing run on the context pool so a large context
+            # does not hold up the other agents on the event loop
+            stable, volatile, files = await self.context_cache.offload(self.build_context, message)
+            span.set_attributes({
+                "context.files": files,
+                "context.stable_tokens": estimate_tokens(stable),
+                "context.volatile_tokens": estimate_tokens(volatile),
+            })
+            return stable, volatile
+            
+    def build_context(self, message: Optional[AgentMessage] = None) -> Tuple[str, str, int]:
+        """Stable and volatile context sections and the number of files considered"""
+        role_content, files = self.context_cache.collect(self.config.role_file,
+                                                         self.config.files_allowed)
+        policy = self.config.context_policy
+        query = ""
+        if message is not None:
+            curated = (message.context or {}).get("files")
+            if policy.get("receive_only_curated") and curated:
+                wanted = {Path(path) for path in curated}
+                files = [(path, content) for path, content in files if path in wanted]
+            query = json.dumps(message.payload)
+        stable, volatile = self.context_packer.pack_sections(role_content, files, self.config.model,
+                                                             policy, query)
+        return stable, volatile, len(files)
         
     @retry(
         stop=stop_after_attempt(int(os.getenv("MAX_RETRIES", "3"))),
-        wait=wait_exponential(multiplier=2, min=2, max=30)
+        wait=WaitRetryAfter(wait_exponential(multiplier=2, min=2, max=30)),
+        retry=retry_if_exception_type(Exception) & retry_if_not_exception_type(ResponseCacheMissError)
     )
-    async def invoke_llm(self, prompt: str, context: str) -> str:
-        """Invoke the LLM with retry logic"""
+    async def invoke_llm(self, prompt: str, context: Union[str, List[Dict[str, Any]]],
+                         priority: Priority = Priority.MEDIUM,
+                         route: Optional[ModelRoute] = None) -> str:
+        """Invoke the LLM with retry logic
+
+        ``context`` is the system prompt, either plain text or the blocks
+        from load_system_prompt. With LLM_CACHE_MODE set, recorded
+        responses are served from the ResponseCache. Calls wait for the
+        shared RateLimiter, ``priority`` deciding who goes first.
+        ``route`` overrides the agent's model and sampling parameters.
+        """
+        route = route or self.router.default(self.config)
+        request, cache_key = await self.prepare_llm_request(prompt, context, route)
+        with telemetry.span("llm.invoke", self.llm_attributes(route)) as span:
+            if cache_key:
+                cached = await self.context_cache.offload(self.response_cache.get, cache_key)
+                if cached is not None:
+                    self.usage["response_cache_hits"] += 1
+                    span.set_attributes({"llm.response_cache": "hit"})
+                    return cached
+                    
+            reserved = estimate_tokens(json.dumps(request.get("system", "")) + prompt)
+            queued = time.monotonic()
+            await self.rate_limiter.acquire(route.model, reserved, priority)
+            sent = time.monotonic()
+            span.set_attributes({"llm.rate_limit_wait_ms": round((sent - queued) * 1000, 3)})
+            used = None
+            try:
+                response = await self.client.messages.create(**request)
+                # Without streaming the first token arrives with the last
+                span.set_attributes({"llm.ttft_ms": round((time.monotonic() - sent) * 1000, 3),
+                                     **self.usage_attributes(response.usage)})
+                used = self.record_usage(response.usage)
+                self.router.record(self.config, route, response.usage)
+                text = response.content[0].text
+                if cache_key:
+                    await self.context_cache.offload(self.response_cache.put, cache_key, route.model, text)
+                return text
+            except Exception as e:
+                self.logger.error(f"LLM invocation failed: {e}")
+                retry_after = retry_after_seconds(e)
+                if retry_after:
+                    self.rate_limiter.pause(route.model, retry_after)
+                raise
+            finally:
+                self.rate_limiter.release(route.model, reserved, used)
+            
+    async def stream_llm(self, prompt: str, context: Union[str, List[Dict[str, Any]]],
+                         priority: Priority = Priority.MEDIUM,
+                         route: Optional[ModelRoute] = None) -> AsyncIterator[str]:
+        """Invoke the LLM and yield text deltas as they are generated
+
+        Same request and response cache as invoke_llm, but without retries:
+        a retry after text has been yielded would repeat it.
+        """
+        route = route or self.router.default(self.config)
+        request, cache_key = await self.prepare_llm_request(prompt, context, route)
+        # Recorded rather than entered: a generator may be closed from another context
+        started = time.time_ns()
+        attributes = {**self.llm_attributes(route), "llm.stream": True}
+        if cache_key:
+            cached = await self.context_cache.offload(self.response_cache.get, cache_key)
+            if cached is not None:
+                self.usage["response_cache_hits"] += 1
+                telemetry.record("llm.invoke", started, {**attributes, "llm.response_cache": "hit"})
+                yield cached
+                return
+                
+        parts = []
+        reserved = estimate_tokens(json.dumps(request.get("system", "")) + prompt)
+        await self.rate_limiter.acquire(route.model, reserved, priority)
+        sent = time.monotonic()
+        attributes["llm.rate_limit_wait_ms"] = round((time.time_ns() - started) / 1e6, 3)
+        used = None
+        error = None
         try:
-            response = await self.client.messages.create(
-                model=self.config.model,
-                max_tokens=4000,
-                temperature=0.3,
-                system=context,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return response.content[0].text
-        except Exception as e:
-            self.logger.error(f"LLM invocation failed: {e}")
+            async with self.client.messages.stream(**request) as stream:
+                async for text in stream.text_stream:
+                    if not parts:
+                        attributes["llm.ttft_ms"] = round((time.monotonic() - sent) * 1000, 3)
+                    parts.append(text)
+                    yield text
+                final = await stream.get_final_message()
+            attributes.update(self.usage_attributes(final.usage))
+            used = self.record_usage(final.usage)
+            self.router.record(self.config, route, final.usage)
+        except BaseException as e:
+            error = str(e) or type(e).__name__
+            if isinstance(e, Exception):
+                self.logger.error(f"LLM streaming failed: {e}")
+                retry_after = retry_after_seconds(e)
+                if retry_after:
+                    self.rate_limiter.pause(route.model, retry_after)
             raise
+        finally:
+            self.rate_limiter.release(route.model, reserved, used)
+            telemetry.record("llm.invoke", started, attributes, error)
+        if cache_key:
+            await self.context_cache.offload(self.response_cache.put, cache_key, route.model, "".join(parts))
             
+    async def invoke_llm_batch(self, requests: List[Tuple[str, Union[str, List[Dict[str, Any]]]]],
+                               routes: Optional[List[ModelRoute]] = None) -> List[Union[str, Exception]]:
+        """Run many (prompt, context) pairs through the Message Batches API
+
+        Returns one result per request, in order: the response text, or the
+        exception for a request that failed. Responses already in the
+        ResponseCache are not submitted. The batch is polled every
+        BATCH_POLL_INTERVAL seconds until it has ended.
+        """
+        routes = routes or [self.router.default(self.config)] * len(requests)
+        results: List[Union[str, Exception, None]] = [None] * len(requests)
+        submitted: Dict[str, Tuple[int, Optional[str]]] = {}
+        batch_requests = []
+        for index, (prompt, context) in enumerate(requests):
+            request, cache_key = await self.prepare_llm_request(prompt, context, routes[index])
+            if cache_key:
+                try:
+                    cached = await self.context_cache.offload(self.response_cache.get, cache_key)
+                except ResponseCacheMissError as e:
+                    results[index] = e
+                    continue
+                if cached is not None:
+                    self.usage["response_cache_hits"] += 1
+                    results[index] = cached
+                    continue
+            custom_id = f"request-{index}"
+            submitted[custom_id] = (index, cache_key)
+            batch_requests.append({"custom_id": custom_id, "params": request})
+            
+        if batch_requests:
+            with telemetry.span("llm.batch", {**self.llm_attributes(routes[0]),
+                                               "llm.batch.requests": len(batch_requests)}):
+                batch = await self.client.messages.batches.create(requests=batch_requests)
+                self.logger.info(f"Submitted batch {batch.id} with {len(batch_requests)} requests")
+                while batch.processing_status != "ended":
+                    await asyncio.sleep(self.batch_poll_interval)
+                    batch = await self.client.messages.batches.retrieve(batch.id)
+                
+                async for entry in await self.client.messages.batches.results(batch.id):
+                    index, cache_key = submitted.pop(entry.custom_id)
+                    if entry.result.type == "succeeded":
+                        telemetry.count(self.usage_attributes(entry.result.message.usage))
+                        self.record_usage(entry.result.message.usage)
+                        self.router.record(self.config, routes[index], entry.result.message.usage)
+                        text = entry.result.message.content[0].text
+                        if cache_key:
+                            await self.context_cache.offload(self.response_cache.put, cache_key,
+                                                             routes[index].model, text)
+                        results[index] = text
+                    else:
+                        detail = getattr(entry.result, "error", None) or entry.result.type
+                        results[index] = AgentTaskError(self.config.name, f"batch request {entry.result.type}: {detail}")
+                for index, _ in submitted.values():
+                    results[index] = AgentTaskError(self.config.name, f"missing from batch {batch.id} results")
+                
+        return results
+        
+    def llm_attributes(self, route: ModelRoute) -> Dict[str, Any]:
+        """Span attributes describing an LLM call, after the GenAI conventions"""
+        return {
+            "agent": self.config.name,
+            "gen_ai.system": "anthropic",
+            "gen_ai.request.model": route.model,
+            "gen_ai.request.max_tokens": route.max_tokens,
+            "gen_ai.request.temperature": route.temperature,
+        }
+        
+    @staticmethod
+    def usage_attributes(usage: Any) -> Dict[str, int]:
+        return {
+            f"gen_ai.usage.{key}": getattr(usage, key, None) or 0
+            for key in ("input_tokens", "output_tokens",
+                        "cache_read_input_tokens", "cache_creation_input_tokens")
+        }
+        
+    async def prepare_llm_request(self, prompt: str, context: Union[str, List[Dict[str, Any]]],
+                                  route: ModelRoute) -> Tuple[Dict[str, Any], Optional[str]]:
+        """llm_request, hashing for the response cache key on the context pool
+
+        hashlib releases the GIL on large inputs, so hashing a big system
+        prompt there runs alongside the event loop.
+        """
+        if not self.response_cache.enabled:
+            return self.llm_request(prompt, context, route)
+        return await self.context_cache.offload(self.llm_request, prompt, context, route)
+        
+    def llm_request(self, prompt: str, context: Union[str, List[Dict[str, Any]]],
+                    route: ModelRoute) -> Tuple[Dict[str, Any], Optional[str]]:
+        """Messages API request for a prompt, and its response cache key if caching is on"""
+        params = {"max_tokens": route.max_tokens, "temperature": route.temperature}
+        cache_key = None
+        if self.response_cache.enabled:
+            cache_key = self.response_cache.key(route.model, context, prompt, params)
+        request = {
+            "model": route.model,
+            **params,
+            "messages": [{"role": "user", "content": prompt}]
+        }
+        if context:
+            request["system"] = context
+        return request, cache_key
+        
+    def record_usage(self, usage: Any) -> Optional[int]:
+        """Accumulate token counts, including prompt cache reads and writes
+
+        Returns the tokens that count against the rate limit.
+        """
+        if usage is None:
+            return None
+        self.usage["calls"] += 1
+        for key in ("input_tokens", "output_tokens",
+                    "cache_read_input_tokens", "cache_creation_input_tokens"):
+            self.usage[key] += getattr(usage, key, None) or 0
+        if getattr(usage, "cache_read_input_tokens", None):
+            self.usage["cache_hits"] += 1
+        else:
+            self.usage["cache_misses"] += 1
+        self.logger.debug(
+            f"Tokens in={getattr(usage, 'input_tokens', 0)} out={getattr(usage, 'output_tokens', 0)} "
+            f"cache_read={getattr(usage, 'cache_read_input_tokens', 0) or 0} "
+            f"cache_write={getattr(usage, 'cache_creation_input_tokens', 0) or 0}"
+        )
+        return sum(getattr(usage, key, None) or 0
+                   for key in ("input_tokens", "output_tokens", "cache_creation_input_tokens"))
+        
     async def process_message(self, message: AgentMessage) -> Optional[AgentMessage]:
         """Process an incoming message"""
+        if message.partial:
+            # A streamed reply an agent asked for arrives whole as the RESPONSE
+            self.logger.debug(f"Ignoring partial reply {message.id} from {message.from_agent}")
+            return None
         self.status = AgentStatus.BUSY
         self.logger.info(f"Processing message {message.id} from {message.from_agent}")
         
-        try:
-            context = await self.load_context()
-            
-            # Add message context
-            prompt = f"""
+        with telemetry.span("agent.process", {
+            "agent": self.config.name,
+            "messaging.message.id": message.id,
+            "messaging.message.type": message.type.value,
+        }, parent=message.traceparent):
+            try:
+                message = await self.message_queue.resolve(message)
+                context = await self.load_system_prompt(message)
+                prompt = self.build_prompt(message)
+                route = self.router.route(self.config, message)
+                
+                if message.stream:
+                    response_text = await self.stream_to(message, prompt, context, route)
+                else:
+                    response_text = await self.invoke_llm(prompt, context, priority=message.priority,
+                                                          route=route)
+                
+                return await self.reply(message, response_text)
+                    
+            except Exception as e:
+                self.logger.error(f"Error processing message: {e}")
+                self.status = AgentStatus.ERROR
+                await self.reply_error(message, e)
+                
+            finally:
+                self.status = AgentStatus.IDLE
+                
+        return None
+        
+    def build_prompt(self, message: AgentMessage) -> str:
+        """User prompt for a message: its type, sender, payload and context"""
+        return f"""
             Message Type: {message.type}
             Priority: {message.priority}
             From: {message.from_agent}
@@ -221,63 +3190,147 @@ class Agent:
             Please process this message according to your role and respond appropriately.
             """
             
-            response_text = await self.invoke_llm(prompt, context)
-            
-            # Create response message if required
-            if message.requires_response:
-                response = AgentMessage(
+    async def reply(self, message: AgentMessage, response_text: str) -> Optional[AgentMessage]:
+        """Send the RESPONSE for ``message`` if its sender asked for one"""
+        if not message.requires_response:
+            return None
+        response = AgentMessage(
+            from_agent=self.config.name,
+            to_agent=message.from_agent,
+            type=MessageType.RESPONSE,
+            priority=message.priority,
+            payload={"response": response_text},
+            thread_id=message.thread_id or message.id,
+            in_reply_to=message.id,
+            requires_response=False
+        )
+        await self.message_queue.send(response)
+        return response
+        
+    async def reply_error(self, message: AgentMessage, error: Exception):
+        """Tell the sender of ``message`` that processing it failed"""
+        await self.message_queue.send(AgentMessage(
+            from_agent=self.config.name,
+            to_agent=message.from_agent,
+            type=MessageType.ERROR,
+            priority=Priority.HIGH,
+            payload={"error": str(error)},
+            thread_id=message.thread_id or message.id,
+            in_reply_to=message.id
+        ))
+        
+    async def stream_to(self, message: AgentMessage, prompt: str,
+                        context: Union[str, List[Dict[str, Any]]],
+                        route: Optional[ModelRoute] = None) -> str:
+        """Stream a reply, forwarding partial text to the sender as NOTIFICATIONs
+
+        Deltas are batched for STREAM_FLUSH_INTERVAL seconds so a long
+        completion does not become one queue message per token. Returns the
+        full text for the final RESPONSE.
+        """
+        loop = asyncio.get_running_loop()
+        parts: List[str] = []
+        pending: List[str] = []
+        last_flush = loop.time()
+        
+        async def flush():
+            nonlocal last_flush
+            if pending:
+                await self.message_queue.send(AgentMessage(
                     from_agent=self.config.name,
                     to_agent=message.from_agent,
-                    type=MessageType.RESPONSE,
+                    type=MessageType.NOTIFICATION,
                     priority=message.priority,
-                    payload={"response": response_text},
+                    payload={"partial": "".join(pending)},
                     thread_id=message.thread_id or message.id,
-                    requires_response=False
-                )
-                
-                await self.message_queue.send(response)
-                return response
-                
-        except Exception as e:
-            self.logger.error(f"Error processing message: {e}")
-            self.status = AgentStatus.ERROR
-            
-            # Send error message
-            error_msg = AgentMessage(
-                from_agent=self.config.name,
-                to_agent=message.from_agent,
-                type=MessageType.ERROR,
-                priority=Priority.HIGH,
-                payload={"error": str(e)},
-                thread_id=message.thread_id
-            )
-            await self.message_queue.send(error_msg)
-            
-        finally:
-            self.status = AgentStatus.IDLE
+                    in_reply_to=message.id,
+                    partial=True
+                ))
+                pending.clear()
+            last_flush = loop.time()
             
-        return None
+        async for text in self.stream_llm(prompt, context, priority=message.priority, route=route):
+            parts.append(text)
+            pending.append(text)
+            if loop.time() - last_flush >= self.stream_flush_interval:
+                await flush()
+        await flush()
+        return "".join(parts)
+        
+    async def collect_batch(self, first: AgentMessage) -> List[AgentMessage]:
+        """Gather batch messages arriving within BATCH_WINDOW of ``first``
+
+        Other messages received meanwhile are processed straight away.
+        """
+        messages = [first]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(messages) < self.batch_max_requests:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            message = await self.message_queue.receive(self.config.name, timeout=remaining)
+            if message is None:
+                break
+            if message.batch:
+                messages.append(message)
+            else:
+                await self.process_message(message)
+                await self.message_queue.ack(message)
+        return messages
         
+    async def process_batch(self, messages: List[AgentMessage]):
+        """Answer batch messages with one Message Batch, replying to each sender"""
+        self.logger.info(f"Processing {len(messages)} messages as one batch")
+        async with self.message_queue.leased(self.config.name, messages):
+            try:
+                resolved = [await self.message_queue.resolve(message) for message in messages]
+                requests = [(self.build_prompt(message), await self.load_system_prompt(message))
+                            for message in resolved]
+                routes = [self.router.route(self.config, message) for message in resolved]
+                results = await self.invoke_llm_batch(requests, routes)
+            except Exception as e:
+                self.logger.error(f"Batch failed: {e}")
+                results = [e] * len(messages)
+                
+            for message, result in zip(messages, results):
+                if isinstance(result, Exception):
+                    await self.reply_error(message, result)
+                else:
+                    await self.reply(message, result)
+                await self.message_queue.ack(message)
+            
     async def run(self):
         """Main agent loop"""
         self.logger.info(f"{self.config.emoji} {self.config.name} started")
+        await self.message_queue.subscribe(self.config.name)
         
-        while True:
-            try:
-                # Check for messages
-                message = await self.message_queue.receive(self.config.name)
-                if message:
-                    await self.process_message(message)
-                else:
-                    await asyncio.sleep(1)  # No messages, wait
-                    
-            except KeyboardInterrupt:
-                self.logger.info(f"{self.config.name} shutting down")
-                break
-            except Exception as e:
-                self.logger.error(f"Agent error: {e}")
-                self.status = AgentStatus.ERROR
-                await asyncio.sleep(5)  # Wait before retrying
+        try:
+            while True:
+                try:
+                    # Wait for messages; send() and broadcast() wake us as soon as one arrives
+                    message = await self.message_queue.receive(
+                        self.config.name, timeout=self.idle_timeout, topics=self.config.topics
+                    )
+                    if message and message.batch:
+                        # Batches can take hours; keep serving other messages meanwhile
+                        batch = asyncio.create_task(self.process_batch(await self.collect_batch(message)))
+                        self.batches.add(batch)
+                        batch.add_done_callback(self.batches.discard)
+                    elif message:
+                        await self.process_message(message)
+                        await self.message_queue.ack(message)
+                        
+                except KeyboardInterrupt:
+                    self.logger.info(f"{self.config.name} shutting down")
+                    break
+                except Exception as e:
+                    self.logger.error(f"Agent error: {e}")
+                    self.status = AgentStatus.ERROR
+                    await asyncio.sleep(5)  # Wait before retrying
+        finally:
+            for batch in list(self.batches):
+                batch.cancel()
 
 # ============================================================================
 # Specialized Agents
@@ -286,8 +3339,13 @@ class Agent:
 class TechLeadAgent(Agent):
     """TechLead agent with special user interaction capabilities"""
     
-    async def handle_user_command(self, command: str) -> str:
-        """Handle @TechLead commands from user"""
+    async def handle_user_command(self, command: str,
+                                  on_text: Optional[Callable[[str], None]] = None) -> str:
+        """Handle @TechLead commands from user
+
+        With ``on_text`` the reply is streamed and each text delta is passed
+        to it as it arrives.
+        """
         self.logger.info(f"Handling user command: {command}")
         
         # Parse @-mentions
@@ -311,10 +3369,301 @@ class TechLeadAgent(Agent):
                 await self.message_queue.send(message)
                 
         # Process with TechLead logic
-        context = await self.load_context()
-        response = await self.invoke_llm(command, context)
+        # The user is waiting at the prompt, so go ahead of agent work
+        context = await self.load_system_prompt()
+        if on_text is None:
+            return await self.invoke_llm(command, context, priority=Priority.CRITICAL)
+            
+        parts = []
+        async for text in self.stream_llm(command, context, priority=Priority.CRITICAL):
+            parts.append(text)
+            on_text(text)
+        return "".join(parts)
+
+# ============================================================================
+# Task Graph Execution
+# ============================================================================
+
+@dataclass
+class GraphTask:
+    """One node of MetaAgent's task graph"""
+    id: str
+    agent: str
+    dependencies: List[str]
+    spec: Dict[str, Any]
+    status: str = "pending"
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    
+    @property
+    def duration(self) -> float:
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+class TaskGraphExecutor:
+    """Run a task graph, launching every task as soon as its dependencies finish
+
+    At most ``max_parallel`` tasks run at once. A task whose agent is not
+    ``parallel_safe`` runs alone, and a task whose agent is ``blocked_by``
+    other agents waits until every graph task of those agents has finished.
+    Tasks downstream of a failure are skipped. Tasks that can never start,
+    such as agents blocked_by each other, fail with what they waited on.
+    """
+    
+    def __init__(self, orchestrator: "Orchestrator", max_parallel: Optional[int] = None):
+        self.orchestrator = orchestrator
+        self.max_parallel = max_parallel or int(os.getenv("MAX_PARALLEL_TASKS", "4"))
         
-        return response
+    @staticmethod
+    def load(path: Path) -> Dict[str, GraphTask]:
+        """Read task_graph.json, rejecting unknown dependencies and cycles"""
+        graph = json.loads(path.read_text())
+        tasks = {
+            spec["id"]: GraphTask(id=spec["id"], agent=spec["agent"],
+                                  dependencies=list(spec.get("dependencies", [])), spec=spec)
+            for spec in graph.get("tasks", [])
+        }
+        for task in tasks.values():
+            missing = [dep for dep in task.dependencies if dep not in tasks]
+            if missing:
+                raise ValueError(f"Task {task.id} depends on unknown tasks: {', '.join(missing)}")
+        TaskGraphExecutor.topological_order(tasks)
+        return tasks
+        
+    @staticmethod
+    def topological_order(tasks: Dict[str, GraphTask]) -> List[str]:
+        remaining = {task_id: set(task.dependencies) for task_id, task in tasks.items()}
+        order = []
+        while remaining:
+            ready = sorted(task_id for task_id, deps in remaining.items() if not deps)
+            if not ready:
+                raise ValueError(f"Task graph has a cycle among: {', '.join(sorted(remaining))}")
+            for task_id in ready:
+                order.append(task_id)
+                del remaining[task_id]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+        
+    def _config(self, agent_name: str) -> Optional[AgentConfig]:
+        return self.orchestrator.configs.get(agent_name)
+        
+    def _can_start(self, task: GraphTask, tasks: Dict[str, GraphTask],
+                   running: Dict[asyncio.Task, GraphTask]) -> bool:
+        if any(tasks[dep].status != "done" for dep in task.dependencies):
+            return False
+        config = self._config(task.agent)
+        blocked_by = set(config.blocked_by) if config else set()
+        if any(other.agent in blocked_by and other.status in ("pending", "running")
+               for other in tasks.values()):
+            return False
+        if not running:
+            return True
+        if len(running) >= self.max_parallel:
+            return False
+        if config and not config.parallel_safe:
+            return False
+        # Nothing else may join while an exclusive task runs
+        return all(self._config(other.agent) is None or self._config(other.agent).parallel_safe
+                   for other in running.values())
+        
+    def _skip_downstream(self, tasks: Dict[str, GraphTask]):
+        changed = True
+        while changed:
+            changed = False
+            for task in tasks.values():
+                if task.status == "pending" and any(
+                        tasks[dep].status in ("failed", "skipped") for dep in task.dependencies):
+                    task.status = "skipped"
+                    changed = True
+                    
+    async def _run_task(self, task: GraphTask):
+        task.status = "running"
+        task.started_at = time.monotonic()
+        try:
+            result = await self.orchestrator.run_agent_task(task.agent, {
+                "action": "execute_task",
+                "task": task.spec
+            })
+            if result is None:
+                raise AgentTaskError(task.agent, "agent not available")
+            task.result = result
+            task.status = "done"
+        except Exception as e:
+            task.error = str(e)
+            task.status = "failed"
+            logger.error(f"Task {task.id} ({task.agent}) failed: {e}")
+        finally:
+            task.finished_at = time.monotonic()
+            
+    async def run(self, tasks: Dict[str, GraphTask]) -> Dict[str, GraphTask]:
+        """Execute the graph; returns the tasks with status and timings filled in"""
+        order = self.topological_order(tasks)
+        running: Dict[asyncio.Task, GraphTask] = {}
+        
+        while True:
+            self._skip_downstream(tasks)
+            for task_id in order:
+                task = tasks[task_id]
+                if task.status == "pending" and self._can_start(task, tasks, running):
+                    logger.info(f"Starting task {task.id} on {task.agent}")
+                    running[asyncio.create_task(self._run_task(task))] = task
+                    
+            if not running:
+                break
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                running.pop(finished)
+                
+        # Tasks whose dependencies are done but that could never start
+        stuck = [task for task in tasks.values() if task.status == "pending"
+                 and all(tasks[dep].status == "done" for dep in task.dependencies)]
+        for task in stuck:
+            task.error = f"never started, waiting on {self._waiting_on(task, tasks)}"
+        for task in stuck:
+            task.status = "failed"
+            logger.warning(f"Task {task.id} ({task.agent}) {task.error}")
+        self._skip_downstream(tasks)
+        return tasks
+        
+    def _waiting_on(self, task: GraphTask, tasks: Dict[str, GraphTask]) -> str:
+        """Pending tasks of the agents a stuck task is blocked_by"""
+        config = self._config(task.agent)
+        blocked_by = set(config.blocked_by) if config else set()
+        waiting = [f"{other.id} ({other.agent})" for other in tasks.values()
+                   if other is not task and other.agent in blocked_by and other.status == "pending"]
+        return ", ".join(waiting) or "an agent that never became free"
+        
+    @staticmethod
+    def critical_path(tasks: Dict[str, GraphTask]) -> List[GraphTask]:
+        """Longest chain of dependent tasks by measured duration"""
+        finish: Dict[str, float] = {}
+        previous: Dict[str, Optional[str]] = {}
+        for task_id in TaskGraphExecutor.topological_order(tasks):
+            task = tasks[task_id]
+            best = max(task.dependencies, key=lambda dep: finish[dep], default=None)
+            finish[task_id] = (finish[best] if best else 0.0) + task.duration
+            previous[task_id] = best
+            
+        path = []
+        current = max(finish, key=finish.get, default=None)
+        while current:
+            path.append(tasks[current])
+            current = previous[current]
+        return list(reversed(path))
+        
+    @staticmethod
+    def report(tasks: Dict[str, GraphTask]) -> Table:
+        """Critical path table for the console"""
+        path = TaskGraphExecutor.critical_path(tasks)
+        table = Table(title="Task graph critical path")
+        table.add_column("Task")
+        table.add_column("Agent")
+        table.add_column("Status")
+        table.add_column("Duration", justify="right")
+        for task in path:
+            table.add_row(task.id, task.agent, task.status, f"{task.duration:.1f}s")
+        table.add_row("", "", "total", f"{sum(task.duration for task in path):.1f}s")
+        return table
+
+# ============================================================================
+# Workflow Checkpoints
+# ============================================================================
+
+@dataclass
+class PhaseCheckpoint:
+    """A workflow phase being run, or replayed from the journal"""
+    name: str
+    input_hash: str
+    skipped: bool = False
+    outputs: Any = None
+    message_ids: List[str] = field(default_factory=list)
+    # Agents the phase needed that are not configured
+    missing_agents: List[str] = field(default_factory=list)
+    # Cleared by a phase that finished without doing its work
+    keep: bool = True
+
+# The phase being run, which records the requests sent and agents missing
+_current_phase: ContextVar[Optional[PhaseCheckpoint]] = ContextVar("current_phase", default=None)
+
+class WorkflowJournal:
+    """Append-only JSON-lines record of workflow phases
+
+    A phase's key hashes its inputs together with the key and outputs of
+    the phase before it, so a phase counts as done only while everything
+    upstream of it is unchanged too. A phase that needed an agent missing
+    from the configs is journaled as skipped, not done, and runs again on
+    resume. Entries are fsynced as they are written; a torn last line from
+    a crash is ignored.
+    """
+    
+    def __init__(self, path: Path = Path("workspace/checkpoints/workflow.jsonl")):
+        self.path = path
+        self.run_id = uuid.uuid4().hex[:12]
+        self.previous = ""
+        self._done: Optional[Dict[Tuple[str, str], Dict[str, Any]]] = None
+        
+    @staticmethod
+    def digest(value: Any) -> str:
+        return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+        
+    def completed(self, phase: str, input_hash: str) -> Optional[Dict[str, Any]]:
+        """The latest done entry for ``phase`` with these inputs, from any run"""
+        if self._done is None:
+            self._done = {}
+            lines = self.path.read_text().splitlines() if self.path.exists() else []
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("status") == "done":
+                    self._done[(entry["phase"], entry["input_hash"])] = entry
+        return self._done.get((phase, input_hash))
+        
+    def append(self, entry: Dict[str, Any]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"run_id": self.run_id, "at": datetime.utcnow().isoformat(), **entry},
+                               default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self._done is not None and entry.get("status") == "done":
+            self._done[(entry["phase"], entry["input_hash"])] = entry
+            
+    @contextmanager
+    def phase(self, name: str, inputs: Any, resume: bool = False) -> Iterator[PhaseCheckpoint]:
+        """Checkpoint the enclosed phase; with ``resume``, skip it if already done"""
+        checkpoint = PhaseCheckpoint(name=name, input_hash=self.digest([self.previous, inputs]))
+        entry = self.completed(name, checkpoint.input_hash) if resume else None
+        if entry is not None:
+            checkpoint.skipped = True
+            checkpoint.outputs = entry.get("outputs")
+            logger.info(f"Resuming past phase {name} (checkpoint from run {entry['run_id']})")
+            yield checkpoint
+        else:
+            self.append({"phase": name, "status": "started", "input_hash": checkpoint.input_hash})
+            token = _current_phase.set(checkpoint)
+            try:
+                yield checkpoint
+            except BaseException as e:
+                self.append({"phase": name, "status": "failed", "input_hash": checkpoint.input_hash,
+                             "message_ids": checkpoint.message_ids, "error": str(e) or type(e).__name__})
+                raise
+            finally:
+                _current_phase.reset(token)
+            if checkpoint.missing_agents:
+                logger.warning(f"Phase {name} skipped, agents not configured: "
+                               f"{', '.join(checkpoint.missing_agents)}")
+                self.append({"phase": name, "status": "skipped", "input_hash": checkpoint.input_hash,
+                             "missing_agents": checkpoint.missing_agents})
+            elif checkpoint.keep:
+                self.append({"phase": name, "status": "done", "input_hash": checkpoint.input_hash,
+                             "outputs": checkpoint.outputs, "message_ids": checkpoint.message_ids})
+        self.previous = self.digest([checkpoint.input_hash, checkpoint.outputs])
 
 # ============================================================================
 # Orchestrator
@@ -323,12 +3672,36 @@ class TechLeadAgent(Agent):
 class Orchestrator:
     """Main orchestrator for managing all agents"""
     
-    def __init__(self):
+    name = "Orchestrator"
+    
+    def __init__(self, message_queue: Optional[MessageQueue] = None):
         self.agents: Dict[str, Agent] = {}
+        # Every replica of an agent, the one in self.agents first
+        self.pools: Dict[str, List[Agent]] = {}
         self.configs: Dict[str, AgentConfig] = {}
-        self.client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-        self.message_queue = MessageQueue()
+        # Retries are left to Agent.invoke_llm so the shared RateLimiter sees them
+        self.client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), max_retries=0)
+        self.message_queue = message_queue or MessageQueue()
+        self.context_cache = ContextCache()
+        self.rate_limiter = RateLimiter()
+        self.router = ModelRouter()
         self.parallel_execution = os.getenv("PARALLEL_EXECUTION", "true").lower() == "true"
+        self.task_timeout = float(os.getenv("AGENT_TASK_TIMEOUT", "900"))
+        self.batch_mode = os.getenv("LLM_BATCH_MODE", "false").lower() == "true"
+        # Message Batches may take up to 24h to finish
+        self.batch_timeout = float(os.getenv("BATCH_TASK_TIMEOUT", "86400"))
+        # Skip phases the checkpoint journal shows as done with the same inputs
+        self.resume = os.getenv("WORKFLOW_RESUME", "false").lower() == "true"
+        self.journal = WorkflowJournal()
+        # Run each agent in its own process instead of on this event loop
+        self.supervised = os.getenv("AGENT_SUPERVISOR", "false").lower() == "true"
+        self.supervisor: Optional["AgentSupervisor"] = None
+        
+        # Requests awaiting a RESPONSE/ERROR, keyed by request message id
+        self.pending: Dict[str, asyncio.Future] = {}
+        # Callbacks for partial text of streamed requests, same keys
+        self.partial_handlers: Dict[str, Callable[[str], None]] = {}
+        self._running: List[asyncio.Task] = []
         
     def load_agent_configs(self):
         """Load agent configurations from YAML files"""
@@ -356,23 +3729,92 @@ class Orchestrator:
                 files_allowed=config_data.get("files_allowed", []),
                 can_invoke=config_data.get("can_invoke", []),
                 blocked_by=config_data.get("blocked_by", []),
-                parallel_safe=config_data.get("parallel_safe", True)
+                parallel_safe=config_data.get("parallel_safe", True),
+                max_tokens=config_data.get("max_tokens", 4000),
+                temperature=config_data.get("temperature", 0.3),
+                replicas=max(1, int(config_data.get("replicas", 1))),
+                topics=config_data.get("topics", ["*"])
             )
             
             self.configs[config.name] = config
             logger.info(f"Loaded config for {config.name}")
             
     def create_agents(self):
-        """Create agent instances"""
+        """Create agent instances, ``replicas`` of each sharing its inbox"""
         for name, config in self.configs.items():
-            if "TechLead" in name:
-                agent = TechLeadAgent(config, self.client)
-            else:
-                agent = Agent(config, self.client)
+            agent_class = TechLeadAgent if "TechLead" in name else Agent
+            pool = []
+            for replica in range(config.replicas):
+                agent = agent_class(config, self.client, self.message_queue, self.context_cache,
+                                    self.rate_limiter, self.router)
+                agent.replica = replica
+                pool.append(agent)
                 
-            self.agents[name] = agent
-            logger.info(f"Created agent: {config.emoji} {name}")
+            self.agents[name] = pool[0]
+            self.pools[name] = pool
+            logger.info(f"Created agent: {config.emoji} {name}"
+                        + (f" x{config.replicas}" if config.replicas > 1 else ""))
+            
+    def pool(self, name: str) -> List[Agent]:
+        """Every replica of an agent"""
+        return self.pools.get(name) or [self.agents[name]]
+            
+    def start_agents(self):
+        """Start every agent loop, the reply router, the compactor and the queue depth gauges
+
+        In supervised mode the agent loops run in AgentSupervisor processes
+        and only the reply loop and the supervisor's monitor run here.
+        """
+        if self._running:
+            return
+        self._running.append(asyncio.create_task(self.dispatch_responses()))
+        self._running.append(asyncio.create_task(self.message_queue.run_compactor()))
+        self._running.append(asyncio.create_task(
+            self.message_queue.run_depth_metrics([self.name, *self.agents])))
+        if self.supervised:
+            if self.supervisor is None:
+                self.supervisor = AgentSupervisor([agent.config for agent in self.agents.values()],
+                                                  self.message_queue)
+            self._running.append(asyncio.create_task(self.supervisor.monitor()))
+            return
+        for name in self.agents:
+            for agent in self.pool(name):
+                self._running.append(asyncio.create_task(agent.run()))
+            
+    async def stop_agents(self):
+        """Cancel the agent loops started by start_agents"""
+        for task in self._running:
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+        self._running.clear()
+        if self.supervisor is not None:
+            await self.supervisor.stop()
+            self.supervisor = None
+        
+    async def dispatch_responses(self):
+        """Resolve pending run_agent_task calls as their replies arrive"""
+        while True:
+            message = await self.message_queue.receive(self.name, timeout=self.task_timeout)
+            if not message:
+                continue
+            await self.message_queue.ack(message)
             
+            request_id = message.in_reply_to or message.thread_id
+            if message.partial:
+                handler = self.partial_handlers.get(request_id)
+                if handler is not None:
+                    handler(self.message_queue.blobs.resolve(message.payload["partial"]))
+                continue
+                
+            future = self.pending.get(request_id)
+            if future is None or future.done():
+                logger.debug(f"No pending task for {message.type.value} message {message.id}")
+                continue
+            if message.type == MessageType.ERROR:
+                future.set_exception(AgentTaskError(message.from_agent, message.payload.get("error", "")))
+            elif message.type == MessageType.RESPONSE:
+                future.set_result(message)
+                
     async def execute_workflow(self, problem_file: Path = Path("inputs/problem.md")):
         """Execute the main workflow"""
         console.print("[bold green]Starting Zero-Error Autonomous Workflow[/bold green]")
@@ -380,6 +3822,33 @@ class Orchestrator:
         # Read problem statement
         problem = problem_file.read_text() if problem_file.exists() else ""
         
+        self.start_agents()
+        try:
+            with telemetry.span("workflow.execute", {"workflow.problem_file": str(problem_file)}):
+                await self.run_phases(problem)
+        finally:
+            await self.stop_agents()
+            await asyncio.get_running_loop().run_in_executor(None, telemetry.flush)
+            
+        console.print(self.usage_report())
+        if self.router.routed_calls:
+            console.print(self.router.summary())
+        console.print("[bold green]✅ Workflow completed![/bold green]")
+        
+    @contextmanager
+    def phase(self, name: str, inputs: Any) -> Iterator[PhaseCheckpoint]:
+        """Trace and checkpoint one workflow phase
+
+        With ``resume`` set, a phase the journal shows as done with the
+        same inputs comes back ``skipped`` with its recorded outputs.
+        """
+        with telemetry.span("workflow.phase", {"workflow.phase": name}) as span:
+            with self.journal.phase(name, inputs, self.resume) as checkpoint:
+                span.set_attributes({"workflow.resumed": checkpoint.skipped})
+                yield checkpoint
+                
+    async def run_phases(self, problem: str):
+        """Run the workflow phases in order"""
         with Progress(
             SpinnerColumn(),
             TextColumn("[progress.description]{task.description}"),
@@ -388,115 +3857,246 @@ class Orchestrator:
             
             # Phase -1: MetaAgent Orchestration (if available)
             meta_agent_yaml = Path("agents/meta_agent.yaml")
-            if meta_agent_yaml.exists():
-                task = progress.add_task("🔵 MetaAgent: Creating task graph and context map...", total=1)
-                try:
-                    # MetaAgent creates the execution plan
-                    await self.run_agent_task("MetaAgent", {
-                        "action": "orchestrate",
-                        "problem": problem,
-                        "mode": "autonomous",
-                        "outputs": [
-                            "workspace/outputs/task_graph.json",
-                            "workspace/outputs/context_map.json"
-                        ]
-                    })
-                    progress.update(task, completed=1)
-                    logger.info("MetaAgent orchestration complete")
-                except Exception as e:
-                    logger.warning(f"MetaAgent orchestration skipped: {e}")
-                    progress.update(task, completed=1)
+            with self.phase("orchestration", {"problem": problem,
+                                              "meta_agent": meta_agent_yaml.exists()}) as phase:
+                if meta_agent_yaml.exists() and not phase.skipped:
+                    task = progress.add_task("🔵 MetaAgent: Creating task graph and context map...", total=1)
+                    try:
+                        # MetaAgent creates the execution plan
+                        phase.outputs = await self.run_agent_task("MetaAgent", {
+                            "action": "orchestrate",
+                            "problem": problem,
+                            "mode": "autonomous",
+                            "outputs": [
+                                "workspace/outputs/task_graph.json",
+                                "workspace/outputs/context_map.json"
+                            ]
+                        })
+                        progress.update(task, completed=1)
+                        logger.info("MetaAgent orchestration complete")
+                    except Exception as e:
+                        logger.warning(f"MetaAgent orchestration skipped: {e}")
+                        phase.keep = False
+                        progress.update(task, completed=1)
             
             # Phase 0: Research
-            task = progress.add_task("🟣 Researcher: Investigating problem space...", total=1)
-            await self.run_agent_task("Researcher", {
-                "action": "research",
-                "problem": problem
-            })
-            progress.update(task, completed=1)
+            with self.phase("research", {"problem": problem}) as phase:
+                if not phase.skipped:
+                    task = progress.add_task("🟣 Researcher: Investigating problem space...", total=1)
+                    phase.outputs = await self.run_agent_task("Researcher", {
+                        "action": "research",
+                        "problem": problem
+                    })
+                    progress.update(task, completed=1)
             
             # Phase 1: Specification
-            task = progress.add_task("🔵 TechLead: Creating specification...", total=1)
-            await self.run_agent_task("TechLead", {
-                "action": "create_spec",
-                "research": self.read_workspace_file("research/summary.md"),
-                "problem": problem
-            })
-            progress.update(task, completed=1)
+            research = self.read_workspace_file("research/summary.md")
+            with self.phase("specification", {"problem": problem, "research": research}) as phase:
+                if not phase.skipped:
+                    task = progress.add_task("🔵 TechLead: Creating specification...", total=1)
+                    phase.outputs = await self.run_agent_task("TechLead", {
+                        "action": "create_spec",
+                        "research": research,
+                        "problem": problem
+                    })
+                    progress.update(task, completed=1)
             
             # Phase 2: Parallel Planning
-            if self.parallel_execution:
-                tasks = []
-                
-                task_po = progress.add_task("🟠 ProductOwner: Creating backlog...", total=1)
-                tasks.append(self.run_agent_task("ProductOwner", {
-                    "action": "create_backlog",
-                    "spec": self.read_workspace_file("../specs/PRIMARY_SPEC.md")
-                }))
-                
-                task_arch = progress.add_task("🟢 Architect: Designing system...", total=1)
-                tasks.append(self.run_agent_task("Architect", {
-                    "action": "design",
-                    "spec": self.read_workspace_file("../specs/PRIMARY_SPEC.md")
-                }))
-                
-                await asyncio.gather(*tasks)
-                progress.update(task_po, completed=1)
-                progress.update(task_arch, completed=1)
+            spec = self.read_workspace_file("../specs/PRIMARY_SPEC.md")
+            with self.phase("planning", {"spec": spec, "parallel": self.parallel_execution}) as phase:
+                if self.parallel_execution and not phase.skipped:
+                    tasks = []
+                    
+                    task_po = progress.add_task("🟠 ProductOwner: Creating backlog...", total=1)
+                    tasks.append(self.run_agent_task("ProductOwner", {
+                        "action": "create_backlog",
+                        "spec": spec
+                    }))
+                    
+                    task_arch = progress.add_task("🟢 Architect: Designing system...", total=1)
+                    tasks.append(self.run_agent_task("Architect", {
+                        "action": "design",
+                        "spec": spec
+                    }))
+                    
+                    phase.outputs = await asyncio.gather(*tasks)
+                    progress.update(task_po, completed=1)
+                    progress.update(task_arch, completed=1)
                 
-            # Phase 3: Implementation (if needed)
-            # This would be expanded based on architecture results
+            # Phase 3: Implementation from MetaAgent's task graph
+            task_graph = Path("workspace/outputs/task_graph.json")
+            graph_text = task_graph.read_text() if task_graph.exists() else ""
+            with self.phase("implementation", {"task_graph": graph_text}) as phase:
+                if graph_text and not phase.skipped:
+                    task = progress.add_task("🧩 Implementation: Running task graph...", total=1)
+                    graph_tasks = await TaskGraphExecutor(self).run(TaskGraphExecutor.load(task_graph))
+                    phase.outputs = {task_id: graph_task.status for task_id, graph_task in graph_tasks.items()}
+                    # Failed tasks are retried on resume
+                    phase.keep = all(status == "done" for status in phase.outputs.values())
+                    progress.update(task, completed=1)
+                    console.print(TaskGraphExecutor.report(graph_tasks))
             
+            # Phase 4a: Bulk test case generation, one batched request per story
+            stories = self.split_user_stories(self.read_workspace_file("outputs/user_stories.md"))
+            with self.phase("test_generation", {"stories": stories, "batch": self.batch_mode}) as phase:
+                if self.batch_mode and stories and "QA" in self.agents and not phase.skipped:
+                    task = progress.add_task(f"🟤 QA: Generating test cases for {len(stories)} stories (batch)...",
+                                             total=1)
+                    results = await self.run_agent_batch("QA", [
+                        {"action": "generate_test_cases", "story": story} for story in stories
+                    ])
+                    failed = sum(1 for result in results if isinstance(result, Exception))
+                    if failed:
+                        logger.warning(f"Test case generation failed for {failed} of {len(stories)} stories")
+                    phase.outputs = [str(result) if isinstance(result, Exception) else result
+                                     for result in results]
+                    phase.keep = not failed
+                    progress.update(task, completed=1)
+                
             # Phase 4: Testing
-            task = progress.add_task("🟤 QA: Running Playwright tests...", total=1)
-            test_result = await self.run_agent_task("QA", {
-                "action": "test",
-                "test_plan": "e2e"
-            })
-            progress.update(task, completed=1)
+            with self.phase("testing", {"test_plan": "e2e"}) as phase:
+                if not phase.skipped:
+                    task = progress.add_task("🟤 QA: Running Playwright tests...", total=1)
+                    phase.outputs = await self.run_agent_task("QA", {
+                        "action": "test",
+                        "test_plan": "e2e"
+                    })
+                    progress.update(task, completed=1)
             
             # Phase 5: Self-Healing (if tests fail)
-            if not self.check_tests_passing():
-                task = progress.add_task("⚫ SelfHealing: Fixing failures...", total=5)
-                for attempt in range(5):
-                    await self.run_agent_task("SelfHealing", {
-                        "action": "fix",
-                        "test_results": self.read_workspace_file("reports/last_test_result.json")
-                    })
-                    progress.update(task, advance=1)
-                    
-                    if self.check_tests_passing():
-                        break
+            test_results = self.read_workspace_file("reports/last_test_result.json")
+            with self.phase("self_healing", {"test_results": test_results}) as phase:
+                if not phase.skipped and not self.check_tests_passing():
+                    task = progress.add_task("⚫ SelfHealing: Fixing failures...", total=5)
+                    phase.outputs = []
+                    for attempt in range(5):
+                        phase.outputs.append(await self.run_agent_task("SelfHealing", {
+                            "action": "fix",
+                            "test_results": self.read_workspace_file("reports/last_test_result.json")
+                        }))
+                        progress.update(task, advance=1)
+                        
+                        if self.check_tests_passing():
+                            break
                         
             # Phase 6: Delivery
-            task = progress.add_task("🟩 DeliveryLead: Finalizing delivery...", total=1)
-            await self.run_agent_task("DeliveryLead", {
-                "action": "finalize",
-                "test_results": self.read_workspace_file("reports/last_test_result.json")
-            })
-            progress.update(task, completed=1)
+            test_results = self.read_workspace_file("reports/last_test_result.json")
+            with self.phase("delivery", {"test_results": test_results}) as phase:
+                if not phase.skipped:
+                    task = progress.add_task("🟩 DeliveryLead: Finalizing delivery...", total=1)
+                    phase.outputs = await self.run_agent_task("DeliveryLead", {
+                        "action": "finalize",
+                        "test_results": test_results
+                    })
+                    progress.update(task, completed=1)
             
-        console.print("[bold green]✅ Workflow completed![/bold green]")
+
+    async def profile_workflow(self, problem_file: Path, output_dir: Path):
+        """Run the workflow and write its timeline and critical path
+
+        ``trace.json`` is Chrome trace-event JSON covering every phase,
+        agent task, queue wait, context build and LLM call;
+        ``critical_path.txt`` is the summary printed at the end.
+        """
+        spans: List[Span] = []
+        telemetry.listeners.append(spans.append)
+        try:
+            await self.execute_workflow(problem_file)
+        finally:
+            telemetry.listeners.remove(spans.append)
+            output_dir.mkdir(parents=True, exist_ok=True)
+            (output_dir / "trace.json").write_text(json.dumps(chrome_trace(spans)))
+            summary = profile_summary(spans)
+            (output_dir / "critical_path.txt").write_text(summary + "\n")
+            console.print(summary, markup=False, highlight=False)
+            console.print(f"[bold]Trace written to {output_dir / 'trace.json'}[/bold]")
+            
+    def usage_report(self) -> Table:
+        """Per-agent token usage, including prompt cache reads and writes"""
+        table = Table(title="Token usage")
+        table.add_column("Agent")
+        for column in ("Calls", "Input", "Output", "Cache read", "Cache write", "Hit rate",
+                       "Replayed"):
+            table.add_column(column, justify="right")
+        for name in self.agents:
+            usage: Counter = Counter()
+            for agent in self.pool(name):
+                usage.update(agent.usage)
+            if not usage["calls"] and not usage["response_cache_hits"]:
+                continue
+            table.add_row(
+                name, str(usage["calls"]), str(usage["input_tokens"]), str(usage["output_tokens"]),
+                str(usage["cache_read_input_tokens"]), str(usage["cache_creation_input_tokens"]),
+                f"{usage['cache_hits'] / usage['calls']:.0%}" if usage["calls"] else "-",
+                str(usage["response_cache_hits"])
+            )
+        return table
+        
+    @staticmethod
+    def split_user_stories(text: str) -> List[str]:
+        """Individual "### Story" sections of user_stories.md"""
+        return [section.strip() for section in re.split(r"(?m)^(?=### Story)", text)
+                if section.startswith("### Story")]
         
-    async def run_agent_task(self, agent_name: str, payload: Dict[str, Any]):
-        """Run a specific agent task"""
+    async def run_agent_batch(self, agent_name: str,
+                              payloads: List[Dict[str, Any]]) -> List[Union[Dict[str, Any], Exception]]:
+        """Run many tasks on one agent through the Message Batches API
+
+        The agent collects the requests into a single batch submission. Returns
+        the response payload for each task, or the exception it failed with.
+        Waits up to BATCH_TASK_TIMEOUT seconds.
+        """
+        return await asyncio.gather(*(
+            self.run_agent_task(agent_name, payload, timeout=self.batch_timeout, batch=True)
+            for payload in payloads
+        ), return_exceptions=True)
+        
+    async def run_agent_task(self, agent_name: str, payload: Dict[str, Any],
+                             timeout: Optional[float] = None,
+                             on_partial: Optional[Callable[[str], None]] = None,
+                             batch: bool = False) -> Optional[Dict[str, Any]]:
+        """Run a specific agent task and return the payload of its response
+
+        Raises AgentTaskError if the agent replies with an ERROR and
+        asyncio.TimeoutError if no reply arrives within ``timeout`` seconds
+        (AGENT_TASK_TIMEOUT by default). With ``on_partial`` the agent
+        streams its reply and each partial chunk is passed to it as it lands.
+        """
+        phase = _current_phase.get()
         if agent_name not in self.agents:
             logger.error(f"Agent {agent_name} not found")
-            return
+            if phase is not None and agent_name not in phase.missing_agents:
+                phase.missing_agents.append(agent_name)
+            return None
             
         message = AgentMessage(
-            from_agent="Orchestrator",
+            from_agent=self.name,
             to_agent=agent_name,
             type=MessageType.REQUEST,
             priority=Priority.HIGH,
             payload=payload,
-            requires_response=True
+            requires_response=True,
+            stream=on_partial is not None,
+            batch=batch
         )
         
-        await self.message_queue.send(message)
-        
-        # Wait for response (simplified - in production would use proper async waiting)
-        await asyncio.sleep(2)
+        if phase is not None:
+            phase.message_ids.append(message.id)
+            
+        # Register before sending so a fast reply cannot be missed
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message.id] = future
+        if on_partial is not None:
+            self.partial_handlers[message.id] = on_partial
+        try:
+            with telemetry.span("agent.task", {"agent": agent_name, "messaging.message.id": message.id}):
+                await self.message_queue.send(message)
+                response = await asyncio.wait_for(future, timeout or self.task_timeout)
+        finally:
+            self.pending.pop(message.id, None)
+            self.partial_handlers.pop(message.id, None)
+            
+        return (await self.message_queue.resolve(response)).payload
         
     def read_workspace_file(self, path: str) -> str:
         """Read a file from workspace"""
@@ -532,8 +4132,10 @@ class Orchestrator:
                     break
                     
                 if command.startswith("@"):
-                    response = await techlead.handle_user_command(command)
-                    console.print(f"[green]TechLead>[/green] {response}")
+                    # Render the reply as it streams in
+                    reply = Text.assemble(("TechLead> ", "green"))
+                    with Live(reply, console=console, refresh_per_second=12):
+                        await techlead.handle_user_command(command, on_text=reply.append)
                 else:
                     console.print("[yellow]Use @TechLead to interact with the system[/yellow]")
                     
@@ -542,36 +4144,420 @@ class Orchestrator:
                 
         console.print("[bold]Goodbye![/bold]")
 
+# ============================================================================
+# Agent Supervisor
+# ============================================================================
+
+@dataclass
+class AgentWorker:
+    """One supervised agent process and its restart bookkeeping"""
+    name: str
+    config: AgentConfig
+    heartbeat: Any
+    process: Optional[multiprocessing.process.BaseProcess] = None
+    started_at: float = 0.0
+    restarts: int = 0
+    restart_at: Optional[float] = None
+
+class AgentSupervisor:
+    """Run each agent replica in its own process, talking to the others over the MessageQueue
+
+    Every process stamps a shared heartbeat from its event loop every
+    ``heartbeat_interval`` seconds. A process that exits, or whose heartbeat
+    is older than ``heartbeat_timeout`` (a wedged loop), is killed and
+    restarted; until its first beat a new process instead gets
+    ``startup_timeout`` seconds to import and build its agent. It is restarted after an exponential backoff; messages it had claimed but not
+    acknowledged are requeued first, leaving other replicas' claims alone. A worker that stays up for
+    ``backoff_max`` seconds starts over at the shortest backoff.
+    """
+    
+    def __init__(self, configs: List[AgentConfig], message_queue: MessageQueue,
+                 target: Optional[Callable[..., None]] = None,
+                 heartbeat_interval: Optional[float] = None, heartbeat_timeout: Optional[float] = None,
+                 backoff_base: Optional[float] = None, backoff_max: Optional[float] = None,
+                 startup_timeout: Optional[float] = None):
+        self.message_queue = message_queue
+        self.target = target or run_agent_process
+        self.heartbeat_interval = heartbeat_interval or float(os.getenv("AGENT_HEARTBEAT_INTERVAL", "5"))
+        self.heartbeat_timeout = heartbeat_timeout or float(os.getenv("AGENT_HEARTBEAT_TIMEOUT", "30"))
+        self.startup_timeout = startup_timeout or float(os.getenv("AGENT_STARTUP_TIMEOUT", "120"))
+        self.backoff_base = backoff_base or float(os.getenv("AGENT_RESTART_BACKOFF", "1"))
+        self.backoff_max = backoff_max or float(os.getenv("AGENT_RESTART_BACKOFF_MAX", "60"))
+        # spawn rather than fork: the parent has watchdog and executor threads
+        self.context = multiprocessing.get_context("spawn")
+        self.workers: Dict[str, AgentWorker] = {}
+        for config in configs:
+            for replica in range(config.replicas):
+                name = config.name if config.replicas == 1 else f"{config.name}#{replica}"
+                self.workers[name] = AgentWorker(name=name, config=config,
+                                                 heartbeat=self.context.Value("d", 0.0, lock=False))
+        
+    def spawn(self, worker: AgentWorker):
+        worker.heartbeat.value = 0.0
+        worker.process = self.context.Process(
+            target=self.target,
+            args=(worker.config, self.message_queue.base_path, worker.heartbeat,
+                  self.heartbeat_interval, 1 / len(self.workers)),
+            name=f"agent-{worker.name}",
+            daemon=True
+        )
+        worker.process.start()
+        worker.started_at = time.time()
+        worker.restart_at = None
+        logger.info(f"Started {worker.name} in process {worker.process.pid}")
+        
+    async def start(self):
+        # Anything still in flight was left by a previous run
+        for agent_name in {worker.config.name for worker in self.workers.values()}:
+            await self.message_queue.requeue(agent_name)
+        for worker in self.workers.values():
+            self.spawn(worker)
+            
+    async def check(self):
+        """Restart workers that have exited or stopped heartbeating"""
+        now = time.time()
+        for name, worker in self.workers.items():
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self.spawn(worker)
+                continue
+                
+            process = worker.process
+            # The heartbeat clock only starts once the process has beaten
+            if worker.heartbeat.value:
+                last_beat, timeout = worker.heartbeat.value, self.heartbeat_timeout
+            else:
+                last_beat, timeout = worker.started_at, self.startup_timeout
+            if process.is_alive() and now - last_beat <= timeout:
+                if worker.restarts and now - worker.started_at >= self.backoff_max:
+                    worker.restarts = 0
+                continue
+                
+            if process.is_alive():
+                what = "missed heartbeats" if worker.heartbeat.value else "did not start"
+                logger.warning(f"{name} {what} for {now - last_beat:.1f}s, killing it")
+                process.kill()
+            await asyncio.get_running_loop().run_in_executor(None, process.join, 5)
+            requeued = await self.message_queue.requeue(worker.config.name, queue_consumer_id(process.pid))
+            delay = min(self.backoff_max, self.backoff_base * 2 ** worker.restarts)
+            worker.restarts += 1
+            worker.restart_at = now + delay
+            logger.error(f"{name} exited with code {process.exitcode}; requeued {requeued} "
+                         f"message(s), restarting in {delay:.1f}s")
+            
+    async def monitor(self):
+        """Start the workers and keep them healthy until cancelled"""
+        await self.start()
+        while True:
+            await asyncio.sleep(min(self.heartbeat_interval, self.backoff_base))
+            await self.check()
+            
+    async def stop(self, timeout: float = 10):
+        """SIGTERM every worker, killing those that do not exit within ``timeout``"""
+        processes = [worker.process for worker in self.workers.values()
+                     if worker.process is not None and worker.process.is_alive()]
+        for process in processes:
+            process.terminate()
+        loop = asyncio.get_running_loop()
+        for process in processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.kill()
+                
+    def status(self) -> Table:
+        table = Table(title="Agent processes")
+        for column in ("Agent", "PID", "State", "Restarts", "Heartbeat age"):
+            table.add_column(column)
+        now = time.time()
+        for name, worker in self.workers.items():
+            process = worker.process
+            alive = process is not None and process.is_alive()
+            table.add_row(name, str(process.pid if process else "-"),
+                          "running" if alive else "restarting" if worker.restart_at else "stopped",
+                          str(worker.restarts),
+                          f"{now - worker.heartbeat.value:.1f}s" if worker.heartbeat.value else "-")
+        return table
+
+async def serve_agent(agent: Agent, heartbeat: Any, interval: float):
+    """Run ``agent`` until SIGTERM, stamping ``heartbeat`` from its event loop"""
+    loop = asyncio.get_running_loop()
+    task = asyncio.create_task(agent.run())
+    try:
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    except NotImplementedError:
+        pass
+        
+    async def beat():
+        while True:
+            heartbeat.value = time.time()
+            await asyncio.sleep(interval)
+            
+    beating = asyncio.create_task(beat())
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        beating.cancel()
+        agent.message_queue.close()
+        await agent.message_queue.backend.close()
+        agent.context_cache.close()
+        telemetry.flush()
+
+def run_agent_process(config: AgentConfig, queue_path: Path, heartbeat: Any,
+                      heartbeat_interval: float, rate_share: float = 1.0):
+    """Entry point of a supervised agent process"""
+    configure_logging()
+    orchestrator = Orchestrator(message_queue=MessageQueue(queue_path))
+    # The processes split the API limits between them
+    orchestrator.rate_limiter = RateLimiter(share=rate_share)
+    orchestrator.configs = {config.name: config}
+    orchestrator.create_agents()
+    asyncio.run(serve_agent(orchestrator.agents[config.name], heartbeat, heartbeat_interval))
+
+# ============================================================================
+# Workflow Profiler
+# ============================================================================
+
+class StubBatches:
+    """Message Batches API of a StubLLMClient; a batch takes as long as its slowest request"""
+    
+    def __init__(self, client: "StubLLMClient"):
+        self.client = client
+        self._results: Dict[str, List[Any]] = {}
+        
+    async def create(self, requests: List[Dict[str, Any]]) -> Any:
+        replies = [(request["custom_id"], *self.client.reply(request["params"])) for request in requests]
+        await asyncio.sleep(max((latency for _, _, latency in replies), default=0))
+        batch_id = f"msgbatch_stub_{uuid.uuid4().hex[:12]}"
+        self._results[batch_id] = [
+            SimpleNamespace(custom_id=custom_id, result=SimpleNamespace(type="succeeded", message=message))
+            for custom_id, message, _ in replies
+        ]
+        return SimpleNamespace(id=batch_id, processing_status="ended")
+        
+    async def retrieve(self, batch_id: str) -> Any:
+        return SimpleNamespace(id=batch_id, processing_status="ended")
+        
+    async def results(self, batch_id: str) -> AsyncIterator[Any]:
+        entries = self._results.pop(batch_id, [])
+        
+        async def iterate():
+            for entry in entries:
+                yield entry
+                
+        return iterate()
+
+class StubLLMClient:
+    """Stands in for AsyncAnthropic when profiling without recorded responses
+
+    Each call takes as long as the routed model would need to generate
+    ``output_tokens`` (MODEL_OUTPUT_SPEEDS), scaled by ``latency_scale``
+    so a full workflow profiles in seconds.
+    """
+    
+    def __init__(self, latency_scale: Optional[float] = None, output_tokens: Optional[int] = None):
+        self.latency_scale = latency_scale if latency_scale is not None else float(
+            os.getenv("PROFILE_LLM_LATENCY_SCALE", "0.05"))
+        self.output_tokens = output_tokens or int(os.getenv("PROFILE_LLM_OUTPUT_TOKENS", "800"))
+        self.messages = self
+        self.batches = StubBatches(self)
+        
+    def reply(self, request: Dict[str, Any]) -> Tuple[Any, float]:
+        """The canned message for ``request`` and how long to take over it"""
+        tokens = min(self.output_tokens, request.get("max_tokens", self.output_tokens))
+        message = SimpleNamespace(
+            content=[SimpleNamespace(type="text", text=f"[profile stub for {request['model']}] " + "x" * tokens * 4)],
+            usage=SimpleNamespace(
+                input_tokens=estimate_tokens(json.dumps([request.get("system"), request.get("messages")])),
+                output_tokens=tokens, cache_read_input_tokens=0, cache_creation_input_tokens=0
+            )
+        )
+        return message, estimate_latency(request["model"], tokens) * self.latency_scale
+        
+    async def create(self, **request) -> Any:
+        message, latency = self.reply(request)
+        await asyncio.sleep(latency)
+        return message
+        
+    @asynccontextmanager
+    async def stream(self, **request):
+        message, latency = self.reply(request)
+        chunks = re.findall(r".{1,200}", message.content[0].text, re.S)
+        
+        async def text_stream():
+            for chunk in chunks:
+                await asyncio.sleep(latency / len(chunks))
+                yield chunk
+                
+        async def get_final_message():
+            return message
+            
+        yield SimpleNamespace(text_stream=text_stream(), get_final_message=get_final_message)
+
+def span_label(span: Span) -> str:
+    """Span name qualified by its workflow phase or agent"""
+    detail = span.attributes.get("workflow.phase") or span.attributes.get("agent")
+    return f"{span.name}[{detail}]" if detail else span.name
+
+def trace_root(spans: List[Span]) -> Span:
+    """The longest span whose parent was not recorded"""
+    ids = {span.span_id for span in spans}
+    return max((span for span in spans if span.parent_span_id not in ids), key=lambda span: span.duration)
+
+def critical_path(spans: List[Span]) -> List[Tuple[Span, int]]:
+    """The spans that bound the longest trace's wall time, with the
+    nanoseconds each spent on the critical path itself
+
+    Walks back from the end of the root span: the child that finished last
+    is what its parent waited on, and before that child started, the child
+    that finished last before then, and so on. Time not covered by any
+    child is the parent's own.
+    """
+    if not spans:
+        return []
+    ids = {span.span_id for span in spans}
+    children: Dict[str, List[Span]] = {}
+    for span in spans:
+        if span.parent_span_id in ids:
+            children.setdefault(span.parent_span_id, []).append(span)
+    root = trace_root(spans)
+    
+    path: List[Tuple[Span, int]] = []
+    
+    def walk(span: Span, end: int):
+        cursor = min(span.end_ns, end)
+        for child in sorted(children.get(span.span_id, []), key=lambda child: child.end_ns, reverse=True):
+            if child.start_ns >= cursor:
+                continue
+            child_end = min(child.end_ns, cursor)
+            path.append((span, cursor - child_end))
+            walk(child, child_end)
+            cursor = max(child.start_ns, span.start_ns)
+        path.append((span, cursor - span.start_ns))
+        
+    walk(root, root.end_ns)
+    return [(span, ns) for span, ns in path if ns > 0]
+
+def chrome_trace(spans: List[Span]) -> Dict[str, Any]:
+    """Chrome trace-event JSON (chrome://tracing, Perfetto) with one lane per agent"""
+    if not spans:
+        return {"traceEvents": []}
+    origin = min(span.start_ns for span in spans)
+    lanes: Dict[str, int] = {}
+    events = []
+    for span in sorted(spans, key=lambda span: (span.start_ns, -span.end_ns)):
+        lane = str(span.attributes.get("agent") or Orchestrator.name)
+        if lane not in lanes:
+            lanes[lane] = len(lanes) + 1
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": lanes[lane],
+                           "args": {"name": lane}})
+        events.append({
+            "name": span_label(span),
+            "cat": span.name.split(".")[0],
+            "ph": "X",
+            "pid": 1,
+            "tid": lanes[lane],
+            "ts": (span.start_ns - origin) / 1000,
+            "dur": (span.end_ns - span.start_ns) / 1000,
+            "args": {**span.attributes, **({"error": span.error} if span.error else {})},
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def profile_summary(spans: List[Span], top: int = 15) -> str:
+    """Wall time per phase and where the critical path spends it"""
+    if not spans:
+        return "No spans recorded"
+    path = critical_path(spans)
+    root = trace_root(spans)
+    wall = root.end_ns - root.start_ns
+    
+    by_label: Counter = Counter()
+    by_kind: Counter = Counter()
+    for span, ns in path:
+        by_label[span_label(span)] += ns
+        by_kind[span.name] += ns
+        
+    lines = [f"Wall time {wall / 1e9:.3f}s ({span_label(root)})", "", "Phases:"]
+    for span in sorted((span for span in spans if span.name == "workflow.phase"),
+                       key=lambda span: span.start_ns):
+        lines.append(f"  {span.attributes.get('workflow.phase', ''):<20}{span.duration * 1000:>12.1f}ms")
+    lines += ["", "Critical path by span kind:"]
+    for name, ns in by_kind.most_common():
+        lines.append(f"  {name:<20}{ns / 1e6:>12.1f}ms {ns / wall:>6.1%}")
+    lines += ["", f"Critical path, top {top}:"]
+    for label, ns in by_label.most_common(top):
+        lines.append(f"  {label:<44}{ns / 1e6:>12.1f}ms {ns / wall:>6.1%}")
+    lines += ["", "Own time of workflow.* spans is orchestrator work outside any agent:",
+              "console and Progress rendering, workspace reads and sleeps."]
+    return "\n".join(lines)
+
 # ============================================================================
 # CLI Interface
 # ============================================================================
 
 @click.command()
-@click.option("--mode", type=click.Choice(["autonomous", "interactive", "test"]), 
+@click.option("--mode", type=click.Choice(["autonomous", "interactive", "test", "profile"]), 
               default="autonomous", help="Execution mode")
 @click.option("--base-url", default="http://localhost:3000", 
               help="Base URL for testing")
 @click.option("--problem", type=click.Path(exists=True), 
               default="inputs/problem.md", help="Problem statement file")
-def main(mode: str, base_url: str, problem: str):
+@click.option("--llm-cache", type=click.Choice(ResponseCache.MODES), default=None,
+              help="LLM response cache mode (overrides LLM_CACHE_MODE)")
+@click.option("--batch", is_flag=True, default=False,
+              help="Send bulk, latency-tolerant work through the Message Batches API")
+@click.option("--supervise", is_flag=True, default=False,
+              help="Run each agent in its own supervised process")
+@click.option("--profile-output", default="workspace/reports/profile",
+              help="Where profile mode writes trace.json and critical_path.txt")
+@click.option("--resume", is_flag=True, default=False,
+              help="Skip workflow phases already checkpointed with unchanged inputs")
+def main(mode: str, base_url: str, problem: str, llm_cache: Optional[str], batch: bool,
+         supervise: bool, profile_output: str, resume: bool):
     """Zero-Error Autonomous Orchestrator"""
+    configure_logging()
     
     # Set base URL in environment
     os.environ["BASE_URL"] = base_url
+    if llm_cache:
+        os.environ["LLM_CACHE_MODE"] = llm_cache
+    if batch:
+        os.environ["LLM_BATCH_MODE"] = "true"
+    if supervise:
+        os.environ["AGENT_SUPERVISOR"] = "true"
+    if resume:
+        os.environ["WORKFLOW_RESUME"] = "true"
     
+    if os.getenv("ENABLE_METRICS", "false").lower() == "true":
+        telemetry.serve_metrics(int(os.getenv("METRICS_PORT", "9090")))
+        
+    # Profiles use recorded responses with --llm-cache replay, else a stub
+    stub_llm = mode == "profile" and llm_cache != "replay"
+    if stub_llm:
+        os.environ["LLM_CACHE_MODE"] = "off"
+        
     # Create orchestrator
     orchestrator = Orchestrator()
+    if stub_llm:
+        orchestrator.client = StubLLMClient()
     orchestrator.load_agent_configs()
     orchestrator.create_agents()
     
     # Run based on mode
-    if mode == "autonomous":
-        asyncio.run(orchestrator.execute_workflow(Path(problem)))
-    elif mode == "interactive":
-        asyncio.run(orchestrator.interactive_mode())
-    elif mode == "test":
-        # Run test suite
-        os.system("pytest tests/")
+    try:
+        if mode == "autonomous":
+            asyncio.run(orchestrator.execute_workflow(Path(problem)))
+        elif mode == "interactive":
+            asyncio.run(orchestrator.interactive_mode())
+        elif mode == "test":
+            # Run test suite
+            os.system("pytest tests/")
+        elif mode == "profile":
+            asyncio.run(orchestrator.profile_workflow(Path(problem), Path(profile_output)))
+    finally:
+        orchestrator.context_cache.close()
+        telemetry.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,52 @@
+"""
+Shared fixtures for unit tests
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+
+@pytest.fixture
+def make_orchestrator(tmp_path):
+    """Build an Orchestrator whose agents answer from canned replies instead of the LLM
+
+    ``replies`` maps agent name to ``(text, delay_seconds)`` or to an exception
+    the agent's LLM call should raise. Agent options such as ``parallel_safe``
+    can be passed through ``configs``.
+    """
+    from orchestrator import Agent, AgentConfig, MessageQueue, Orchestrator
+
+    created = []
+
+    def factory(replies, configs=None):
+        orchestrator = Orchestrator(message_queue=MessageQueue(tmp_path / "messages"))
+        for name, reply in replies.items():
+            config = AgentConfig(name=name, emoji="🤖", model="test-model",
+                                 role_file=Path("missing.md"), context_policy={},
+                                 files_allowed=[], **(configs or {}).get(name, {}))
+            agent = Agent(config, orchestrator.client, orchestrator.message_queue,
+                          orchestrator.context_cache, orchestrator.rate_limiter,
+                          orchestrator.router)
+
+            async def invoke_llm(prompt, context, priority=None, route=None, reply=reply):
+                if isinstance(reply, Exception):
+                    raise reply
+                await asyncio.sleep(reply[1])
+                return reply[0]
+
+            agent.invoke_llm = invoke_llm
+            orchestrator.configs[name] = config
+            orchestrator.agents[name] = agent
+        created.append(orchestrator)
+        return orchestrator
+
+    yield factory
+    for orchestrator in created:
+        orchestrator.message_queue.close()
+        orchestrator.context_cache.close()
@@ -0,0 +1,242 @@
+"""
+Unit tests for the agent context cache
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from orchestrator import ContextCache, ContextPacker, estimate_tokens
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "roles").mkdir()
+    (tmp_path / "roles" / "qa.md").write_text("You are QA")
+    (tmp_path / "workspace").mkdir()
+    for i in range(3):
+        (tmp_path / "workspace" / f"note{i}.md").write_text(f"note {i}")
+    return tmp_path
+
+
+def wait_for(condition, timeout=3):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_compose_matches_role_and_files(workspace):
+    """The composed context is the role file followed by each matching file"""
+    cache = ContextCache(watch=False)
+    context = cache.compose(Path("roles/qa.md"), ["workspace/*.md"])
+    assert context == "\n\n".join(
+        ["You are QA"] + [f"\n# File: workspace/note{i}.md\nnote {i}" for i in range(3)]
+    )
+
+
+def test_unchanged_files_are_not_reread(workspace):
+    """Without a watcher, files are re-validated by stat but only changed ones re-read"""
+    cache = ContextCache(watch=False)
+    cache.compose(Path("roles/qa.md"), ["workspace/*.md"])
+    misses = cache.misses
+
+    (workspace / "workspace" / "note1.md").write_text("note 1, revised")
+    context = cache.compose(Path("roles/qa.md"), ["workspace/*.md"])
+
+    assert "note 1, revised" in context
+    assert cache.misses == misses + 1
+
+
+def test_watched_workspace_serves_from_cache_until_an_event(workspace):
+    """With a watcher, warm builds skip the filesystem and events invalidate them"""
+    cache = ContextCache()
+    try:
+        first = cache.compose(Path("roles/qa.md"), ["workspace/*.md"])
+        hits = cache.hits
+        assert cache.compose(Path("roles/qa.md"), ["workspace/*.md"]) == first
+        assert cache.hits == hits + 1
+
+        (workspace / "workspace" / "new.md").write_text("fresh file")
+        assert wait_for(lambda: "fresh file" in cache.compose(Path("roles/qa.md"),
+                                                              ["workspace/*.md"]))
+    finally:
+        cache.close()
+
+
+def test_changes_only_rebuild_contexts_that_contain_them(workspace):
+    """A change under one agent's roots leaves other agents' composed contexts cached"""
+    (workspace / "specs").mkdir()
+    (workspace / "specs" / "spec.md").write_text("the spec")
+    cache = ContextCache()
+    try:
+        notes = (Path("roles/qa.md"), ["workspace/*.md"])
+        specs = (Path("roles/qa.md"), ["specs/*.md"])
+        built_notes = cache.collect(*notes)
+        built_specs = cache.collect(*specs)
+
+        cache.invalidate(workspace / "workspace" / "messages" / "QA" / "inbox.sqlite-wal")
+        assert cache.collect(*notes) is built_notes
+        cache.invalidate(workspace / "workspace" / "note1.md", structural=False)
+        assert cache.collect(*specs) is built_specs
+        rebuilt = cache.collect(*notes)
+        assert rebuilt is not built_notes
+        assert cache.collect(*notes) is rebuilt
+    finally:
+        cache.close()
+
+
+def test_runtime_state_is_not_context(workspace):
+    """Queue, blob and cache files never reach a ``workspace/**/*`` context"""
+    for path in ("messages/QA/inbox.sqlite", "blobs/ab/abcdef", "cache/llm/ab/key.json",
+                 "checkpoints/workflow.jsonl", "telemetry/traces.jsonl"):
+        (workspace / "workspace" / path).parent.mkdir(parents=True, exist_ok=True)
+        (workspace / "workspace" / path).write_text("runtime state")
+    cache = ContextCache(watch=False)
+    _, files = cache.collect(Path("roles/qa.md"), ["workspace/**/*"])
+    assert sorted(str(path) for path, _ in files) == [f"workspace/note{i}.md" for i in range(3)]
+
+
+def test_lru_byte_budget(workspace):
+    """The least recently used files are evicted once the byte budget is exceeded"""
+    cache = ContextCache(max_bytes=12, watch=False)
+    for i in range(3):
+        cache.read(Path(f"workspace/note{i}.md"))
+    assert list(cache._files) == [Path("workspace/note1.md"), Path("workspace/note2.md")]
+
+
+def test_packer_keeps_everything_within_budget(workspace):
+    """A context that fits is passed through unchanged"""
+    cache = ContextCache(watch=False)
+    role, files = cache.collect(Path("roles/qa.md"), ["workspace/*.md"])
+    packed = ContextPacker(cache).pack(role, files, "claude-3-5-sonnet-20241022")
+    assert packed == cache.compose(Path("roles/qa.md"), ["workspace/*.md"])
+
+
+def test_packer_prefers_relevant_files(workspace):
+    """max_context_files keeps the files that best match the message"""
+    (workspace / "workspace" / "sms_gateway.md").write_text("SMS gateway retries and SMS reminders")
+    cache = ContextCache(watch=False)
+    role, files = cache.collect(Path("roles/qa.md"), ["workspace/*.md"])
+
+    packed = ContextPacker(cache).pack(role, files, "claude-3-5-sonnet-20241022",
+                                       {"max_context_files": 1},
+                                       query='{"action": "test sms reminders"}')
+    assert "SMS gateway retries" in packed
+    assert "# File: workspace/note0.md\nnote 0" not in packed
+    assert "- workspace/note0.md (~2 tokens): note 0" in packed
+
+
+def test_packed_context_is_reused_until_a_file_changes(workspace):
+    """A context that fits whole is packed once, whatever the message"""
+    cache = ContextCache(watch=False)
+    packer = ContextPacker(cache)
+    role, files = cache.collect(Path("roles/qa.md"), ["workspace/*.md"])
+    first = packer.pack_sections(role, files, "claude-3-5-sonnet-20241022", query="review note 1")
+    role, files = cache.collect(Path("roles/qa.md"), ["workspace/*.md"])
+    assert packer.pack_sections(role, files, "claude-3-5-sonnet-20241022", query="other") is first
+
+    (workspace / "workspace" / "note1.md").write_text("note 1, revised")
+    role, files = cache.collect(Path("roles/qa.md"), ["workspace/*.md"])
+    _, volatile = packer.pack_sections(role, files, "claude-3-5-sonnet-20241022", query="other")
+    assert "note 1, revised" in volatile
+
+
+def test_stable_files_are_ranked_with_the_rest(workspace):
+    """Specs outside the workspace do not take a relevant workspace file's place"""
+    (workspace / "specs").mkdir()
+    for i in range(3):
+        (workspace / "specs" / f"spec{i}.md").write_text(f"spec {i}")
+    (workspace / "workspace" / "sms_gateway.md").write_text("SMS gateway retries and SMS reminders")
+    cache = ContextCache(watch=False)
+    role, files = cache.collect(Path("roles/qa.md"), ["specs/*.md", "workspace/*.md"])
+
+    stable, volatile = ContextPacker(cache).pack_sections(role, files, "claude-3-5-sonnet-20241022",
+                                                          {"max_context_files": 2},
+                                                          query='{"action": "test sms reminders"}')
+    assert "SMS gateway retries" in volatile
+    assert stable.count("# File: specs/") == 1
+
+
+def test_packer_truncates_and_summarizes_overflow(workspace):
+    """Files past the token budget are truncated, then summarized"""
+    for name in ("big_a.md", "big_b.md"):
+        (workspace / "workspace" / name).write_text(f"{name} header\n" + "lorem ipsum " * 2000)
+    cache = ContextCache(watch=False)
+    role, files = cache.collect(Path("roles/qa.md"), ["workspace/*.md"])
+
+    packed = ContextPacker(cache).pack(role, files, "test-model", {"max_context_tokens": 3000})
+    assert estimate_tokens(packed) <= 3000
+    assert "truncated" in packed
+    assert "big_b.md (~" in packed
+    assert packed.startswith("You are QA")
+
+
+def test_budget_follows_model_and_policy():
+    """Budgets come from the agent policy, then the model family"""
+    assert ContextPacker.budget_for("claude-3-haiku-20240307", {}) == 60000
+    assert ContextPacker.budget_for("claude-3-opus-20240229", {"max_context_tokens": 500}) == 500
+
+
+@pytest.mark.asyncio
+async def test_context_build_leaves_the_event_loop_free(workspace, tmp_path):
+    """A slow context build for one agent does not stall the others"""
+    import asyncio
+
+    from orchestrator import Agent, AgentConfig, MessageQueue
+
+    cache = ContextCache(watch=False)
+
+    def slow_collect(role_file, patterns):
+        time.sleep(0.3)
+        return "You are QA", []
+
+    cache.collect = slow_collect
+    config = AgentConfig(name="QA", emoji="🟤", model="test-model", role_file=Path("roles/qa.md"),
+                         context_policy={}, files_allowed=["workspace/*.md"])
+    agent = Agent(config, None, MessageQueue(tmp_path / "messages"), cache)
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    other_agent = asyncio.create_task(ticker())
+    assert await agent.load_context() == "You are QA"
+    other_agent.cancel()
+    cache.close()
+    assert ticks >= 10
+
+
+def test_terms_are_counted_in_worker_processes(workspace):
+    """With CONTEXT_PROCESS_WORKERS, ranking tokenizes files in a process pool"""
+    from collections import Counter
+
+    cache = ContextCache(watch=False, process_workers=2)
+    files = [(Path(f"workspace/doc{i}.md"), f"retry backoff jitter doc{i} " * 50) for i in range(4)]
+    try:
+        cache.warm_terms(files)
+        assert cache._processes is not None
+        assert cache._processes._mp_context.get_start_method() == "spawn"
+        for path, content in files:
+            assert cache.terms(path, content) == Counter(
+                {"retry": 50, "backoff": 50, "jitter": 50, path.stem: 50})
+        workers = list(cache._processes._processes.values())
+    finally:
+        cache.close()
+    assert cache._processes is None
+    assert not any(worker.is_alive() for worker in workers)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,166 @@
+"""
+Unit tests for Message Batches mode, against a local stand-in for the API
+"""
+import json
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+
+class StubBatchesAPI(BaseHTTPRequestHandler):
+    """Just enough of /v1/messages/batches: create, retrieve, results
+
+    Each request is answered with the word after "TOKEN:" in its prompt;
+    "TOKEN:fail" comes back errored. A batch ends on its second retrieve
+    and results are returned in reverse order, as the API does not
+    promise ordering.
+    """
+
+    server: "StubBatchesServer"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def batch_json(self, batch_id):
+        batch = self.server.batches[batch_id]
+        ended = batch["polls"] >= 2
+        host, port = self.server.server_address
+        return {
+            "id": batch_id, "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {"processing": 0 if ended else len(batch["requests"]),
+                               "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": "2024-01-01T00:00:00Z", "expires_at": "2024-01-02T00:00:00Z",
+            "ended_at": "2024-01-01T00:01:00Z" if ended else None,
+            "archived_at": None, "cancel_initiated_at": None,
+            "results_url": f"http://{host}:{port}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        batch_id = f"msgbatch_{len(self.server.batches) + 1}"
+        self.server.batches[batch_id] = {"requests": body["requests"], "polls": 0}
+        self.send_json(self.batch_json(batch_id))
+
+    def do_GET(self):
+        match = re.match(r"/v1/messages/batches/(\w+)(/results)?", self.path)
+        batch_id = match.group(1)
+        if not match.group(2):
+            self.server.batches[batch_id]["polls"] += 1
+            self.send_json(self.batch_json(batch_id))
+            return
+
+        lines = []
+        for request in reversed(self.server.batches[batch_id]["requests"]):
+            prompt = request["params"]["messages"][0]["content"]
+            token = re.search(r"TOKEN:(\w+)", prompt).group(1)
+            if token == "fail":
+                result = {"type": "errored", "error": {"type": "error", "error": {
+                    "type": "invalid_request_error", "message": "prompt rejected"}}}
+            else:
+                result = {"type": "succeeded", "message": {
+                    "id": "msg_1", "type": "message", "role": "assistant",
+                    "model": request["params"]["model"], "stop_reason": "end_turn",
+                    "stop_sequence": None, "content": [{"type": "text", "text": f"answer {token}"}],
+                    "usage": {"input_tokens": 20, "output_tokens": 3}}}
+            lines.append(json.dumps({"custom_id": request["custom_id"], "result": result}))
+        self.send_json("\n".join(lines).encode(), "application/binary")
+
+
+class StubBatchesServer(ThreadingHTTPServer):
+    """Serves StubBatchesAPI and holds the batches created in one test"""
+
+    def __init__(self, address):
+        super().__init__(address, StubBatchesAPI)
+        self.batches: dict[str, dict[str, Any]] = {}
+
+
+@pytest.fixture
+def batches_api():
+    server = StubBatchesServer(("127.0.0.1", 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", server.batches
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.asyncio
+async def test_invoke_llm_batch_returns_results_in_request_order(batches_api, tmp_path):
+    """Results are matched back by custom_id; a failed request surfaces as an exception"""
+    from pathlib import Path
+
+    from anthropic import AsyncAnthropic
+
+    from orchestrator import Agent, AgentConfig, AgentTaskError, MessageQueue
+
+    url, batches = batches_api
+    config = AgentConfig(name="DataScientist", emoji="🟡", model="claude-3-5-sonnet-20241022",
+                         role_file=Path("missing.md"), context_policy={}, files_allowed=[])
+    agent = Agent(config, AsyncAnthropic(api_key="test", base_url=url, max_retries=0),
+                  MessageQueue(tmp_path / "messages"))
+    agent.batch_poll_interval = 0.01
+
+    results = await agent.invoke_llm_batch([
+        ("score TOKEN:alpha", "system"), ("score TOKEN:fail", "system"), ("score TOKEN:gamma", "system")
+    ])
+
+    assert results[0] == "answer alpha" and results[2] == "answer gamma"
+    assert isinstance(results[1], AgentTaskError)
+    assert len(batches) == 1 and batches["msgbatch_1"]["polls"] >= 2
+    assert agent.usage["calls"] == 2
+    agent.context_cache.close()
+
+
+@pytest.mark.asyncio
+async def test_batch_tasks_are_submitted_together_and_fanned_out(batches_api, make_orchestrator):
+    """run_agent_batch requests become one submission and one RESPONSE each"""
+    from anthropic import AsyncAnthropic
+
+    url, batches = batches_api
+    orchestrator = make_orchestrator({"QA": ("unused", 0)})
+    agent = orchestrator.agents["QA"]
+    agent.client = AsyncAnthropic(api_key="test", base_url=url, max_retries=0)
+    agent.batch_window = 0.2
+    agent.batch_poll_interval = 0.01
+
+    orchestrator.start_agents()
+    try:
+        results = await orchestrator.run_agent_batch("QA", [
+            {"action": "generate_test_cases", "story": f"TOKEN:story{i}"} for i in range(4)
+        ])
+    finally:
+        await orchestrator.stop_agents()
+
+    assert [result["response"] for result in results] == [f"answer story{i}" for i in range(4)]
+    assert len(batches) == 1
+    assert len(batches["msgbatch_1"]["requests"]) == 4
+
+
+def test_user_stories_split_into_story_sections():
+    """Each "### Story" heading starts one batchable unit of work"""
+    from orchestrator import Orchestrator
+
+    stories = Orchestrator.split_user_stories(
+        "# Stories\n## Epic\n### Story 1.1: Risk\nbody\n### Story 1.2: Dashboard\nmore\n")
+    assert stories == ["### Story 1.1: Risk\nbody", "### Story 1.2: Dashboard\nmore"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
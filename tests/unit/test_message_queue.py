@@ -0,0 +1,458 @@
+"""
+Unit tests for the MessageQueue
+"""
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from orchestrator import AgentMessage, MessageQueue, MessageType, Priority, SQLiteInboxBackend
+
+
+def make_message(to_agent="QA", **kwargs):
+    return AgentMessage(
+        from_agent="Orchestrator",
+        to_agent=to_agent,
+        type=kwargs.pop("type", MessageType.REQUEST),
+        payload=kwargs.pop("payload", {"action": "test"}),
+        **kwargs
+    )
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = MessageQueue(tmp_path / "messages", poll_interval=5)
+    yield queue
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_receive_without_timeout_does_not_block(queue):
+    """An empty inbox returns None immediately"""
+    assert await queue.receive("QA") is None
+
+
+@pytest.mark.asyncio
+async def test_receive_returns_messages_in_order(queue):
+    """Messages are delivered oldest first and only once"""
+    first, second = make_message(), make_message()
+    await queue.send(first)
+    await queue.send(second)
+
+    assert (await queue.receive("QA")).id == first.id
+    assert (await queue.receive("QA")).id == second.id
+    assert await queue.receive("QA") is None
+
+
+@pytest.mark.asyncio
+async def test_send_wakes_waiting_receiver(queue):
+    """A blocked receiver wakes well before the poll interval elapses"""
+    receiver = asyncio.create_task(queue.receive("QA", timeout=10))
+    await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    message = make_message()
+    await queue.send(message)
+    received = await receiver
+
+    assert received.id == message.id
+    assert time.perf_counter() - started < 0.5
+
+
+@pytest.mark.asyncio
+async def test_receive_timeout_expires(queue):
+    """A blocked receiver gives up after its timeout"""
+    started = time.perf_counter()
+    assert await queue.receive("QA", timeout=0.1) is None
+    assert time.perf_counter() - started < 1
+
+
+@pytest.mark.asyncio
+async def test_depth_and_peek(queue):
+    """Depth counts waiting messages; peek does not dequeue"""
+    first, second = make_message(), make_message()
+    await queue.send(first)
+    await queue.send(second)
+
+    assert await queue.depth("QA") == 2
+    assert (await queue.peek("QA")).id == first.id
+    assert await queue.depth("QA") == 2
+
+    received = await queue.receive("QA")
+    await queue.ack(received)
+    assert await queue.depth("QA") == 1
+    assert (await queue.peek("QA")).id == second.id
+
+
+@pytest.mark.asyncio
+async def test_legacy_json_inbox_is_migrated(tmp_path):
+    """Existing inbox/processed JSON files are imported on first open"""
+    agent_dir = tmp_path / "messages" / "QA"
+    for folder, message in (("processed", make_message()), ("inbox", make_message()),
+                            ("inbox", make_message())):
+        (agent_dir / folder).mkdir(parents=True, exist_ok=True)
+        name = f"{message.timestamp.isoformat()}_{message.id}.json"
+        (agent_dir / folder / name).write_text(message.model_dump_json(indent=2))
+    pending = sorted((agent_dir / "inbox").glob("*.json"))
+
+    backend = SQLiteInboxBackend(tmp_path / "messages")
+    assert await backend.depth("QA") == 2
+    assert not list(agent_dir.glob("*/*.json"))
+
+    received = await backend.take("QA")
+    assert pending[0].name.endswith(f"_{received.id}.json")
+    done = backend.connection("QA").execute(
+        "SELECT SUM(count) FROM depths WHERE state = ?", (SQLiteInboxBackend.DONE,)
+    ).fetchone()[0]
+    assert done == 1
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_higher_priority_is_served_first(queue):
+    """CRITICAL work jumps ahead of older LOW notifications"""
+    low = make_message(priority=Priority.LOW)
+    critical = make_message(priority=Priority.CRITICAL)
+    await queue.send(low)
+    await queue.send(critical)
+
+    assert await queue.depth_by_priority("QA") == {
+        "low": 1, "medium": 0, "high": 0, "critical": 1
+    }
+    assert (await queue.receive("QA")).id == critical.id
+    assert (await queue.receive("QA")).id == low.id
+
+
+@pytest.mark.asyncio
+async def test_depths_are_exported_as_gauges(queue):
+    from orchestrator import telemetry
+    await queue.send(make_message(priority=Priority.HIGH))
+    await queue.depth_by_priority("QA")
+
+    text = telemetry.metrics.render()
+    assert "# TYPE orchestrator_queue_depth gauge" in text
+    assert 'orchestrator_queue_depth{agent="QA",priority="high"} 1' in text
+    assert 'orchestrator_queue_depth{agent="QA",priority="low"} 0' in text
+
+
+@pytest.mark.asyncio
+async def test_aging_prevents_starvation(tmp_path):
+    """A LOW message that has waited long enough outranks fresh HIGH work"""
+    backend = SQLiteInboxBackend(tmp_path, aging_interval=10)
+    low = make_message(priority=Priority.LOW)
+    await backend.put(low)
+    # Pretend the LOW message has been waiting for 35s (3.5 ranks of aging)
+    backend.connection("QA").execute("UPDATE messages SET enqueued_at = enqueued_at - 35")
+    await backend.put(make_message(priority=Priority.HIGH))
+
+    assert (await backend.take("QA")).id == low.id
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_version_one_inbox_is_upgraded(tmp_path):
+    """Inboxes created before priority scheduling keep their pending messages"""
+    import sqlite3
+    agent_dir = tmp_path / "QA"
+    agent_dir.mkdir()
+    message = make_message()
+    conn = sqlite3.connect(agent_dir / "inbox.sqlite")
+    conn.executescript("""
+        CREATE TABLE messages (seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL UNIQUE,
+            thread_id TEXT, from_agent TEXT NOT NULL, created_at TEXT NOT NULL,
+            state INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL);
+        CREATE INDEX messages_state_seq ON messages (state, seq);
+        CREATE TABLE counters (state INTEGER PRIMARY KEY, count INTEGER NOT NULL);
+        INSERT INTO counters VALUES (0, 1), (1, 0), (2, 0);
+    """)
+    conn.execute("INSERT INTO messages (id, from_agent, created_at, data) VALUES (?, ?, ?, ?)",
+                 (message.id, message.from_agent, message.timestamp.isoformat(),
+                  message.model_dump_json()))
+    conn.commit()
+    conn.close()
+
+    backend = SQLiteInboxBackend(tmp_path)
+    assert await backend.depth_by_priority("QA") == {
+        "low": 0, "medium": 1, "high": 0, "critical": 0
+    }
+    assert (await backend.take("QA")).id == message.id
+    await backend.close()
+
+
+
+@pytest.mark.asyncio
+async def test_competing_consumers_claim_under_a_lease(tmp_path):
+    """Replicas never get the same message, and an expired lease passes it on"""
+    first = SQLiteInboxBackend(tmp_path, lease_seconds=0.2, consumer="replica-1")
+    second = SQLiteInboxBackend(tmp_path, lease_seconds=0.2, consumer="replica-2")
+    messages = [make_message() for _ in range(3)]
+    for message in messages:
+        await first.put(message)
+
+    claimed = [await first.take("QA"), await second.take("QA")]
+    assert {claimed[0].id, claimed[1].id} == {messages[0].id, messages[1].id}
+    await second.ack("QA", claimed[1].id)
+
+    time.sleep(0.25)
+    # The first replica's lease ran out, so its message goes to the next taker
+    assert (await second.take("QA")).id == claimed[0].id
+    assert (await second.take("QA")).id == messages[2].id
+    assert await first.requeue_in_flight("QA", consumer="replica-1") == 0
+    assert await first.requeue_in_flight("QA", consumer="replica-2") == 2
+    await first.close()
+    await second.close()
+
+
+@pytest.mark.asyncio
+async def test_leased_messages_outlive_their_lease(tmp_path):
+    """Work held in a leased() block, like a Message Batch, is not handed to another replica"""
+    queue = MessageQueue(tmp_path, backend=SQLiteInboxBackend(tmp_path, lease_seconds=0.3,
+                                                               consumer="replica-1"))
+    other = SQLiteInboxBackend(tmp_path, lease_seconds=0.3, consumer="replica-2")
+    message = make_message()
+    await queue.send(message)
+    received = await queue.receive("QA")
+
+    async with queue.leased("QA", [received]):
+        await asyncio.sleep(0.6)
+        assert await other.take("QA") is None
+    await queue.ack(received)
+    assert await other.take("QA") is None
+    await queue.backend.close()
+    await other.close()
+
+
+@pytest.mark.asyncio
+async def test_thread_messages_are_handed_out_in_order(tmp_path):
+    """A later message of a thread waits until the earlier one is acked"""
+    first = SQLiteInboxBackend(tmp_path, consumer="replica-1")
+    second = SQLiteInboxBackend(tmp_path, consumer="replica-2")
+    opening = make_message(thread_id="review-42")
+    follow_up = make_message(thread_id="review-42", priority=Priority.CRITICAL)
+    unrelated = make_message()
+    for message in (opening, follow_up, unrelated):
+        await first.put(message)
+
+    assert (await first.take("QA")).id == opening.id
+    assert (await second.take("QA")).id == unrelated.id
+    assert await second.take("QA") is None
+    await first.ack("QA", opening.id)
+    assert (await second.take("QA")).id == follow_up.id
+    await first.close()
+    await second.close()
+
+
+
+@pytest.mark.asyncio
+async def test_inbox_reads_messages_from_every_codec(tmp_path):
+    """Each row's header byte says how it was encoded, so codecs can be mixed"""
+    import sqlite3
+
+    from orchestrator import MessageCodec
+    plain = SQLiteInboxBackend(tmp_path, codec=MessageCodec("json", "none"))
+    compressed = SQLiteInboxBackend(tmp_path, codec=MessageCodec("json", "zlib", compress_min_bytes=1024))
+    small = make_message()
+    large = make_message(payload={"action": "finalize", "spec": "The dashboard lists appointments. " * 500})
+    await plain.put(small)
+    await compressed.put(large)
+
+    conn = sqlite3.connect(tmp_path / "QA" / "inbox.sqlite")
+    rows = dict(conn.execute("SELECT id, data FROM messages").fetchall())
+    conn.close()
+    assert rows[small.id][0] == 0x01
+    assert rows[large.id][0] == 0x11
+    assert len(rows[large.id]) < len(large.model_dump_json()) // 10
+
+    assert await plain.take("QA") == small
+    assert await plain.take("QA") == large
+    await plain.close()
+    await compressed.close()
+
+
+
+@pytest.mark.asyncio
+async def test_large_payload_values_are_sent_by_reference(tmp_path):
+    """An artifact sent to two agents is stored once and resolved on demand"""
+    from orchestrator import BlobStore
+    queue = MessageQueue(tmp_path / "messages", blobs=BlobStore(tmp_path / "blobs", min_bytes=1024))
+    spec = "The dashboard lists appointments. " * 500
+    for agent in ("ProductOwner", "Architect"):
+        await queue.send(make_message(agent, payload={"action": "design", "spec": spec}))
+
+    received = await queue.receive("Architect")
+    assert received.payload["spec"] == {"$blob": received.payload["spec"]["$blob"], "bytes": len(spec)}
+    assert len(list((tmp_path / "blobs").glob("*/*"))) == 1
+    assert (await queue.resolve(received)).payload == {"action": "design", "spec": spec}
+    await queue.backend.close()
+
+
+
+@pytest.mark.asyncio
+async def test_compaction_archives_done_messages_and_applies_retention(tmp_path):
+    """Done rows leave the inbox for a segment, stay findable by thread, then expire"""
+    import sqlite3
+    backend = SQLiteInboxBackend(tmp_path)
+    opening = make_message()
+    reply = make_message(thread_id=opening.id, payload={"response": "done " * 2000})
+    waiting = make_message()
+    for message in (opening, reply, waiting):
+        await backend.put(message)
+    for _ in range(2):
+        await backend.ack("QA", (await backend.take("QA")).id)
+
+    assert await backend.compact(archive_after=0) == 2
+    conn = sqlite3.connect(tmp_path / "QA" / "inbox.sqlite")
+    assert [row[0] for row in conn.execute("SELECT id FROM messages")] == [waiting.id]
+    assert dict(conn.execute("SELECT state, SUM(count) FROM depths GROUP BY state")) == {0: 1, 1: 0, 2: 0}
+    conn.close()
+    segments = list((tmp_path / "QA" / "archive").glob("*.seg"))
+    assert len(segments) == 1
+    assert await backend.archived("QA", opening.id) == [opening, reply]
+
+    # A segment is deleted once its whole day is past retention
+    segments[0].rename(segments[0].with_name("2000-01-01.seg"))
+    conn = sqlite3.connect(tmp_path / "QA" / "inbox.sqlite")
+    conn.execute("UPDATE archive SET segment = '2000-01-01.seg'")
+    conn.commit()
+    conn.close()
+    assert await backend.compact(archive_after=0, retention=86400) == 0
+    assert not list((tmp_path / "QA" / "archive").glob("*.seg"))
+    assert await backend.archived("QA", opening.id) == []
+    assert (await backend.take("QA")).id == waiting.id
+    await backend.close()
+
+
+
+@pytest.mark.asyncio
+async def test_retention_counts_from_when_a_message_was_processed(tmp_path):
+    """A message that waited longer than retention before it was handled is still archived"""
+    import sqlite3
+    from datetime import UTC, datetime
+    backend = SQLiteInboxBackend(tmp_path)
+    message = make_message()
+    await backend.put(message)
+    conn = sqlite3.connect(tmp_path / "QA" / "inbox.sqlite")
+    conn.execute("UPDATE messages SET enqueued_at = ?", (time.time() - 40 * 86400,))
+    conn.commit()
+    conn.close()
+    await backend.ack("QA", (await backend.take("QA")).id)
+
+    assert await backend.compact(archive_after=3600, retention=30 * 86400) == 0
+    assert await backend.compact(archive_after=0, retention=30 * 86400) == 1
+    today = datetime.now(UTC).date().isoformat()
+    assert [segment.name for segment in (tmp_path / "QA" / "archive").glob("*.seg")] == [f"{today}.seg"]
+    assert await backend.archived("QA", message.id) == [message]
+    await backend.close()
+
+
+
+@pytest.mark.asyncio
+async def test_blobs_are_swept_once_no_message_references_them(tmp_path):
+    """Compaction deletes a blob when the archive segment of its last message expires"""
+    import sqlite3
+
+    from orchestrator import BlobStore
+    queue = MessageQueue(tmp_path / "messages", blobs=BlobStore(tmp_path / "blobs", min_bytes=1024, grace=0))
+    queue.archive_after, queue.retention = 0, 86400
+    await queue.send(make_message(payload={"spec": "a" * 2000}))
+    await queue.send(make_message(payload={"spec": "b" * 2000}))
+    await queue.ack(await queue.receive("QA"))
+
+    assert await queue.compact() == 1
+    assert len(list((tmp_path / "blobs").glob("*/*"))) == 2
+
+    segment = next((tmp_path / "messages" / "QA" / "archive").glob("*.seg"))
+    segment.rename(segment.with_name("2000-01-01.seg"))
+    conn = sqlite3.connect(tmp_path / "messages" / "QA" / "inbox.sqlite")
+    conn.execute("UPDATE archive SET segment = '2000-01-01.seg'")
+    conn.commit()
+    conn.close()
+    await queue.compact()
+    waiting = await queue.resolve(await queue.receive("QA"))
+    assert waiting.payload == {"spec": "b" * 2000}
+    assert len(list((tmp_path / "blobs").glob("*/*"))) == 1
+    await queue.backend.close()
+
+
+
+@pytest.mark.asyncio
+async def test_broadcast_is_written_once_and_read_through_cursors(tmp_path):
+    """Each subscriber sees a broadcast once, filtered by its topics"""
+    import sqlite3
+    queue = MessageQueue(tmp_path / "messages")
+    for agent in ("QA", "Architect", "MetaAgent"):
+        await queue.subscribe(agent)
+    status = make_message("*", type=MessageType.NOTIFICATION, payload={"status": "task graph ready"})
+    status.from_agent = "MetaAgent"
+    await queue.broadcast(status, topic="workflow.status")
+    await queue.broadcast(make_message("*", type=MessageType.NOTIFICATION), topic="deploy")
+    await queue.subscribe("Latecomer")
+
+    conn = sqlite3.connect(tmp_path / "messages" / "broadcasts" / "log.sqlite")
+    assert conn.execute("SELECT COUNT(*) FROM broadcasts").fetchone()[0] == 2
+    conn.close()
+
+    received = await queue.receive("QA", topics=["workflow.*"])
+    assert (received.id, received.to_agent, received.payload) == (
+        status.id, "QA", {"status": "task graph ready"})
+    assert await queue.receive("QA", topics=["workflow.*"]) is None
+    assert (await queue.receive("Architect", timeout=1, topics=["*"])).id == status.id
+    assert (await queue.receive("Architect", topics=["*"])).topic == "deploy"
+    assert (await queue.receive("MetaAgent", topics=["*"])).topic == "deploy"
+    assert await queue.receive("Latecomer", topics=["*"]) is None
+    queue.close()
+    await queue.backend.close()
+
+
+
+@pytest.mark.asyncio
+async def test_get_thread_collects_messages_across_inboxes_and_archives(tmp_path):
+    """A thread is found from any of its message ids, wherever each message sits"""
+    queue = MessageQueue(tmp_path / "messages")
+    request = make_message("SelfHealing", payload={"action": "fix"})
+    reply = AgentMessage(from_agent="SelfHealing", to_agent="Orchestrator", type=MessageType.RESPONSE,
+                         payload={"response": "patched"}, thread_id=request.id, in_reply_to=request.id)
+    await queue.send(request)
+    await queue.send(make_message("SelfHealing"))
+    await queue.ack(await queue.receive("SelfHealing"))
+    await queue.backend.compact(archive_after=0)
+    await queue.send(reply)
+
+    for message_id in (request.id, reply.id):
+        thread = await queue.get_thread(message_id)
+        assert [(entry.inbox, entry.state, entry.message.id) for entry in thread] == [
+            ("SelfHealing", "archived", request.id), ("Orchestrator", "pending", reply.id)]
+    queue.close()
+    await queue.backend.close()
+
+
+
+@pytest.mark.asyncio
+async def test_read_only_backend_leaves_inboxes_untouched(tmp_path):
+    """Inspecting a thread does not migrate, vacuum or write to an inbox"""
+    import sqlite3
+    writer = SQLiteInboxBackend(tmp_path)
+    request = make_message()
+    await writer.put(request)
+    await writer.close()
+    conn = sqlite3.connect(tmp_path / "QA" / "inbox.sqlite")
+    conn.execute("PRAGMA user_version = 1")
+    conn.close()
+    before = (tmp_path / "QA" / "inbox.sqlite").read_bytes()
+
+    reader = SQLiteInboxBackend(tmp_path, read_only=True)
+    assert [(entry.state, entry.message.id) for entry in await reader.thread(request.id)] == [
+        ("pending", request.id)]
+    with pytest.raises(sqlite3.OperationalError):
+        await reader.put(make_message())
+    await reader.close()
+    assert (tmp_path / "QA" / "inbox.sqlite").read_bytes() == before
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,89 @@
+"""
+Unit tests for per-message model routing
+"""
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from orchestrator import AgentConfig, AgentMessage, MessageType, ModelRoute, ModelRouter
+
+OPUS = AgentConfig(name="Architect", emoji="🟢", model="claude-3-opus-20240229",
+                   role_file=Path("missing.md"), context_policy={}, files_allowed=[])
+
+
+def message(type, payload, requires_response=False):
+    return AgentMessage(from_agent="TechLead", to_agent="Architect", type=type,
+                        payload=payload, requires_response=requires_response)
+
+
+def test_acknowledgements_fall_back_to_the_small_model():
+    """Notifications and unanswered replies never reach Opus"""
+    router = ModelRouter(enabled=True, fallback_model="claude-3-5-haiku-20241022")
+
+    route = router.route(OPUS, message(MessageType.NOTIFICATION, {"status": "done"}))
+    assert route.model == "claude-3-5-haiku-20241022" and route.max_tokens == 512
+
+    route = router.route(OPUS, message(MessageType.NOTIFICATION, {"q": "?"}, requires_response=True))
+    assert route.model == OPUS.model
+
+
+def test_requests_keep_the_configured_budget():
+    """A short request can ask for a long document; only status checks get a small budget"""
+    router = ModelRouter(enabled=True)
+    short = router.route(OPUS, message(MessageType.REQUEST, {"action": "create_spec",
+                                                             "problem": "see problem.md"}, True))
+    assert short == ModelRoute(OPUS.model, OPUS.max_tokens, OPUS.temperature, "request")
+    status = router.route(OPUS, message(MessageType.REQUEST, {"action": "status"}, True))
+    assert status.model == OPUS.model
+    assert status.max_tokens == ModelRouter.SHORT_ACTION_MAX_TOKENS
+
+    disabled = ModelRouter(enabled=False)
+    assert disabled.route(OPUS, message(MessageType.NOTIFICATION, {})) == ModelRouter.default(OPUS)
+
+
+def test_savings_are_totalled():
+    """A rerouted call records the cost and time it saved over the configured model"""
+    router = ModelRouter(enabled=True)
+    usage = SimpleNamespace(input_tokens=10000, output_tokens=500)
+    router.record(OPUS, ModelRouter.default(OPUS), usage)
+    assert router.routed_calls == 0
+
+    router.record(OPUS, ModelRoute("claude-3-5-haiku-20241022", 512, 0.3, "notification ack"), usage)
+    assert router.routed_calls == 1
+    assert router.saved_cost == pytest.approx((10000 * 14.2 + 500 * 71) / 1_000_000)
+    assert router.saved_seconds > 0
+
+
+def test_unrerouted_requests_are_not_counted():
+    """A request routed to the configured model and budget saves nothing and is not a reroute"""
+    router = ModelRouter(enabled=True)
+    route = router.route(OPUS, message(MessageType.REQUEST, {"spec": "x" * 40000}, True))
+    assert route.reason != ModelRouter.default(OPUS).reason
+    router.record(OPUS, route, SimpleNamespace(input_tokens=10000, output_tokens=500))
+    assert router.routed_calls == 0
+    assert router.saved_cost == router.saved_seconds == 0
+
+
+def test_reduced_budget_saving_counts_the_cut_output():
+    """A small request that used its whole budget is credited with the configured budget's output"""
+    router = ModelRouter(enabled=True)
+    route = router.route(OPUS, message(MessageType.REQUEST, {"action": "ping"}, True))
+    assert route.model == OPUS.model and route.max_tokens < OPUS.max_tokens
+
+    router.record(OPUS, route, SimpleNamespace(input_tokens=1000, output_tokens=route.max_tokens // 2))
+    assert router.routed_calls == 1 and router.saved_seconds == 0
+
+    router.record(OPUS, route, SimpleNamespace(input_tokens=1000, output_tokens=route.max_tokens))
+    assert router.routed_calls == 2
+    assert router.saved_cost == pytest.approx((OPUS.max_tokens - route.max_tokens) * 75 / 1_000_000)
+    assert router.saved_seconds > 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -1,9 +1,12 @@
 """
 Unit tests for orchestrator functionality
 """
-import pytest
-import sys
+import asyncio
 import os
+import sys
+import time
+
+import pytest
 
 # Add project root to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
@@ -24,6 +27,7 @@ def test_orchestrator_imports():
 def test_environment_variables():
     """Test environment variable handling"""
     import os
+
     from dotenv import load_dotenv
     
     # This should not fail even if .env doesn't exist
@@ -39,8 +43,8 @@ def test_environment_variables():
 
 def test_basic_python_functionality():
     """Sanity check for Python environment"""
-    import json
     import datetime
+    import json
     
     # Test basic Python functionality
     data = {"timestamp": datetime.datetime.now().isoformat()}
@@ -51,5 +55,295 @@ def test_basic_python_functionality():
     assert len(json_str) > 0
 
 
+@pytest.mark.asyncio
+async def test_run_agent_task_returns_as_soon_as_agent_replies(make_orchestrator):
+    """run_agent_task resolves on the correlated RESPONSE, not after a fixed sleep"""
+    orchestrator = make_orchestrator({"Researcher": ("findings", 0.05)})
+    orchestrator.start_agents()
+    try:
+        started = time.perf_counter()
+        result = await orchestrator.run_agent_task("Researcher", {"action": "research"})
+        assert result == {"response": "findings"}
+        assert time.perf_counter() - started < 1.5
+        assert not orchestrator.pending
+    finally:
+        await orchestrator.stop_agents()
+
+
+@pytest.mark.asyncio
+async def test_parallel_tasks_get_their_own_responses(make_orchestrator):
+    """Concurrent requests are matched to replies by message id"""
+    orchestrator = make_orchestrator({
+        "ProductOwner": ("backlog", 0.2),
+        "Architect": ("design", 0.01),
+    })
+    orchestrator.start_agents()
+    try:
+        backlog, design = await asyncio.gather(
+            orchestrator.run_agent_task("ProductOwner", {"action": "create_backlog"}),
+            orchestrator.run_agent_task("Architect", {"action": "design"}),
+        )
+        assert backlog == {"response": "backlog"}
+        assert design == {"response": "design"}
+    finally:
+        await orchestrator.stop_agents()
+
+
+@pytest.mark.asyncio
+async def test_run_agent_task_raises_on_error_and_timeout(make_orchestrator):
+    """ERROR replies and missing replies surface to the caller"""
+    from orchestrator import AgentTaskError
+
+    orchestrator = make_orchestrator({
+        "QA": RuntimeError("playwright missing"),
+        "DeliveryLead": ("done", 5),
+    })
+    orchestrator.start_agents()
+    try:
+        with pytest.raises(AgentTaskError, match="playwright missing"):
+            await orchestrator.run_agent_task("QA", {"action": "test"})
+        with pytest.raises(asyncio.TimeoutError):
+            await orchestrator.run_agent_task("DeliveryLead", {"action": "finalize"}, timeout=0.1)
+    finally:
+        await orchestrator.stop_agents()
+
+
+class FakeMessages:
+    """Stands in for client.messages, echoing prompt cache usage like the API"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def create(self, **request):
+        from types import SimpleNamespace
+        cached = bool(self.requests)
+        self.requests.append(request)
+        return SimpleNamespace(
+            content=[SimpleNamespace(text="ok")],
+            usage=SimpleNamespace(input_tokens=50, output_tokens=5,
+                                  cache_read_input_tokens=1200 if cached else 0,
+                                  cache_creation_input_tokens=0 if cached else 1200)
+        )
+
+    def stream(self, **request):
+        return FakeStream(self, request)
+
+
+class FakeStream:
+    """Stands in for the messages.stream() context manager"""
+
+    def __init__(self, messages, request, chunks=("Looks ", "good ", "to ", "me")):
+        self.messages = messages
+        self.request = request
+        self.chunks = chunks
+
+    async def __aenter__(self):
+        self.messages.requests.append(self.request)
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    async def text_stream(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(0.01)
+            yield chunk
+
+    async def get_final_message(self):
+        from types import SimpleNamespace
+        return SimpleNamespace(usage=SimpleNamespace(input_tokens=50, output_tokens=4,
+                                                     cache_read_input_tokens=0,
+                                                     cache_creation_input_tokens=0))
+
+
+@pytest.mark.asyncio
+async def test_system_prompt_caches_stable_prefix(tmp_path, monkeypatch):
+    """Role and stable files lead the system prompt and carry cache_control"""
+    from pathlib import Path
+    from types import SimpleNamespace
+
+    from orchestrator import Agent, AgentConfig, MessageQueue
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "prompts").mkdir()
+    (tmp_path / "prompts" / "context7.md").write_text("Context7 rules")
+    (tmp_path / "workspace").mkdir()
+    (tmp_path / "workspace" / "notes.md").write_text("today's notes")
+    (tmp_path / "role.md").write_text("You are QA")
+
+    config = AgentConfig(name="QA", emoji="🟤", model="claude-3-5-sonnet-20241022",
+                         role_file=Path("role.md"), context_policy={},
+                         files_allowed=["workspace/*.md", "prompts/*.md"])
+    client = SimpleNamespace(messages=FakeMessages())
+    agent = Agent(config, client, MessageQueue(tmp_path / "messages"))
+
+    system = await agent.load_system_prompt()
+    assert system[0]["cache_control"] == {"type": "ephemeral"}
+    assert system[0]["text"].startswith("You are QA")
+    assert "Context7 rules" in system[0]["text"]
+    assert "today's notes" in system[1]["text"] and "cache_control" not in system[1]
+
+    for _ in range(3):
+        await agent.invoke_llm("run the tests", system)
+    assert agent.usage["calls"] == 3
+    assert agent.usage["cache_hits"] == 2 and agent.usage["cache_misses"] == 1
+    assert agent.usage["cache_read_input_tokens"] == 2400
+    agent.message_queue.close()
+    agent.context_cache.close()
+
+
+@pytest.mark.asyncio
+async def test_response_cache_records_and_replays(tmp_path):
+    """readwrite serves repeats from disk; replay never calls the API and fails on a miss"""
+    from pathlib import Path
+    from types import SimpleNamespace
+
+    from orchestrator import Agent, AgentConfig, MessageQueue, ResponseCache, ResponseCacheMissError
+
+    config = AgentConfig(name="SelfHealing", emoji="🔴", model="claude-3-5-sonnet-20241022",
+                         role_file=Path("missing.md"), context_policy={}, files_allowed=[])
+    client = SimpleNamespace(messages=FakeMessages())
+    agent = Agent(config, client, MessageQueue(tmp_path / "messages"))
+    agent.response_cache = ResponseCache(tmp_path / "llm", mode="readwrite")
+
+    assert await agent.invoke_llm("fix the build", "system") == "ok"
+    assert await agent.invoke_llm("fix the build", "system") == "ok"
+    assert len(client.messages.requests) == 1
+    assert agent.usage["response_cache_hits"] == 1
+
+    agent.response_cache = ResponseCache(tmp_path / "llm", mode="replay")
+    assert await agent.invoke_llm("fix the build", "system") == "ok"
+    with pytest.raises(ResponseCacheMissError):
+        await agent.invoke_llm("a prompt never recorded", "system")
+    assert len(client.messages.requests) == 1
+    agent.message_queue.close()
+    agent.context_cache.close()
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    """Expired entries are ignored and the cache stays within its byte budget"""
+    from orchestrator import ResponseCache
+
+    cache = ResponseCache(tmp_path, mode="readwrite", ttl=3600, max_bytes=1000)
+    keys = [ResponseCache.key("m", "s", f"prompt {i}", {}) for i in range(6)]
+    for i, key in enumerate(keys):
+        cache.put(key, "m", "x" * 200)
+        os.utime(cache.entry_path(key), (1000 + i, 1000 + i))
+    cache.evict()
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[-1]) == "x" * 200
+    assert sum(p.stat().st_size for p in tmp_path.glob("*/*.json")) <= 900
+
+    expired = ResponseCache(tmp_path, mode="readwrite", ttl=0)
+    assert expired.get(keys[-1]) is None
+
+
+@pytest.mark.asyncio
+async def test_streamed_task_forwards_partials_before_response(make_orchestrator):
+    """A streamed request delivers partial text as it is generated, then the full reply"""
+    from types import SimpleNamespace
+
+    orchestrator = make_orchestrator({"Architect": ("unused", 0)})
+    agent = orchestrator.agents["Architect"]
+    agent.client = SimpleNamespace(messages=FakeMessages())
+    agent.stream_flush_interval = 0
+    partials = []
+
+    orchestrator.start_agents()
+    try:
+        result = await orchestrator.run_agent_task("Architect", {"action": "review"},
+                                                   timeout=5, on_partial=partials.append)
+    finally:
+        await orchestrator.stop_agents()
+
+    assert result == {"response": "Looks good to me"}
+    assert "".join(partials) == "Looks good to me"
+    assert len(partials) > 1
+    assert agent.usage["calls"] == 1
+
+
+
+@pytest.mark.asyncio
+async def test_partials_sent_to_an_agent_are_not_processed(make_orchestrator):
+    """An agent that streamed from another gets no LLM call per partial chunk"""
+    from orchestrator import AgentMessage, MessageType
+
+    orchestrator = make_orchestrator({"TechLead": RuntimeError("must not run")})
+    agent = orchestrator.agents["TechLead"]
+    partial = AgentMessage(from_agent="Architect", to_agent="TechLead", type=MessageType.NOTIFICATION,
+                           payload={"partial": "Looks"}, in_reply_to="request", partial=True)
+    assert await agent.process_message(partial) is None
+    assert await orchestrator.message_queue.receive("Architect") is None
+
+
+
+@pytest.mark.asyncio
+async def test_agent_replicas_share_the_load(tmp_path):
+    """Requests to an agent with replicas are handled concurrently"""
+    from pathlib import Path
+
+    from orchestrator import AgentConfig, MessageQueue, Orchestrator
+
+    orchestrator = Orchestrator(message_queue=MessageQueue(tmp_path / "messages"))
+    orchestrator.configs["QA"] = AgentConfig(name="QA", emoji="🟤", model="test-model",
+                                             role_file=Path("missing.md"), context_policy={},
+                                             files_allowed=[], replicas=3)
+    orchestrator.create_agents()
+    for agent in orchestrator.pool("QA"):
+        async def invoke_llm(prompt, context, priority=None, route=None, replica=agent.replica):
+            await asyncio.sleep(0.3)
+            return f"replica {replica}"
+        agent.invoke_llm = invoke_llm
+
+    orchestrator.start_agents()
+    started = time.monotonic()
+    try:
+        results = await asyncio.gather(*(orchestrator.run_agent_task("QA", {"story": i}) for i in range(3)))
+    finally:
+        await orchestrator.stop_agents()
+        orchestrator.message_queue.close()
+        orchestrator.context_cache.close()
+
+    assert time.monotonic() - started < 0.85
+    assert {result["response"] for result in results} == {"replica 0", "replica 1", "replica 2"}
+
+
+
+@pytest.mark.asyncio
+async def test_resume_skips_checkpointed_phases(make_orchestrator, tmp_path, monkeypatch):
+    """A resumed run replays done phases from the journal until an input changes"""
+    import json
+
+    from orchestrator import AgentTaskError
+
+    monkeypatch.chdir(tmp_path)
+    problem = tmp_path / "problem.md"
+    problem.write_text("Build a dashboard")
+    await make_orchestrator({"Researcher": ("findings", 0), "DeliveryLead": ("done", 0)}).execute_workflow(problem)
+
+    journal = tmp_path / "workspace" / "checkpoints" / "workflow.jsonl"
+    research = [json.loads(line) for line in journal.read_text().splitlines()
+                if '"research"' in line and '"done"' in line]
+    assert research[0]["outputs"] == {"response": "findings"}
+    assert len(research[0]["message_ids"]) == 1
+    # TechLead is not configured, so the specification phase did not happen
+    specification = [json.loads(line) for line in journal.read_text().splitlines() if '"specification"' in line]
+    assert [entry["status"] for entry in specification] == ["started", "skipped"]
+    assert specification[1]["missing_agents"] == ["TechLead"]
+
+    resumed = make_orchestrator({"Researcher": RuntimeError("must not run"), "DeliveryLead": ("done", 0)})
+    resumed.resume = True
+    await resumed.execute_workflow(problem)
+    specification = [json.loads(line) for line in journal.read_text().splitlines() if '"specification"' in line]
+    assert [entry["status"] for entry in specification] == ["started", "skipped", "started", "skipped"]
+
+    problem.write_text("Build a dashboard with alerts")
+    changed = make_orchestrator({"Researcher": RuntimeError("must not run"), "DeliveryLead": ("done", 0)})
+    changed.resume = True
+    with pytest.raises(AgentTaskError):
+        await changed.execute_workflow(problem)
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file
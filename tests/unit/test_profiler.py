@@ -0,0 +1,83 @@
+"""
+Unit tests for the workflow profiler
+"""
+import json
+import os
+import sys
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from orchestrator import Span, StubLLMClient, chrome_trace, critical_path
+
+
+def span(name, span_id, parent, start, end, **attributes):
+    return Span(name=name, trace_id="t", span_id=span_id, parent_span_id=parent,
+                start_ns=start, end_ns=end, attributes=attributes)
+
+
+def test_critical_path_follows_the_child_that_finished_last():
+    """Of two parallel tasks only the slower one is on the critical path"""
+    spans = [
+        span("workflow.execute", "root", None, 0, 100),
+        span("agent.task", "fast", "root", 10, 50, agent="ProductOwner"),
+        span("agent.task", "slow", "root", 10, 90, agent="Architect"),
+        span("llm.invoke", "llm", "slow", 20, 85, agent="Architect"),
+    ]
+
+    path = sorted((s.span_id, ns) for s, ns in critical_path(spans))
+
+    assert path == [("llm", 65), ("root", 10), ("root", 10), ("slow", 5), ("slow", 10)]
+    assert sum(ns for _, ns in critical_path(spans)) == 100
+    assert "fast" not in {s.span_id for s, _ in critical_path(spans)}
+
+
+def test_chrome_trace_puts_each_agent_on_its_own_lane():
+    spans = [
+        span("workflow.phase", "phase", None, 1000, 9000, **{"workflow.phase": "planning"}),
+        span("llm.invoke", "llm", "phase", 2000, 8000, agent="Architect"),
+    ]
+
+    events = chrome_trace(spans)["traceEvents"]
+
+    lanes = {event["args"]["name"]: event["tid"] for event in events if event["ph"] == "M"}
+    assert set(lanes) == {"Orchestrator", "Architect"}
+    llm = next(event for event in events if event["name"] == "llm.invoke[Architect]")
+    assert llm["tid"] == lanes["Architect"] and llm["ts"] == 1 and llm["dur"] == 6
+
+
+@pytest.mark.asyncio
+async def test_profile_run_writes_trace_and_summary(make_orchestrator, tmp_path, monkeypatch):
+    """Replies link back to the task that asked for them, so agent work lands on the path"""
+    monkeypatch.chdir(tmp_path)
+    orchestrator = make_orchestrator({"Researcher": ("findings", 0.05), "DeliveryLead": ("done", 0)})
+    (tmp_path / "problem.md").write_text("Build a dashboard")
+
+    await orchestrator.profile_workflow(tmp_path / "problem.md", tmp_path / "profile")
+
+    events = json.loads((tmp_path / "profile" / "trace.json").read_text())["traceEvents"]
+    names = {event["name"] for event in events}
+    assert {"workflow.phase[research]", "agent.task[Researcher]", "agent.process[Researcher]",
+            "queue.receive[Researcher]", "agent.load_context[Researcher]"} <= names
+    summary = (tmp_path / "profile" / "critical_path.txt").read_text()
+    assert summary.startswith("Wall time")
+    assert "agent.process[Researcher]" in summary
+
+
+@pytest.mark.asyncio
+async def test_stub_client_answers_message_batches(make_orchestrator):
+    """Batch-mode agents can be profiled against the stub"""
+    orchestrator = make_orchestrator({"QA": ("unused", 0)})
+    agent = orchestrator.agents["QA"]
+    agent.client = StubLLMClient(latency_scale=0, output_tokens=10)
+
+    results = await agent.invoke_llm_batch([("first", "system"), ("second", "system")])
+
+    assert len(results) == 2
+    assert all(result.startswith("[profile stub for test-model]") for result in results)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,107 @@
+"""
+Unit tests for the shared LLM rate limiter
+"""
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from orchestrator import Priority, RateLimiter, WaitRetryAfter, retry_after_seconds
+
+
+class RateLimitedError(Exception):
+    """An API error carrying a retry-after header"""
+
+    def __init__(self, retry_after):
+        super().__init__("429 rate_limit_error")
+        self.response = SimpleNamespace(headers={"retry-after": retry_after})
+
+
+@pytest.mark.asyncio
+async def test_critical_waiters_jump_the_queue():
+    """With every slot taken, the next free slot goes to the most urgent waiter"""
+    limiter = RateLimiter(max_concurrency=1, rpm=1000, tpm=10 ** 6)
+    await limiter.acquire("claude-3-5-sonnet", 10)
+    order = []
+
+    async def call(name, priority):
+        await limiter.acquire("claude-3-5-sonnet", 10, priority)
+        order.append(name)
+        limiter.release("claude-3-5-sonnet", 10, 10)
+
+    waiters = [asyncio.create_task(call("low", Priority.LOW)),
+               asyncio.create_task(call("medium", Priority.MEDIUM)),
+               asyncio.create_task(call("critical", Priority.CRITICAL))]
+    await asyncio.sleep(0.01)
+    assert limiter.waiting == 3
+    limiter.release("claude-3-5-sonnet", 10, 10)
+    await asyncio.gather(*waiters)
+
+    assert order == ["critical", "medium", "low"]
+    assert limiter.active == 0
+
+
+@pytest.mark.asyncio
+async def test_token_budget_delays_only_its_own_model():
+    """An exhausted tokens/min bucket holds its model until it refills"""
+    limiter = RateLimiter(max_concurrency=8, rpm=1000, tpm=6000)
+    await limiter.acquire("claude-3-opus", 6000)
+    limiter.release("claude-3-opus", 6000, 6000)
+
+    started = time.monotonic()
+    await limiter.acquire("claude-3-5-haiku", 100)
+    assert time.monotonic() - started < 0.05
+    await limiter.acquire("claude-3-opus", 30)
+    assert time.monotonic() - started >= 0.25
+
+
+@pytest.mark.asyncio
+async def test_retry_after_is_honoured(tmp_path):
+    """A 429's retry-after sets the backoff and pauses the model for everyone"""
+    from pathlib import Path
+
+    from orchestrator import Agent, AgentConfig, MessageQueue
+
+    assert retry_after_seconds(RateLimitedError("7")) == 7
+    assert retry_after_seconds(ValueError("no response")) is None
+    wait = WaitRetryAfter(lambda state: 30)
+    outcome = SimpleNamespace(exception=lambda: RateLimitedError("0.1"))
+    assert wait(SimpleNamespace(outcome=outcome)) == pytest.approx(0.1)
+
+    calls = []
+
+    async def create(**request):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RateLimitedError("0.2")
+        return SimpleNamespace(content=[SimpleNamespace(text="ok")],
+                               usage=SimpleNamespace(input_tokens=10, output_tokens=2))
+
+    config = AgentConfig(name="QA", emoji="🟤", model="claude-3-5-sonnet-20241022",
+                         role_file=Path("missing.md"), context_policy={}, files_allowed=[])
+    agent = Agent(config, SimpleNamespace(messages=SimpleNamespace(create=create)),
+                  MessageQueue(tmp_path / "messages"))
+
+    assert await agent.invoke_llm("run", "system") == "ok"
+    assert 0.2 <= calls[1] - calls[0] < 2
+    assert agent.rate_limiter.paused_until["claude-3-5-sonnet-20241022"] > calls[0]
+    agent.context_cache.close()
+
+
+def test_empty_limit_settings_fall_back_to_model_defaults(monkeypatch):
+    """Empty ANTHROPIC_RPM / ANTHROPIC_TPM values loaded from a .env mean unset"""
+    monkeypatch.setenv("ANTHROPIC_RPM", "")
+    monkeypatch.setenv("ANTHROPIC_TPM", "")
+    limiter = RateLimiter()
+    assert limiter.rpm == 0 and limiter.tpm == 0
+    assert limiter.limits_for("claude-3-5-sonnet") == RateLimiter(rpm=0, tpm=0).limits_for("claude-3-5-sonnet")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,337 @@
+"""
+Unit tests for the Redis Streams queue backend, run against an in-memory
+stand-in for the handful of stream commands the backend uses
+"""
+import asyncio
+import contextlib
+import os
+import sys
+import time
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from orchestrator import (
+    AgentMessage,
+    MessageQueue,
+    MessageType,
+    Priority,
+    RedisStreamsBackend,
+    create_queue_backend,
+)
+
+
+class FakeRedis:
+    """Minimal in-memory Redis Streams with consumer groups"""
+
+    def __init__(self):
+        self.streams = {}
+        self.groups = {}
+        self.sorted_sets = {}
+        self.lists = {}
+        self.last_id = (0, 0)
+        self.clock_offset = 0
+        self.changed = asyncio.Condition()
+
+    async def xadd(self, name, fields, maxlen=None, approximate=True):
+        # <ms>-<seq> ids, increasing across every stream
+        ms = int((time.time() + self.clock_offset) * 1000)
+        self.last_id = (ms, 0) if ms > self.last_id[0] else (self.last_id[0], self.last_id[1] + 1)
+        entry_id = "{}-{}".format(*self.last_id).encode()
+        encoded = {k.encode(): v if isinstance(v, bytes) else v.encode() for k, v in fields.items()}
+        self.streams.setdefault(name, []).append((entry_id, encoded))
+        async with self.changed:
+            self.changed.notify_all()
+        return entry_id
+
+    async def xgroup_create(self, name, groupname, id="$", mkstream=False):
+        if (name, groupname) in self.groups:
+            raise Exception("BUSYGROUP Consumer Group name already exists")
+        self.streams.setdefault(name, [])
+        self.groups[(name, groupname)] = {"delivered": len(self.streams[name]) if id == "$" else 0,
+                                          "pending": {}}
+        return True
+
+    async def xreadgroup(self, groupname, consumername, streams, count=None, block=None):
+        deadline = time.monotonic() + (block or 0) / 1000
+        while True:
+            for name in streams:
+                group = self.groups[(name, groupname)]
+                entries = self.streams[name][group["delivered"]:][:count]
+                if entries:
+                    group["delivered"] += len(entries)
+                    for entry_id, _ in entries:
+                        group["pending"][entry_id] = [consumername, time.monotonic()]
+                    return [[name.encode(), entries]]
+            remaining = deadline - time.monotonic()
+            if block is None or remaining <= 0:
+                return []
+            async with self.changed:
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(self.changed.wait(), remaining)
+
+    async def xack(self, name, groupname, *ids):
+        pending = self.groups[(name, groupname)]["pending"]
+        return sum(1 for entry_id in ids if pending.pop(entry_id, None))
+
+    async def xautoclaim(self, name, groupname, consumername, min_idle_time,
+                         start_id="0-0", count=None):
+        pending = self.groups[(name, groupname)]["pending"]
+        entries = dict(self.streams[name])
+        claimed = []
+        for entry_id, info in pending.items():
+            if (time.monotonic() - info[1]) * 1000 >= min_idle_time:
+                info[:] = [consumername, time.monotonic()]
+                claimed.append((entry_id, entries[entry_id]))
+                if count and len(claimed) >= count:
+                    break
+        return [b"0-0", claimed, []]
+
+    async def xclaim(self, name, groupname, consumername, min_idle_time, message_ids, justid=False):
+        pending = self.groups[(name, groupname)]["pending"]
+        entries = dict(self.streams[name])
+        claimed = []
+        for entry_id in message_ids:
+            entry_id = entry_id if isinstance(entry_id, bytes) else entry_id.encode()
+            if entry_id in pending:
+                pending[entry_id] = [consumername, time.monotonic()]
+                claimed.append(entry_id if justid else (entry_id, entries[entry_id]))
+        return claimed
+
+    async def xinfo_groups(self, name):
+        return [
+            {"name": groupname.encode(),
+             "last-delivered-id": (self.streams[name][group["delivered"] - 1][0]
+                                   if group["delivered"] else b"0-0"),
+             "lag": len(self.streams[name]) - group["delivered"]}
+            for (stream, groupname), group in self.groups.items() if stream == name
+        ]
+
+    async def xrange(self, name, min="-", max="+", count=None):
+        def bound(value, default):
+            if value in ("-", "+"):
+                return default, False
+            ms, seq = value.lstrip("(").split("-")
+            return (int(ms), int(seq)), value.startswith("(")
+
+        low, low_open = bound(min, (0, 0))
+        high, high_open = bound(max, (float("inf"), 0))
+        entries = []
+        for entry_id, fields in self.streams.get(name, []):
+            position = tuple(int(part) for part in entry_id.split(b"-"))
+            if (low < position or (position == low and not low_open)) and (
+                    position < high or (position == high and not high_open)):
+                entries.append((entry_id, fields))
+        return entries[:count]
+
+    async def zadd(self, name, mapping):
+        self.sorted_sets.setdefault(name, {}).update(mapping)
+
+    async def zrem(self, name, *members):
+        members = [member.decode() if isinstance(member, bytes) else member for member in members]
+        return sum(1 for member in members if self.sorted_sets.get(name, {}).pop(member, None) is not None)
+
+    async def rpush(self, name, *values):
+        self.lists.setdefault(name, []).extend(
+            value if isinstance(value, bytes) else value.encode() for value in values)
+
+    async def lpop(self, name):
+        values = self.lists.get(name)
+        return values.pop(0) if values else None
+
+    async def zrange(self, name, start, end):
+        members = sorted(self.sorted_sets.get(name, {}).items(), key=lambda item: item[1])
+        return [member.encode() for member, _ in members[start:None if end == -1 else end + 1]]
+
+    async def expire(self, name, seconds):
+        return True
+
+    async def aclose(self):
+        pass
+
+
+def make_message(to_agent="QA", **fields):
+    return AgentMessage(
+        from_agent="Orchestrator",
+        to_agent=to_agent,
+        type=MessageType.REQUEST,
+        payload={"action": "test"},
+        **fields
+    )
+
+
+@pytest.mark.asyncio
+async def test_round_trip_and_ack():
+    """Messages are delivered once and leave the pending list when acked"""
+    redis = FakeRedis()
+    backend = RedisStreamsBackend(client=redis, consumer="node-a")
+    message = make_message()
+
+    await backend.put(message)
+    received = await backend.take("QA")
+    assert received.id == message.id
+    assert await backend.take("QA") is None
+
+    pending = redis.groups[("agents:QA:inbox:medium", "QA")]["pending"]
+    assert len(pending) == 1
+    await backend.ack("QA", message.id)
+    assert not pending
+
+
+@pytest.mark.asyncio
+async def test_blocking_receive_wakes_on_send():
+    """receive() with a timeout blocks in XREADGROUP until a message lands"""
+    queue = MessageQueue(backend=RedisStreamsBackend(client=FakeRedis()))
+    receiver = asyncio.create_task(queue.receive("QA", timeout=5))
+    await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    message = make_message()
+    await queue.send(message)
+
+    assert (await receiver).id == message.id
+    assert time.perf_counter() - started < 0.5
+
+
+@pytest.mark.asyncio
+async def test_unacked_message_is_claimed_by_another_consumer():
+    """Work left in flight by a dead consumer is picked up by the next one"""
+    redis = FakeRedis()
+    crashed = RedisStreamsBackend(client=redis, consumer="node-a", claim_idle=0)
+    survivor = RedisStreamsBackend(client=redis, consumer="node-b", claim_idle=0)
+    message = make_message()
+
+    await crashed.put(message)
+    assert (await crashed.take("QA")).id == message.id
+
+    reclaimed = await survivor.take("QA")
+    assert reclaimed.id == message.id
+    await survivor.ack("QA", message.id)
+    assert await survivor.take("QA") is None
+
+
+@pytest.mark.asyncio
+async def test_replicas_keep_thread_order():
+    """A thread's next message waits for the previous one's ack, whichever replica took it"""
+    redis = FakeRedis()
+    first = RedisStreamsBackend(client=redis, consumer="node-a")
+    second = RedisStreamsBackend(client=redis, consumer="node-b")
+    opening = make_message(thread_id="review-42")
+    follow_up = make_message(thread_id="review-42", priority=Priority.CRITICAL)
+    other = make_message()
+    for message in (opening, follow_up, other):
+        await first.put(message)
+
+    # The CRITICAL follow-up is read first but waits for the opening message
+    assert (await first.take("QA")).id == opening.id
+    assert (await second.take("QA")).id == other.id
+    assert await second.take("QA") is None
+
+    await first.ack("QA", opening.id)
+    assert (await second.take("QA")).id == follow_up.id
+    await second.ack("QA", follow_up.id)
+    assert not redis.sorted_sets["agents:QA:thread-queue:review-42"]
+
+
+@pytest.mark.asyncio
+async def test_renew_keeps_a_held_message_from_being_claimed():
+    redis = FakeRedis()
+    holder = RedisStreamsBackend(client=redis, consumer="node-a", claim_idle=0.1)
+    other = RedisStreamsBackend(client=redis, consumer="node-b", claim_idle=0.1)
+    message = make_message()
+    await holder.put(message)
+    assert (await holder.take("QA")).id == message.id
+
+    await asyncio.sleep(0.07)
+    await holder.renew("QA", [message.id])
+    await asyncio.sleep(0.07)
+    assert await other.take("QA") is None
+    await asyncio.sleep(0.1)
+    assert (await other.take("QA")).id == message.id
+
+
+@pytest.mark.asyncio
+async def test_depth_and_peek():
+    """Depth and peek only see messages not yet delivered to the group"""
+    backend = RedisStreamsBackend(client=FakeRedis())
+    first, second = make_message(), make_message()
+    await backend.put(first)
+    await backend.put(second)
+
+    assert await backend.depth("QA") == 2
+    assert (await backend.peek("QA")).id == first.id
+    await backend.take("QA")
+    assert await backend.depth("QA") == 1
+    assert (await backend.peek("QA")).id == second.id
+
+
+@pytest.mark.asyncio
+async def test_priority_streams_with_aging():
+    """CRITICAL work is read first, until an old LOW message has aged past fresh HIGH work"""
+    backend = RedisStreamsBackend(client=FakeRedis(), aging_interval=10)
+    low, critical = make_message(priority=Priority.LOW), make_message(priority=Priority.CRITICAL)
+    await backend.put(low)
+    await backend.put(critical)
+    assert await backend.depth_by_priority("QA") == {"low": 1, "medium": 0, "high": 0, "critical": 1}
+    assert (await backend.peek("QA")).id == critical.id
+    assert (await backend.take("QA")).id == critical.id
+    assert (await backend.take("QA")).id == low.id
+
+    redis = FakeRedis()
+    backend = RedisStreamsBackend(client=redis, aging_interval=10)
+    stale = make_message(priority=Priority.LOW)
+    # Added 35s ago, 3.5 ranks of aging
+    redis.clock_offset = -35
+    await backend.put(stale)
+    redis.clock_offset = 0
+    await backend.put(make_message(priority=Priority.HIGH))
+    assert (await backend.take("QA")).id == stale.id
+    assert await backend.depth("QA") == 1
+
+
+def test_queue_type_selects_backend(tmp_path):
+    """MESSAGE_QUEUE_TYPE picks the backend, tolerating inline comments"""
+    assert isinstance(create_queue_backend("redis"), RedisStreamsBackend)
+    backend = create_queue_backend("filesystem  # or 'redis' for production", tmp_path)
+    assert backend.base_path == tmp_path
+
+
+
+@pytest.mark.asyncio
+async def test_broadcasts_use_a_consumer_group_per_agent():
+    """Every subscribed agent reads each broadcast once from the shared stream"""
+    redis = FakeRedis()
+    queue = MessageQueue(backend=RedisStreamsBackend(client=redis, consumer="node-a"))
+    await queue.subscribe("QA")
+    await queue.subscribe("Architect")
+    message = make_message("*")
+    await queue.broadcast(message, topic="workflow.status")
+
+    assert len(redis.streams["agents:broadcasts"]) == 1
+    for agent in ("QA", "Architect"):
+        received = await queue.receive(agent, topics=["workflow.*"])
+        assert (received.id, received.to_agent) == (message.id, agent)
+        assert await queue.receive(agent, topics=["workflow.*"]) is None
+
+
+
+@pytest.mark.asyncio
+async def test_thread_index_finds_request_and_reply():
+    redis = FakeRedis()
+    queue = MessageQueue(backend=RedisStreamsBackend(client=redis, consumer="node-a"))
+    request = make_message("SelfHealing")
+    reply = AgentMessage(from_agent="SelfHealing", to_agent="Orchestrator", type=MessageType.RESPONSE,
+                         payload={"response": "fixed"}, thread_id=request.id, in_reply_to=request.id)
+    await queue.send(request)
+    await queue.send(make_message())
+    await queue.send(reply)
+
+    thread = await queue.get_thread(reply.id)
+    assert [(entry.inbox, entry.message.id) for entry in thread] == [
+        ("SelfHealing", request.id), ("Orchestrator", reply.id)]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
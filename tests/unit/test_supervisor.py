@@ -0,0 +1,119 @@
+"""
+Unit tests for the multi-process agent supervisor
+"""
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from orchestrator import (
+    Agent,
+    AgentConfig,
+    AgentMessage,
+    AgentSupervisor,
+    MessageQueue,
+    MessageType,
+    Orchestrator,
+    serve_agent,
+)
+
+
+def flaky_agent_process(config, queue_path, heartbeat, heartbeat_interval, rate_share=1.0):
+    """Agent process whose first LLM call dies or wedges, depending on its name
+
+    A marker file next to the inbox records that the first attempt happened,
+    so the restarted process answers normally.
+    """
+    marker = Path(queue_path) / f"{config.name}.attempted"
+    agent = Agent(config, None, MessageQueue(Path(queue_path), poll_interval=0.1))
+
+    async def invoke_llm(prompt, context, priority=None, route=None):
+        if not marker.exists():
+            marker.write_text(str(os.getpid()))
+            if config.name == "Crashy":
+                os._exit(3)
+            time.sleep(600)  # blocks the event loop, so heartbeats stop
+        return f"{config.name} recovered"
+
+    agent.invoke_llm = invoke_llm
+    asyncio.run(serve_agent(agent, heartbeat, heartbeat_interval))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("name", ["Crashy", "Wedged"])
+async def test_failed_agent_process_is_restarted_and_its_message_redelivered(name, tmp_path):
+    """A crashed or wedged agent is replaced and the task it held still completes"""
+    queue = MessageQueue(tmp_path / "messages", poll_interval=0.1)
+    orchestrator = Orchestrator(message_queue=queue)
+    config = AgentConfig(name=name, emoji="🤖", model="test-model", role_file=Path("missing.md"),
+                         context_policy={}, files_allowed=[])
+    orchestrator.configs[name] = config
+    orchestrator.agents[name] = Agent(config, None, queue)
+    orchestrator.supervised = True
+    orchestrator.supervisor = supervisor = AgentSupervisor(
+        [config], queue, target=flaky_agent_process,
+        heartbeat_interval=0.2, heartbeat_timeout=1.5, backoff_base=0.2, backoff_max=5,
+        startup_timeout=60)
+
+    orchestrator.start_agents()
+    try:
+        result = await orchestrator.run_agent_task(name, {"action": "work"}, timeout=60)
+        worker = supervisor.workers[name]
+        assert result == {"response": f"{name} recovered"}
+        assert worker.restarts == 1
+        assert worker.process.pid != int((tmp_path / "messages" / f"{name}.attempted").read_text())
+    finally:
+        await orchestrator.stop_agents()
+        queue.close()
+        orchestrator.context_cache.close()
+        orchestrator.agents[name].context_cache.close()
+
+    assert not worker.process.is_alive()
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_timeout_only_applies_after_the_first_beat(tmp_path, monkeypatch):
+    """A process still importing is given startup_timeout, not heartbeat_timeout"""
+    queue = MessageQueue(tmp_path / "messages")
+    config = AgentConfig(name="Slow", emoji="🤖", model="test-model", role_file=Path("missing.md"),
+                         context_policy={}, files_allowed=[])
+    supervisor = AgentSupervisor([config], queue, heartbeat_timeout=1, startup_timeout=30)
+    worker = supervisor.workers["Slow"]
+    worker.process = SimpleNamespace(is_alive=lambda: True, kill=lambda: killed.append(True),
+                                     join=lambda timeout: None, exitcode=-9, pid=1)
+    killed = []
+
+    worker.started_at = time.time() - 10
+    await supervisor.check()
+    assert killed == [] and worker.restart_at is None
+
+    worker.heartbeat.value = time.time() - 10
+    await supervisor.check()
+    assert killed == [True] and worker.restarts == 1
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_requeue_returns_in_flight_messages_to_the_inbox(tmp_path):
+    queue = MessageQueue(tmp_path / "messages")
+    message = AgentMessage(from_agent="Orchestrator", to_agent="QA",
+                           type=MessageType.REQUEST, payload={"action": "test"})
+    await queue.send(message)
+    assert (await queue.receive("QA")).id == message.id
+    assert await queue.receive("QA") is None
+
+    assert await queue.requeue("QA") == 1
+    assert await queue.backend.depth("QA") == 1
+    assert (await queue.receive("QA")).id == message.id
+    await queue.backend.close()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
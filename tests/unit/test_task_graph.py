@@ -0,0 +1,122 @@
+"""
+Unit tests for the task graph executor
+"""
+import json
+import os
+import sys
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from orchestrator import TaskGraphExecutor
+
+
+def write_graph(tmp_path, tasks):
+    path = tmp_path / "task_graph.json"
+    path.write_text(json.dumps({"tasks": [
+        {"id": task_id, "agent": agent, "dependencies": deps}
+        for task_id, agent, deps in tasks
+    ]}))
+    return path
+
+
+DIAMOND = [
+    ("T1", "Architect", []),
+    ("T2", "BackendEngineer", ["T1"]),
+    ("T3", "FrontendEngineer", ["T1"]),
+    ("T4", "QA", ["T2", "T3"]),
+]
+
+
+def overlaps(a, b):
+    return a.started_at < b.finished_at and b.started_at < a.finished_at
+
+
+@pytest.mark.asyncio
+async def test_independent_tasks_overlap(make_orchestrator, tmp_path):
+    """Tasks whose dependencies are met run concurrently; the critical path is reported"""
+    orchestrator = make_orchestrator({
+        "Architect": ("design", 0.05),
+        "BackendEngineer": ("api", 0.3),
+        "FrontendEngineer": ("ui", 0.1),
+        "QA": ("green", 0.05),
+    })
+    orchestrator.start_agents()
+    try:
+        tasks = await TaskGraphExecutor(orchestrator, max_parallel=4).run(
+            TaskGraphExecutor.load(write_graph(tmp_path, DIAMOND)))
+    finally:
+        await orchestrator.stop_agents()
+
+    assert all(task.status == "done" for task in tasks.values())
+    assert overlaps(tasks["T2"], tasks["T3"])
+    assert tasks["T4"].started_at >= tasks["T2"].finished_at
+    assert [task.id for task in TaskGraphExecutor.critical_path(tasks)] == ["T1", "T2", "T4"]
+
+
+@pytest.mark.asyncio
+async def test_parallel_unsafe_agent_runs_alone(make_orchestrator, tmp_path):
+    """An agent that is not parallel_safe never shares the floor"""
+    orchestrator = make_orchestrator({
+        "Architect": ("design", 0.01),
+        "BackendEngineer": ("api", 0.1),
+        "FrontendEngineer": ("ui", 0.1),
+        "QA": ("green", 0.01),
+    }, configs={"FrontendEngineer": {"parallel_safe": False}})
+    orchestrator.start_agents()
+    try:
+        tasks = await TaskGraphExecutor(orchestrator).run(
+            TaskGraphExecutor.load(write_graph(tmp_path, DIAMOND)))
+    finally:
+        await orchestrator.stop_agents()
+
+    assert tasks["T4"].status == "done"
+    assert not overlaps(tasks["T2"], tasks["T3"])
+
+
+@pytest.mark.asyncio
+async def test_blocked_by_and_failure_skips_downstream(make_orchestrator, tmp_path):
+    """blocked_by waits for the blocking agent; failures skip dependent tasks"""
+    orchestrator = make_orchestrator({
+        "Architect": ("design", 0.01),
+        "BackendEngineer": RuntimeError("build broke"),
+        "FrontendEngineer": ("ui", 0.01),
+        "QA": ("green", 0.01),
+    }, configs={"FrontendEngineer": {"blocked_by": ["BackendEngineer"]}})
+    orchestrator.start_agents()
+    try:
+        tasks = await TaskGraphExecutor(orchestrator).run(
+            TaskGraphExecutor.load(write_graph(tmp_path, DIAMOND)))
+    finally:
+        await orchestrator.stop_agents()
+
+    assert tasks["T2"].status == "failed"
+    assert tasks["T3"].started_at >= tasks["T2"].finished_at
+    assert tasks["T4"].status == "skipped"
+
+
+@pytest.mark.asyncio
+async def test_tasks_that_can_never_start_fail(make_orchestrator, tmp_path):
+    """Agents blocked_by each other are reported as failed, not quietly skipped"""
+    orchestrator = make_orchestrator({"Architect": ("design", 0), "QA": ("green", 0)}, configs={
+        "Architect": {"blocked_by": ["QA"]}, "QA": {"blocked_by": ["Architect"]}})
+    tasks = await TaskGraphExecutor(orchestrator).run(TaskGraphExecutor.load(write_graph(
+        tmp_path, [("T1", "Architect", []), ("T2", "QA", []), ("T3", "QA", ["T1"])])))
+
+    assert tasks["T1"].status == tasks["T2"].status == "failed"
+    assert tasks["T1"].error == "never started, waiting on T2 (QA), T3 (QA)"
+    assert tasks["T3"].status == "skipped"
+
+
+def test_cycles_and_unknown_dependencies_are_rejected(tmp_path):
+    """A graph that cannot be scheduled fails fast"""
+    with pytest.raises(ValueError, match="cycle"):
+        TaskGraphExecutor.load(write_graph(tmp_path, [("A", "QA", ["B"]), ("B", "QA", ["A"])]))
+    with pytest.raises(ValueError, match="unknown"):
+        TaskGraphExecutor.load(write_graph(tmp_path, [("A", "QA", ["Z"])]))
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,127 @@
+"""
+Unit tests for spans, OTLP export and the Prometheus endpoint
+"""
+import json
+import os
+import sys
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import orchestrator
+from orchestrator import Agent, AgentConfig, AgentMessage, MessageQueue, MessageType, Telemetry
+
+
+class StubCollector(BaseHTTPRequestHandler):
+    """An OTLP/HTTP collector that keeps every export it is sent"""
+
+    server: "StubCollectorServer"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.exports.append((self.path, json.loads(body)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class StubCollectorServer(ThreadingHTTPServer):
+    """Serves StubCollector and holds the exports of one test"""
+
+    def __init__(self, address):
+        super().__init__(address, StubCollector)
+        self.exports: list[tuple[str, dict]] = []
+
+
+@pytest.fixture
+def collector(monkeypatch):
+    server = StubCollectorServer(("127.0.0.1", 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    tracer = Telemetry(enabled=True, endpoint=f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(orchestrator, "telemetry", tracer)
+    yield tracer, server.exports
+    server.shutdown()
+    server.server_close()
+
+
+def attributes(span):
+    return {item["key"]: next(iter(item["value"].values())) for item in span["attributes"]}
+
+
+@pytest.mark.asyncio
+async def test_spans_are_exported_as_otlp_json(collector, tmp_path):
+    """Queue and LLM spans nest under the phase span and carry token usage"""
+    tracer, exports = collector
+
+    async def create(**request):
+        return SimpleNamespace(content=[SimpleNamespace(text="ok")],
+                               usage=SimpleNamespace(input_tokens=120, output_tokens=8,
+                                                     cache_read_input_tokens=100))
+
+    config = AgentConfig(name="QA", emoji="🟤", model="claude-3-5-sonnet-20241022",
+                         role_file=Path("missing.md"), context_policy={}, files_allowed=[])
+    queue = MessageQueue(tmp_path / "messages")
+    agent = Agent(config, SimpleNamespace(messages=SimpleNamespace(create=create)), queue)
+
+    with tracer.span("workflow.phase", {"workflow.phase": "testing"}):
+        await queue.send(AgentMessage(from_agent="Orchestrator", to_agent="QA",
+                                      type=MessageType.REQUEST, payload={"action": "test"}))
+        assert await queue.receive("QA", timeout=1) is not None
+        assert await agent.invoke_llm("run", "system") == "ok"
+    tracer.flush()
+    queue.close()
+    agent.context_cache.close()
+
+    path, body = exports[0]
+    assert path == "/v1/traces"
+    resource = body["resourceSpans"][0]
+    assert attributes(resource["resource"])["service.name"] == tracer.service_name
+    spans = {span["name"]: span for span in resource["scopeSpans"][0]["spans"]}
+    assert set(spans) == {"workflow.phase", "queue.send", "queue.receive", "llm.invoke"}
+
+    phase = spans["workflow.phase"]
+    for name in ("queue.send", "queue.receive", "llm.invoke"):
+        assert spans[name]["traceId"] == phase["traceId"]
+        assert spans[name]["parentSpanId"] == phase["spanId"]
+    llm = attributes(spans["llm.invoke"])
+    assert llm["gen_ai.request.model"] == "claude-3-5-sonnet-20241022"
+    assert llm["gen_ai.usage.input_tokens"] == "120"
+    assert llm["gen_ai.usage.cache_read_input_tokens"] == "100"
+    assert "messaging.queue_time_ms" in attributes(spans["queue.receive"])
+
+
+def test_metrics_endpoint_serves_prometheus_text():
+    """Span durations become histograms and token usage becomes counters"""
+    tracer = Telemetry(enabled=False)
+    with tracer.span("llm.invoke", {"agent": "QA", "gen_ai.request.model": "claude-3-5-haiku"}) as span:
+        span.set_attributes({"gen_ai.usage.output_tokens": 42, "llm.ttft_ms": 150.0})
+    with pytest.raises(ValueError), tracer.span("queue.send", {"agent": "QA"}):
+        raise ValueError("disk full")
+
+    server = tracer.serve_metrics(0)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+            text = response.read().decode()
+    finally:
+        tracer.close()
+
+    assert "# TYPE orchestrator_span_duration_seconds histogram" in text
+    assert 'orchestrator_span_duration_seconds_count{agent="QA",span="llm.invoke"} 1' in text
+    assert 'orchestrator_llm_tokens_total{agent="QA",kind="output_tokens",model="claude-3-5-haiku"} 42' in text
+    assert 'orchestrator_llm_ttft_seconds_bucket{agent="QA",le="0.25"} 1' in text
+    assert 'orchestrator_span_errors_total{agent="QA",span="queue.send"} 1' in text
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Context Assembly Benchmarks
+Measures how long Agent.build_context takes to collect and pack a
+system prompt for a message
+"""
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orchestrator import Agent, AgentConfig, AgentMessage, ContextCache, MessageQueue, MessageType
+
+
+def legacy_load_context(role_file: Path, patterns) -> str:
+    """The pre-cache load_context: glob and read everything on every message"""
+    role_content = role_file.read_text() if role_file.exists() else ""
+    context_parts = [role_content]
+    for pattern in patterns:
+        for file in Path(".").glob(pattern):
+            if file.exists() and file.is_file():
+                context_parts.append(f"\n# File: {file}\n{file.read_text()}")
+    return "\n\n".join(context_parts)
+
+
+def timed(fn, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+@click.command()
+@click.option("--files", default=5000, help="Files in the generated workspace")
+@click.option("--size", default=2048, help="Bytes per file")
+@click.option("--repeat", default=5, help="Builds timed per variant")
+@click.option("--max-context-tokens", default=0,
+              help="Agent context budget (0: the model default); a budget that fits reuses the packed context")
+def main(files: int, size: int, repeat: int, max_context_tokens: int):
+    """Compare uncached and cached context builds on a synthetic workspace"""
+    logger.remove()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            Path("role.md").write_text("You are a benchmark agent")
+            for i in range(files):
+                folder = Path("workspace") / f"dir{i % 50}"
+                folder.mkdir(parents=True, exist_ok=True)
+                (folder / f"file{i}.md").write_text("x" * size)
+            patterns = ["workspace/**/*.md"]
+            role = Path("role.md")
+
+            print(f"Context build time, {files} files of {size} bytes\n")
+            print(f"{'uncached':<44}{timed(lambda: legacy_load_context(role, patterns), repeat):10.2f}ms")
+
+            policy = {"max_context_tokens": max_context_tokens} if max_context_tokens else {}
+            config = AgentConfig(name="Bench", emoji="🤖", model="claude-3-5-sonnet-20241022",
+                                 role_file=role, context_policy=policy, files_allowed=patterns)
+            messages = [AgentMessage(from_agent="Benchmark", to_agent="Bench", type=MessageType.REQUEST,
+                                     payload={"action": "review", "file": f"file{i}.md"})
+                        for i in range(repeat)]
+            for label, watch in (("cached, mtime validation", False), ("cached, watchdog", True)):
+                cache = ContextCache(watch=watch)
+                agent = Agent(config, None, MessageQueue(Path("messages")), context_cache=cache)
+                cold = timed(lambda agent=agent: agent.build_context(messages[0]), 1)
+                warm = timed(lambda agent=agent: agent.build_context(messages[0]), repeat)
+                started = time.perf_counter()
+                for message in messages:
+                    agent.build_context(message)
+                varied = (time.perf_counter() - started) / len(messages) * 1000
+                print(f"{label + ' (cold)':<44}{cold:10.2f}ms")
+                print(f"{label + ' (warm)':<44}{warm:10.2f}ms")
+                print(f"{label + ' (warm, new message)':<44}{varied:10.2f}ms")
+                cache.close()
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Message Thread Dump
+Prints every message of a conversation, from any of its message ids
+"""
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+
+import click
+from loguru import logger
+from rich.console import Console
+from rich.table import Table
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orchestrator import MessageQueue, create_queue_backend
+
+
+async def load_thread(messages_dir: Path, message_id: str, resolve: bool):
+    # Read-only, so dumping a thread never migrates or vacuums a live inbox
+    queue = MessageQueue(messages_dir, backend=create_queue_backend(base_path=messages_dir, read_only=True))
+    try:
+        entries = await queue.get_thread(message_id)
+        if resolve:
+            for entry in entries:
+                entry.message = await queue.resolve(entry.message)
+        return entries
+    finally:
+        await queue.backend.close()
+
+
+@click.command()
+@click.argument("message_id")
+@click.option("--messages-dir", default="workspace/messages", type=click.Path(path_type=Path),
+              help="Message queue directory (ignored with MESSAGE_QUEUE_TYPE=redis)")
+@click.option("--resolve", is_flag=True, default=False,
+              help="Inline payload values stored in the blob store")
+@click.option("--json", "as_json", is_flag=True, default=False,
+              help="Print the messages as JSON lines")
+@click.option("--width", default=120, help="Payload characters shown per message in the table")
+def main(message_id: str, messages_dir: Path, resolve: bool, as_json: bool, width: int):
+    """Dump the thread MESSAGE_ID belongs to, oldest message first"""
+    logger.remove()
+    entries = asyncio.run(load_thread(messages_dir, message_id, resolve))
+    if not entries:
+        click.echo(f"No messages found for {message_id}", err=True)
+        sys.exit(1)
+
+    if as_json:
+        for entry in entries:
+            click.echo(json.dumps({"inbox": entry.inbox, "state": entry.state,
+                                   "message": entry.message.model_dump(mode="json")}))
+        return
+
+    table = Table(title=f"Thread {entries[0].message.thread_id or entries[0].message.id}")
+    table.add_column("Time")
+    table.add_column("From → To")
+    table.add_column("Type")
+    table.add_column("State")
+    table.add_column("Id")
+    table.add_column("Payload", overflow="fold")
+    for entry in entries:
+        message = entry.message
+        payload = json.dumps(message.payload)
+        table.add_row(message.timestamp.strftime("%H:%M:%S.%f")[:-3],
+                      f"{message.from_agent} → {message.to_agent}",
+                      message.type.value, entry.state, message.id[:8],
+                      payload if len(payload) <= width else payload[:width] + "…")
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Message Queue Benchmarks
+Measures send-to-receive latency of the orchestrator MessageQueue
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import click
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orchestrator import (AgentMessage, MessageCodec, MessageQueue, MessageType, Priority,
+                          SQLiteInboxBackend)
+
+
+def make_message(to_agent: str = "Bench") -> AgentMessage:
+    return AgentMessage(
+        from_agent="Benchmark",
+        to_agent=to_agent,
+        type=MessageType.NOTIFICATION,
+        payload={"sent_at": time.perf_counter()}
+    )
+
+
+def summarize(label: str, latencies: List[float]):
+    """Print latency percentiles in milliseconds"""
+    ms = sorted(latency * 1000 for latency in latencies)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    print(f"{label:<24} n={len(ms):<4} "
+          f"p50={statistics.median(ms):8.2f}ms  p95={p95:8.2f}ms  max={ms[-1]:8.2f}ms")
+
+
+async def measure(queue: MessageQueue, samples: int, gap: float,
+                  poll_interval: float, mode: str) -> List[float]:
+    """Send ``samples`` messages and record how long each takes to be received"""
+    latencies: List[float] = []
+    done = asyncio.Event()
+
+    async def receiver():
+        while len(latencies) < samples:
+            if mode == "polling":
+                # The pre-event-driven Agent.run loop
+                message = await queue.receive("Bench")
+                if not message:
+                    await asyncio.sleep(poll_interval)
+                    continue
+            else:
+                message = await queue.receive("Bench", timeout=poll_interval)
+                if not message:
+                    continue
+            latencies.append(time.perf_counter() - message.payload["sent_at"])
+        done.set()
+
+    # Sends from another thread through a separate backend, without notifying
+    # the queue, the way a separate orchestrator process would
+    external = SQLiteInboxBackend(queue.base_path)
+    writer = ThreadPoolExecutor(max_workers=1)
+
+    async def external_send(message: AgentMessage):
+        await asyncio.get_running_loop().run_in_executor(writer, asyncio.run, external.put(message))
+
+    task = asyncio.create_task(receiver())
+    for _ in range(samples):
+        # Stagger sends so they land at random points in the poll cycle
+        await asyncio.sleep(gap)
+        message = make_message()
+        message.payload["sent_at"] = time.perf_counter()
+        if mode == "external":
+            await external_send(message)
+        else:
+            await queue.send(message)
+    await done.wait()
+    await task
+    writer.shutdown()
+    return latencies
+
+
+@click.group()
+def cli():
+    """MessageQueue benchmarks"""
+    # Per-message log lines would dominate the timings
+    logger.remove()
+
+
+@cli.command()
+@click.option("--samples", default=20, help="Messages per mode")
+@click.option("--gap", default=0.37, help="Seconds between sends")
+@click.option("--poll-interval", default=1.0, help="Sleep used by the polling loop")
+def latency(samples: int, gap: float, poll_interval: float):
+    """Compare the 1s polling loop against event-driven receive"""
+    print(f"Send-to-receive latency ({samples} messages, {gap}s apart)\n")
+    for mode in ("polling", "event", "external"):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = MessageQueue(Path(tmp), poll_interval=poll_interval)
+            try:
+                latencies = asyncio.run(measure(queue, samples, gap, poll_interval, mode))
+            finally:
+                queue.close()
+        label = {
+            "polling": f"polling ({poll_interval}s sleep)",
+            "event": "event (in-process)",
+            "external": "event (other process)",
+        }[mode]
+        summarize(label, latencies)
+
+
+def legacy_take(inbox: Path):
+    """The pre-SQLite receive path: sort the whole inbox to take one file"""
+    processed = inbox.parent / "processed"
+    processed.mkdir(exist_ok=True)
+    message_file = sorted(inbox.glob("*.json"))[0]
+    AgentMessage.model_validate_json(message_file.read_text())
+    message_file.rename(processed / message_file.name)
+
+
+@cli.command()
+@click.option("--sizes", default="100,1000,5000", help="Comma-separated inbox depths")
+@click.option("--takes", default=50, help="Dequeues timed per depth")
+def dequeue(sizes: str, takes: int):
+    """Compare per-dequeue cost of the sorted-glob inbox and the SQLite inbox"""
+    print(f"Mean dequeue time over {takes} takes\n")
+    for size in (int(n) for n in sizes.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            inbox = Path(tmp) / "Bench" / "inbox"
+            inbox.mkdir(parents=True)
+            for _ in range(size):
+                message = make_message()
+                (inbox / f"{message.timestamp.isoformat()}_{message.id}.json").write_text(
+                    message.model_dump_json(indent=2))
+            started = time.perf_counter()
+            for _ in range(takes):
+                legacy_take(inbox)
+            legacy = (time.perf_counter() - started) / takes
+
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = SQLiteInboxBackend(Path(tmp))
+
+            async def run(backend: SQLiteInboxBackend = backend, size: int = size) -> float:
+                for _ in range(size):
+                    await backend.put(make_message())
+                started = time.perf_counter()
+                for _ in range(takes):
+                    await backend.take("Bench")
+                return (time.perf_counter() - started) / takes
+
+            indexed = asyncio.run(run())
+            asyncio.run(backend.close())
+        print(f"depth={size:<6} sorted-glob={legacy * 1000:8.3f}ms  sqlite={indexed * 1000:8.3f}ms")
+
+
+async def mixed_load(backend: SQLiteInboxBackend, scheduled: bool, backlog: int,
+                     urgent: int, service: float) -> Dict[str, List[float]]:
+    """Drain a LOW/MEDIUM backlog while CRITICAL/HIGH messages keep arriving
+
+    With ``scheduled`` off every message is enqueued as MEDIUM, which is
+    exactly the old timestamp-ordered inbox.
+    """
+    latencies: Dict[str, List[float]] = {p.value: [] for p in Priority}
+
+    async def send(priority: Priority):
+        message = make_message()
+        message.priority = priority if scheduled else Priority.MEDIUM
+        message.payload.update(sent_at=time.perf_counter(), cls=priority.value)
+        await backend.put(message)
+
+    for i in range(backlog):
+        await send(Priority.LOW if i % 2 else Priority.MEDIUM)
+
+    async def producer():
+        for i in range(urgent):
+            await asyncio.sleep(service * 3)
+            await send(Priority.CRITICAL if i % 2 else Priority.HIGH)
+
+    producing = asyncio.create_task(producer())
+    remaining = backlog + urgent
+    while remaining:
+        message = await backend.take("Bench")
+        if not message:
+            await asyncio.sleep(0)
+            continue
+        latencies[message.payload["cls"]].append(time.perf_counter() - message.payload["sent_at"])
+        await backend.ack("Bench", message.id)
+        remaining -= 1
+        # Simulated processing time
+        await asyncio.sleep(service)
+    await producing
+    return latencies
+
+
+@cli.command()
+@click.option("--backlog", default=400, help="LOW/MEDIUM messages queued up front")
+@click.option("--urgent", default=60, help="CRITICAL/HIGH messages arriving during the drain")
+@click.option("--service", default=0.002, help="Simulated seconds of work per message")
+def priority(backlog: int, urgent: int, service: float):
+    """Per-priority latency under mixed load, FIFO inbox vs priority scheduler"""
+    for label, scheduled in (("fifo", False), ("priority", True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = SQLiteInboxBackend(Path(tmp))
+            latencies = asyncio.run(mixed_load(backend, scheduled, backlog, urgent, service))
+            asyncio.run(backend.close())
+        print(f"\n{label}")
+        for level in reversed(list(Priority)):
+            summarize(f"  {level.value}", latencies[level.value])
+
+
+def artifact_message(payload_kb: int) -> AgentMessage:
+    """A REQUEST carrying a spec and a test report, like the workflow phases send"""
+    spec = "\n".join(f"- REQ-{i}: The clinic dashboard shows appointment {i} with its SMS status"
+                      for i in range(payload_kb * 1024 // 70))
+    return AgentMessage(
+        from_agent="Orchestrator",
+        to_agent="Bench",
+        type=MessageType.REQUEST,
+        payload={"action": "finalize", "spec": spec, "test_results": {
+            "passed": 41, "failed": 1,
+            "details": [{"title": f"test {i}", "status": "passed", "duration": i * 3} for i in range(40)],
+        }}
+    )
+
+
+@cli.command()
+@click.option("--payload-kb", default=16, help="Approximate size of each message payload")
+@click.option("--messages", default=2000, help="Messages encoded and decoded per codec")
+def codec(payload_kb: int, messages: int):
+    """Encode/decode throughput and size of each message codec against indented JSON"""
+    message = artifact_message(payload_kb)
+    codecs = {"json (indent=2)": None}
+    for format in MessageCodec.FORMATS:
+        for compression in MessageCodec.COMPRESSIONS:
+            candidate = MessageCodec(format, compression)
+            if (candidate.format, candidate.compression) == (format, compression):
+                codecs[f"{format}+{compression}"] = candidate
+
+    print(f"{messages} messages of {len(message.model_dump_json()) / 1024:.1f} KB compact JSON\n")
+    for label, candidate in codecs.items():
+        started = time.perf_counter()
+        for _ in range(messages):
+            data = candidate.encode(message) if candidate else message.model_dump_json(indent=2)
+        encoded = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(messages):
+            if candidate:
+                MessageCodec.decode(data)
+            else:
+                AgentMessage(**json.loads(data))
+        decoded = time.perf_counter() - started
+        print(f"{label:<18} size={len(data) / 1024:8.1f}KB  "
+              f"encode={messages / encoded:9.0f}/s  decode={messages / decoded:9.0f}/s")
+
+
+if __name__ == "__main__":
+    cli()
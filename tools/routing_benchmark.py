@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Model Routing Benchmarks
+Replays recorded workflow messages through ModelRouter and compares the
+projected cost and generation time with every agent's configured model
+"""
+import json
+import os
+import sqlite3
+import sys
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+import click
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orchestrator import (AgentConfig, AgentMessage, MessageCodec, MessageType, ModelRouter,
+                          estimate_cost, estimate_latency, estimate_tokens)
+from tools.agent_registry import AgentRegistry
+
+
+def load_recorded(messages_dir: Path) -> List[AgentMessage]:
+    """Every message in the SQLite inboxes and legacy JSON files under ``messages_dir``"""
+    messages = []
+    for database in messages_dir.glob("*/inbox.sqlite"):
+        conn = sqlite3.connect(database)
+        try:
+            for (data,) in conn.execute("SELECT data FROM messages ORDER BY seq"):
+                messages.append(MessageCodec.decode(data))
+        finally:
+            conn.close()
+    for message_file in messages_dir.glob("*/*/*.json"):
+        messages.append(AgentMessage.model_validate_json(message_file.read_text()))
+    return messages
+
+
+def synthetic_workflow() -> List[AgentMessage]:
+    """The message mix of one autonomous run: a request and reply per phase,
+    plus the progress notifications agents send each other"""
+    messages = []
+    phases = [
+        ("Researcher", {"action": "research", "problem": "x" * 6000}),
+        ("TechLead", {"action": "create_spec", "research": "x" * 12000, "problem": "x" * 6000}),
+        ("ProductOwner", {"action": "create_backlog", "spec": "x" * 16000}),
+        ("Architect", {"action": "design", "spec": "x" * 16000}),
+        ("QA", {"action": "test", "test_plan": "e2e"}),
+        ("SelfHealing", {"action": "fix", "test_results": "x" * 3000}),
+        ("DeliveryLead", {"action": "finalize", "test_results": "x" * 3000}),
+    ]
+    for agent, payload in phases:
+        request = AgentMessage(from_agent="Orchestrator", to_agent=agent, type=MessageType.REQUEST,
+                               payload=payload, requires_response=True)
+        reply = AgentMessage(from_agent=agent, to_agent="Orchestrator", type=MessageType.RESPONSE,
+                             payload={"response": "x" * 9000}, in_reply_to=request.id)
+        messages += [request, reply]
+        for peer in ("TechLead", "Architect", "Researcher"):
+            messages.append(AgentMessage(from_agent=agent, to_agent=peer,
+                                         type=MessageType.NOTIFICATION,
+                                         payload={"status": f"{agent} finished {payload['action']}"}))
+    return messages
+
+
+def agent_config(name: str) -> AgentConfig:
+    spec = AgentRegistry.AGENTS.get(name, {})
+    return AgentConfig(name=name, emoji=spec.get("emoji", "🤖"),
+                       model=spec.get("model", "claude-3-5-sonnet-20241022"),
+                       role_file=Path("missing.md"), context_policy={}, files_allowed=[])
+
+
+@click.command()
+@click.option("--messages", "messages_dir", default="workspace/messages", type=click.Path(path_type=Path),
+              help="Recorded message directory of a previous run")
+@click.option("--synthetic", is_flag=True, help="Use a generated workflow instead of a recording")
+@click.option("--context-tokens", default=8000, help="System prompt tokens assumed per call")
+def main(messages_dir: Path, synthetic: bool, context_tokens: int):
+    """Projected cost and generation time, configured models vs routed"""
+    logger.remove()
+    messages = synthetic_workflow() if synthetic else load_recorded(messages_dir)
+    if not messages:
+        print(f"No recorded messages under {messages_dir}; try --synthetic")
+        return
+
+    # Output length is taken from the recorded reply where there is one
+    replies: Dict[str, int] = {
+        message.in_reply_to: estimate_tokens(json.dumps(message.payload))
+        for message in messages if message.in_reply_to
+    }
+    router = ModelRouter(enabled=True)
+    totals = defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0.0])
+    for message in messages:
+        # The Orchestrator consumes replies without calling the LLM
+        if message.to_agent == "Orchestrator":
+            continue
+        config = agent_config(message.to_agent)
+        baseline, route = router.default(config), router.route(config, message)
+        input_tokens = context_tokens + estimate_tokens(json.dumps(message.payload))
+        wanted = replies.get(message.id, baseline.max_tokens // 2)
+        row = totals[message.type.value]
+        row[0] += 1
+        row[1] += estimate_cost(baseline.model, input_tokens, min(wanted, baseline.max_tokens))
+        row[2] += estimate_cost(route.model, input_tokens, min(wanted, route.max_tokens))
+        row[3] += estimate_latency(baseline.model, min(wanted, baseline.max_tokens))
+        row[4] += estimate_latency(route.model, min(wanted, route.max_tokens))
+    if not totals:
+        print("No recorded messages were handled by an agent")
+        return
+
+    print(f"{sum(row[0] for row in totals.values())} LLM calls, {context_tokens} context tokens per call\n")
+    print(f"{'type':<14}{'n':>5}{'configured $':>14}{'routed $':>11}{'configured s':>14}{'routed s':>11}")
+    for message_type, (count, cost, routed_cost, seconds, routed_seconds) in sorted(totals.items()):
+        print(f"{message_type:<14}{count:>5}{cost:>14.3f}{routed_cost:>11.3f}"
+              f"{seconds:>14.1f}{routed_seconds:>11.1f}")
+    cost = sum(row[1] for row in totals.values())
+    routed_cost = sum(row[2] for row in totals.values())
+    seconds = sum(row[3] for row in totals.values())
+    routed_seconds = sum(row[4] for row in totals.values())
+    print(f"\nsaved ${cost - routed_cost:.3f} ({1 - routed_cost / cost:.0%}) "
+          f"and {seconds - routed_seconds:.0f}s of generation ({1 - routed_seconds / seconds:.0%})")
+
+
+if __name__ == "__main__":
+    main()